@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""Measures lambda module import time (cold start) and client creation latency.
+
+Every sample runs in a fresh interpreter so nothing is cached between them. The first
+client is the one a cold invocation creates, the second is what a warm invocation pays.
+
+    ./bench/coldstart.py --repeat 10 > coldstart.json
+
+Run it against two commits to compare them. Client timings need boto3 to be installed and
+are reported as null otherwise, no AWS credentials or network access are needed.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambdas")
+
+MODULES = [
+    "custom_metric_collector",
+    "lifecycle_init",
+    "lifecycle_handler",
+]
+
+SAMPLE = """
+import json, os, sys, time
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+sys.path.insert(0, {lambda_dir!r})
+start = time.perf_counter()
+import {module}
+imported = time.perf_counter()
+result = {{"import": imported - start, "first_client": None, "warm_client": None}}
+try:
+    import clients
+    clients.get("ecs")
+    created = time.perf_counter()
+    clients.get("ecs")
+    result["first_client"] = created - imported
+    result["warm_client"] = time.perf_counter() - created
+except ImportError:
+    pass
+print(json.dumps(result))
+"""
+
+
+def sample(module):
+    code = SAMPLE.format(lambda_dir=os.path.abspath(LAMBDA_DIR), module=module)
+    output = subprocess.check_output([sys.executable, "-c", code], stderr=subprocess.DEVNULL)
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def summarize(values):
+    values = [v for v in values if v is not None]
+    if not values:
+        return None
+    return {
+        "min_ms": min(values) * 1000,
+        "median_ms": statistics.median(values) * 1000,
+        "max_ms": max(values) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    results = {}
+    for module in MODULES:
+        samples = [sample(module) for _ in range(args.repeat)]
+        results[module] = {
+            key: summarize([s[key] for s in samples])
+            for key in ["import", "first_client", "warm_client"]
+        }
+    json.dump({"python": sys.version.split()[0], "repeat": args.repeat, "modules": results},
+              sys.stdout, indent=4, sort_keys=True)
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
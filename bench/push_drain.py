@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""Offline benchmark of drain completion from task stopped events against polling.
+
+A batch of instances of a synthetic cluster is drained and registered. Their tasks stop at
+random times, and a task stopped event is generated for each one from the recorded payload in
+bench/events/task-stopped.json, some of them sent twice as ECS can. The events are applied in
+order with drain_events, and the same stop times are replayed against the state machine's
+adaptive check schedule. For each path the delay between an instance's last task stopping and
+its lifecycle action completing is reported. Finally a fraction of the events is dropped, and
+the fallback check is shown to complete those instances.
+
+    ./bench/push_drain.py
+    ./bench/push_drain.py --drains 50 --lost 0.2
+"""
+import argparse
+import copy
+import datetime
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, "..", "lambdas"))
+sys.path.insert(0, BENCH_DIR)
+
+import drain_batch
+import drain_events
+import lifecycle_event
+import ratelimit
+from scale import retry_event
+from stub_aws import StubAWS, SyntheticCluster
+
+INSTANCES = 500
+SERVICES = 100
+# seconds over which the tasks of a draining instance stop, about a TaskStopTimeout of 30s
+STOP_SECONDS = 30
+# fraction of task events ECS sends a second time
+DUPLICATE_EVENTS = 0.1
+EVENT_FILE = os.path.join(BENCH_DIR, "events", "task-stopped.json")
+
+
+def task_events(cluster, instance, stop_times, template):
+    """Returns (stop time, event) for every task on instance, shaped like the recorded payload"""
+    events = []
+    for task_arn, stopped in zip(cluster.tasks[instance["containerInstanceArn"]], stop_times):
+        event = copy.deepcopy(template)
+        event["resources"] = [task_arn]
+        event["detail"]["clusterArn"] = cluster.arn
+        event["detail"]["containerInstanceArn"] = instance["containerInstanceArn"]
+        event["detail"]["taskArn"] = task_arn
+        for container in event["detail"]["containers"]:
+            container["taskArn"] = task_arn
+        events.append((stopped, event))
+    return events
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {}
+    return {
+        "mean": round(sum(values) / len(values), 3),
+        "p50": round(values[len(values) // 2], 3),
+        "max": round(values[-1], 3),
+    }
+
+
+def polled_delays(last_stops, stop_times):
+    """Replays the stop times against the adaptive check schedule, returning each instance's delay"""
+    start = datetime.datetime(2018, 1, 1)
+    endtime = start + datetime.timedelta(seconds=STOP_SECONDS * 4)
+    event = {}
+    elapsed = lifecycle_event.next_check_interval(event, None, endtime, now=start)
+    delays = []
+    pending = dict(last_stops)
+    while pending:
+        for arn, last in list(pending.items()):
+            if last <= elapsed:
+                delays.append(elapsed - last)
+                del pending[arn]
+        remaining = sum(1 for t in stop_times if t > elapsed)
+        elapsed += lifecycle_event.next_check_interval(
+            event, remaining, endtime, now=start + datetime.timedelta(seconds=elapsed))
+    return delays
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    cluster = SyntheticCluster(INSTANCES, SERVICES)
+    aws = StubAWS(cluster).install()
+    ratelimit.limiter.enabled = False
+    with open(EVENT_FILE) as f:
+        template = json.load(f)
+
+    state_dir = tempfile.mkdtemp()
+    registry = drain_events.FileDrainRegistry(state_dir)
+    drain_batch.registry = registry
+
+    drained = [i for i in cluster.instances.values() if cluster.tasks[i["containerInstanceArn"]]][:args.drains]
+    batch = {"batch": [retry_event(cluster, i) for i in drained], "state": "state_machine:init"}
+    batch = drain_batch.handle(batch)
+
+    events, last_stops, stop_times = [], {}, []
+    for instance in drained:
+        times = [rng.uniform(0, STOP_SECONDS) for _ in cluster.tasks[instance["containerInstanceArn"]]]
+        stop_times.extend(times)
+        last_stops[instance["containerInstanceArn"]] = max(times)
+        events.extend(task_events(cluster, instance, times, template))
+    events.extend([e for e in events if rng.random() < DUPLICATE_EVENTS])
+    events.sort(key=lambda e: e[0])
+    lost = set(rng.sample(sorted(last_stops), int(len(last_stops) * args.lost)))
+
+    aws.counter.reset()
+    processing = []
+    # a completion before the instance's last stop would show up as a negative delay
+    pushed_delays = []
+    for stopped, event in events:
+        arn = event["detail"]["containerInstanceArn"]
+        if arn in lost:
+            continue
+        start = time.perf_counter()
+        if drain_events.apply_task_event(registry, event):
+            pushed_delays.append(stopped - last_stops[arn])
+        processing.append(time.perf_counter() - start)
+    event_calls = dict(aws.counter.calls)
+
+    # the next check picks up the completions, and empties the instances whose events were lost
+    for arn in lost:
+        cluster.instances[arn]["runningTasksCount"] = cluster.instances[arn]["pendingTasksCount"] = 0
+    aws.counter.reset()
+    batch = drain_batch.handle(batch)
+
+    return {
+        "instances_drained": len(drained),
+        "task_events": len(events),
+        "pushed": {
+            "completed": len(pushed_delays),
+            "delay_seconds": percentiles(pushed_delays),
+            "processing_ms_per_event": percentiles([p * 1000 for p in processing]),
+            "api_calls": event_calls,
+        },
+        "polled": {
+            "delay_seconds": percentiles(polled_delays(last_stops, stop_times)),
+        },
+        "fallback_check": {
+            "events_lost_for": len(lost),
+            "state": batch["state"],
+            "still_draining": len(batch["batch"]),
+            "api_calls": dict(aws.counter.calls),
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--drains", type=int, default=20, help="instances drained together")
+    parser.add_argument("--lost", type=float, default=0.1, help="fraction of instances whose events are dropped")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    json.dump(run(args), sys.stdout, indent=4, sort_keys=True)
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""Offline scale benchmarks for the lambdas against a local stub of the AWS APIs.
+
+For every scenario a synthetic cluster is generated and each operation is measured for wall
+time, peak traced memory and the number of AWS API calls it made, by operation. Results are
+written as JSON so runs on two commits can be diffed.
+
+    ./bench/scale.py --output bench_output.json
+    ./bench/scale.py --scenarios 10x1 1000x200
+"""
+import argparse
+import datetime
+import json
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, "..", "lambdas"))
+sys.path.insert(0, BENCH_DIR)
+
+import capacity
+import cluster_stats
+import drain_batch
+import lifecycle_event
+import lifecycle_handler
+import ratelimit
+import simulation
+import snapshot
+from stub_aws import StubAWS, SyntheticCluster
+
+# (instances, services)
+SCENARIOS = [
+    (10, 1),
+    (100, 20),
+    (1000, 200),
+    (5000, 1000),
+    (10000, 2000),
+]
+# instances drained together in the batch drain scenario
+BATCH_DRAIN_SIZE = 50
+# what-if scenarios evaluated per run of the simulation scenario
+SIMULATION_SCENARIOS = 1000
+
+
+def lifecycle_message(cluster, instance):
+    return json.dumps({
+        "EC2InstanceId": instance["ec2InstanceId"],
+        "NotificationMetadata": json.dumps({"ecs_cluster": cluster.name, "ecs_timeout": "5m"}),
+        "AutoScalingGroupName": "bench-asg",
+        "LifecycleActionToken": "token-" + instance["ec2InstanceId"],
+        "LifecycleHookName": "bench-hook",
+    })
+
+
+def retry_event(cluster, instance):
+    endtime = datetime.datetime.now() + datetime.timedelta(minutes=5)
+    return {
+        "Records": [{"EventSource": "state_machine:retry",
+                     "Sns": {"Message": lifecycle_message(cluster, instance)}}],
+        "containerInstanceArn": instance["containerInstanceArn"],
+        "endtime": endtime.strftime('%Y-%m-%dT%H:%M:%S.%f'),
+        "state": "state_machine:retry",
+    }
+
+
+def operations(cluster):
+    """Returns (name, setup, run) for every measured operation. setup runs outside the measurement."""
+    instances = list(cluster.instances.values())
+    target = instances[len(instances) // 2]
+
+    def cold_cache():
+        cluster_stats.task_definition_cache = cluster_stats.TaskDefinitionCache()
+
+    def warm_cache():
+        cold_cache()
+        cluster_stats.ClusterStatAggregator(cluster.name)
+
+    def cold_index():
+        lifecycle_event.instance_index.clear()
+
+    def what_if_scenarios():
+        # a mix of every kind of change, the same for every run
+        services = [svc["serviceName"] for svc in cluster.services.values()]
+        scenarios = []
+        for i in range(SIMULATION_SCENARIOS):
+            if i % 3 == 0:
+                scenarios.append([{"add_instances": {"count": i % 20 + 1, "cpu": 4096, "memory": 15000}}])
+            elif i % 3 == 1:
+                scenarios.append([{"scale_service": {"service": services[i % len(services)], "desired": i % 50}}])
+            else:
+                scenarios.append([{"drain_instance": instances[i % len(instances)]["ec2InstanceId"]}])
+        return scenarios
+
+    what_if = {}
+
+    def simulate():
+        if "simulation" not in what_if:
+            what_if["simulation"] = simulation.Simulation(
+                snapshot.snapshot_from(cluster_stats.ClusterStatAggregator(cluster.name)))
+            what_if["scenarios"] = what_if_scenarios()
+        for scenario in what_if["scenarios"]:
+            what_if["simulation"].evaluate(scenario)
+
+    def batch_event():
+        return {"batch": [retry_event(cluster, i) for i in instances[:BATCH_DRAIN_SIZE]],
+                "state": "state_machine:retry"}
+
+    return [
+        ("cluster_stat_aggregator_cold", cold_cache, lambda: cluster_stats.ClusterStatAggregator(cluster.name)),
+        ("cluster_stat_aggregator_warm", warm_cache, lambda: cluster_stats.ClusterStatAggregator(cluster.name)),
+        ("get_ecs_instance", cold_index,
+         lambda: lifecycle_event.LifecycleEvent(drain_batch.sns_event(lifecycle_message(cluster, target)))),
+        ("lifecycle_handler_check", None, lambda: lifecycle_handler.main(retry_event(cluster, target))),
+        ("batch_drain_check", None, lambda: drain_batch.handle(batch_event())),
+        ("simulation_{}_scenarios".format(SIMULATION_SCENARIOS), simulate, simulate),
+    ]
+
+
+def measure(aws, setup, run):
+    # one untraced run for wall time, one traced run for memory
+    if setup:
+        setup()
+    aws.counter.reset()
+    start = time.perf_counter()
+    run()
+    wall = time.perf_counter() - start
+    calls = dict(aws.counter.calls)
+
+    if setup:
+        setup()
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "wall_ms": wall * 1000,
+        "peak_memory_kb": peak / 1024.0,
+        "api_calls": sum(calls.values()),
+        "api_calls_by_operation": calls,
+    }
+
+
+def run_scenario(instances, services):
+    cluster = SyntheticCluster(instances, services)
+    aws = StubAWS(cluster).install()
+    return {
+        "instances": instances,
+        "services": services,
+        "operations": {name: measure(aws, setup, run) for name, setup, run in operations(cluster)},
+    }
+
+
+def revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=BENCH_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenarios", nargs="*", metavar="INSTANCESxSERVICES",
+                        help="scenarios to run, defaults to all of them")
+    parser.add_argument("--output", help="file to write the JSON results to, defaults to stdout")
+    args = parser.parse_args()
+
+    scenarios = SCENARIOS
+    if args.scenarios:
+        scenarios = [tuple(int(n) for n in s.lower().split("x")) for s in args.scenarios]
+
+    # the lambdas log every step, which would dominate the timings
+    import logging
+    logging.getLogger().setLevel(logging.WARNING)
+    # keep one-off imports out of the first scenario's timings
+    capacity.load_numpy()
+    # the stubs never throttle, pacing calls would only measure the configured rates (see throttle.py)
+    ratelimit.limiter.enabled = False
+
+    results = {
+        "revision": revision(),
+        "python": sys.version.split()[0],
+        "scenarios": [run_scenario(instances, services) for instances, services in scenarios],
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=4, sort_keys=True)
+        sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,452 @@
+"""Local stand-ins for the ECS, AutoScaling, CloudWatch, SQS and Step Functions APIs the lambdas use.
+
+The stubs hold a synthetic cluster in memory, answer the same calls with the same response
+shapes as boto3 (including pagination and API batch limits) and count every call by operation.
+Install them with install(), which registers them with the lambdas' client registry.
+"""
+import random
+import re
+import threading
+import time
+from collections import Counter, OrderedDict
+
+# instance shapes as (instance type, cpu units, memory MiB)
+INSTANCE_TYPES = [
+    ("m5.large", 2048, 7680),
+    ("m5.xlarge", 4096, 15576),
+    ("c5.2xlarge", 8192, 15126),
+]
+# task sizes as (cpu units, memory MiB)
+TASK_SHAPES = [(128, 256), (256, 512), (512, 1024), (1024, 2048), (256, 2048), (2048, 1024)]
+
+
+# attempts per call before a throttled call fails, as in botocore's standard retry mode
+MAX_ATTEMPTS = 3
+
+
+class ApiLimitError(Exception):
+    """Raised when a call breaks a limit the real API enforces"""
+
+
+class ThrottlingError(Exception):
+    """Shaped like botocore's ClientError for a throttled call"""
+
+    def __init__(self, operation):
+        super(ThrottlingError, self).__init__("{} was throttled".format(operation))
+        self.response = {"Error": {"Code": "ThrottlingException", "Message": "Rate exceeded"}}
+
+
+class ServerRateLimit(object):
+    """Server side token bucket, calls over the limit are throttled"""
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.capacity = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.time()
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            now = time.time()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+class CallCounter(object):
+    def __init__(self):
+        self.calls = Counter()
+        self._lock = threading.Lock()
+
+    def count(self, operation):
+        with self._lock:
+            self.calls[operation] += 1
+
+    def reset(self):
+        with self._lock:
+            self.calls = Counter()
+
+
+class StubPaginator(object):
+    def __init__(self, method, result_key):
+        self.method = method
+        self.result_key = result_key
+
+    def paginate(self, PaginationConfig=None, **kwargs):
+        page_size = (PaginationConfig or {}).get("PageSize")
+        if page_size:
+            kwargs["maxResults"] = page_size
+        while True:
+            page = self.method(**kwargs)
+            yield page
+            if not page.get("nextToken"):
+                return
+            kwargs["nextToken"] = page["nextToken"]
+
+
+class StubEvents(object):
+    """Enough of botocore's hierarchical event emitter for handlers registered on client.meta.events"""
+
+    def __init__(self):
+        self.handlers = []
+
+    def register(self, event_name, handler):
+        self.handlers.append((event_name, handler))
+
+    def register_first(self, event_name, handler):
+        self.handlers.insert(0, (event_name, handler))
+
+    def emit(self, event_name, **kwargs):
+        responses = []
+        for name, handler in list(self.handlers):
+            if event_name == name or event_name.startswith(name + "."):
+                responses.append((handler, handler(event_name=event_name, **kwargs)))
+        return responses
+
+
+class StubMeta(object):
+    def __init__(self, events):
+        self.events = events
+
+
+def api(operation):
+    """Marks a stub method as an API operation, counted and emitted like a botocore call"""
+    def decorator(method):
+        def call(self, *args, **kwargs):
+            return self._invoke(operation, method, args, kwargs)
+        call.__name__ = method.__name__
+        return call
+    return decorator
+
+
+class StubClient(object):
+    # the hyphenated service id botocore names the call events after
+    service = None
+
+    def __init__(self, counter, limits=None):
+        self.counter = counter
+        self.meta = StubMeta(StubEvents())
+        # operation name to ServerRateLimit, operations without one are never throttled
+        self.limits = limits or {}
+
+    def _invoke(self, operation, method, args, kwargs):
+        name = "{}.{}".format(self.service, operation)
+        context = {}
+        self.meta.events.emit("before-call." + name, params=kwargs, context=context)
+        limit = self.limits.get(operation)
+        attempts = 0
+        try:
+            # retried like botocore does, emitting needs-retry for every throttled attempt
+            while True:
+                attempts += 1
+                self.counter.count(name)
+                if limit is None or limit.allow():
+                    break
+                self.counter.count(name + ".Throttled")
+                error = ThrottlingError(name)
+                self.meta.events.emit("needs-retry." + name, response=(None, error.response),
+                                      attempts=attempts, caught_exception=None)
+                if attempts >= MAX_ATTEMPTS:
+                    raise error
+                time.sleep(random.random() * min(20, 0.05 * 2 ** attempts))
+            parsed = method(self, *args, **kwargs)
+        except Exception as e:
+            self.meta.events.emit("after-call-error." + name, exception=e, context=context)
+            raise
+        parsed = dict(parsed, ResponseMetadata=dict(parsed.get("ResponseMetadata", {}), RetryAttempts=attempts - 1))
+        self.meta.events.emit("after-call." + name, parsed=parsed, context=context)
+        return parsed
+
+
+def _page(items, key, maxResults=100, nextToken=None, limit=100):
+    if maxResults > limit:
+        raise ApiLimitError("maxResults {} over {}".format(maxResults, limit))
+    start = int(nextToken or 0)
+    page = {key: items[start:start + maxResults]}
+    if start + maxResults < len(items):
+        page["nextToken"] = str(start + maxResults)
+    return page
+
+
+class StubECS(StubClient):
+    service = "ecs"
+
+    def __init__(self, counter, cluster, limits=None):
+        super(StubECS, self).__init__(counter, limits)
+        self.cluster = cluster
+
+    def get_paginator(self, operation):
+        return StubPaginator(getattr(self, operation), {
+            "list_container_instances": "containerInstanceArns",
+            "list_services": "serviceArns",
+            "list_clusters": "clusterArns",
+            "list_tasks": "taskArns",
+        }[operation])
+
+    @api("ListClusters")
+    def list_clusters(self, **kwargs):
+        return _page([self.cluster.arn], "clusterArns", **kwargs)
+
+    @api("DescribeClusters")
+    def describe_clusters(self, clusters, include=None):
+        return {"clusters": [{"clusterArn": self.cluster.arn, "clusterName": self.cluster.name,
+                              "tags": [{"key": k, "value": v} for k, v in self.cluster.tags.items()]}
+                             for arn in clusters if arn == self.cluster.arn]}
+
+    @api("ListContainerInstances")
+    def list_container_instances(self, cluster, filter=None, **kwargs):
+        arns = list(self.cluster.instances.keys())
+        if filter:
+            ids = set(re.findall(r"i-[0-9a-f]+", filter))
+            arns = [arn for arn in arns if self.cluster.instances[arn]["ec2InstanceId"] in ids]
+        return _page(arns, "containerInstanceArns", **kwargs)
+
+    @api("DescribeContainerInstances")
+    def describe_container_instances(self, cluster, containerInstances):
+        if len(containerInstances) > 100:
+            raise ApiLimitError("describe_container_instances takes at most 100 instances")
+        return {"containerInstances": [self.cluster.instances[arn] for arn in containerInstances
+                                       if arn in self.cluster.instances]}
+
+    @api("UpdateContainerInstancesState")
+    def update_container_instances_state(self, cluster, containerInstances, status):
+        if len(containerInstances) > 10:
+            raise ApiLimitError("update_container_instances_state takes at most 10 instances")
+        for arn in containerInstances:
+            self.cluster.instances[arn]["status"] = status
+        return {"containerInstances": [self.cluster.instances[arn] for arn in containerInstances]}
+
+    @api("ListServices")
+    def list_services(self, cluster, **kwargs):
+        return _page(list(self.cluster.services.keys()), "serviceArns", **kwargs)
+
+    @api("DescribeServices")
+    def describe_services(self, cluster, services):
+        if len(services) > 10:
+            raise ApiLimitError("describe_services takes at most 10 services")
+        # like the API, services can be named by ARN or by name
+        by_name = {service["serviceName"]: service for service in self.cluster.services.values()}
+        return {"services": [self.cluster.services.get(service) or by_name[service] for service in services]}
+
+    @api("DescribeTaskDefinition")
+    def describe_task_definition(self, taskDefinition):
+        return {"taskDefinition": self.cluster.task_definitions[taskDefinition]}
+
+    @api("ListTasks")
+    def list_tasks(self, cluster, containerInstance=None, desiredStatus=None, **kwargs):
+        # the synthetic cluster has no stopping tasks, all of them are desired RUNNING
+        tasks = [] if desiredStatus == "STOPPED" else self.cluster.tasks.get(containerInstance, [])
+        return _page(tasks, "taskArns", **kwargs)
+
+    @api("DescribeTasks")
+    def describe_tasks(self, cluster, tasks):
+        if len(tasks) > 100:
+            raise ApiLimitError("DescribeTasks accepts at most 100 tasks")
+        owners = {task: instance for instance, arns in self.cluster.tasks.items() for task in arns}
+        described = []
+        for arn in tasks:
+            # synthetic task arns are their service's arn with a task number
+            service = self.cluster.services[arn.rsplit("/task-", 1)[0]]
+            described.append({
+                "taskArn": arn,
+                "lastStatus": "RUNNING",
+                "containerInstanceArn": owners.get(arn),
+                "taskDefinitionArn": service["taskDefinition"],
+                "group": "service:" + service["serviceName"],
+            })
+        return {"tasks": described}
+
+
+class StubAutoScaling(StubClient):
+    service = "auto-scaling"
+
+    def __init__(self, counter, limits=None):
+        super(StubAutoScaling, self).__init__(counter, limits)
+        # autoscaling group name to its DesiredCapacity and MaxSize
+        self.groups = {}
+
+    @api("RecordLifecycleActionHeartbeat")
+    def record_lifecycle_action_heartbeat(self, **kwargs):
+        return {}
+
+    @api("CompleteLifecycleAction")
+    def complete_lifecycle_action(self, **kwargs):
+        return {"ResponseMetadata": {"HTTPStatusCode": 200}}
+
+    @api("DescribeAutoScalingGroups")
+    def describe_auto_scaling_groups(self, AutoScalingGroupNames):
+        return {"AutoScalingGroups": [
+            dict(self.groups.setdefault(name, {"DesiredCapacity": 1, "MaxSize": 1}), AutoScalingGroupName=name)
+            for name in AutoScalingGroupNames
+        ]}
+
+    @api("SetDesiredCapacity")
+    def set_desired_capacity(self, AutoScalingGroupName, DesiredCapacity, HonorCooldown=True):
+        self.groups.setdefault(AutoScalingGroupName, {"MaxSize": DesiredCapacity})["DesiredCapacity"] = DesiredCapacity
+        return {}
+
+
+class StubCloudWatch(StubClient):
+    service = "cloudwatch"
+
+    @api("PutMetricData")
+    def put_metric_data(self, Namespace, MetricData):
+        if len(MetricData) > 1000:
+            raise ApiLimitError("put_metric_data takes at most 1000 datums")
+        return {"ResponseMetadata": {"HTTPStatusCode": 200}}
+
+
+class StubSQS(StubClient):
+    """One queue, messages received stay invisible until they are deleted"""
+    service = "sqs"
+
+    def __init__(self, counter, limits=None):
+        super(StubSQS, self).__init__(counter, limits)
+        # receipt handle to message body, in the order they were sent
+        self.queued = OrderedDict()
+        self.in_flight = {}
+        self.sent = 0
+
+    def send(self, body):
+        self.sent += 1
+        self.queued["receipt-{}".format(self.sent)] = body
+
+    @api("ReceiveMessage")
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, **kwargs):
+        if MaxNumberOfMessages > 10:
+            raise ApiLimitError("receive_message returns at most 10 messages")
+        messages = []
+        while self.queued and len(messages) < MaxNumberOfMessages:
+            receipt, body = self.queued.popitem(last=False)
+            self.in_flight[receipt] = body
+            messages.append({"ReceiptHandle": receipt, "Body": body})
+        return {"Messages": messages} if messages else {}
+
+    @api("DeleteMessageBatch")
+    def delete_message_batch(self, QueueUrl, Entries):
+        if len(Entries) > 10:
+            raise ApiLimitError("delete_message_batch takes at most 10 entries")
+        for entry in Entries:
+            self.in_flight.pop(entry["ReceiptHandle"], None)
+        return {"Successful": [{"Id": entry["Id"]} for entry in Entries], "Failed": []}
+
+
+class StubStepFunctions(StubClient):
+    service = "sfn"
+
+    @api("StartExecution")
+    def start_execution(self, stateMachineArn, input):
+        return {"executionArn": stateMachineArn + ":execution"}
+
+
+class SyntheticCluster(object):
+    """A randomly generated but reproducible cluster in describe_* response shapes"""
+
+    def __init__(self, instances, services, name="bench", seed=0):
+        rng = random.Random(seed)
+        self.name = name
+        self.arn = "arn:aws:ecs:us-east-1:123456789012:cluster/{}".format(name)
+        self.tags = {"bench": "true"}
+        self.instances = {}
+        self.services = {}
+        self.task_definitions = {}
+        # container instance arn -> task arns
+        self.tasks = {}
+        self.task_count = 0
+
+        for i in range(instances):
+            instance_type, cpu, memory = rng.choice(INSTANCE_TYPES)
+            arn = "arn:aws:ecs:us-east-1:123456789012:container-instance/{}/{:032x}".format(name, i)
+            self.instances[arn] = {
+                "containerInstanceArn": arn,
+                "ec2InstanceId": "i-{:017x}".format(i),
+                "status": "ACTIVE",
+                "version": 1,
+                "runningTasksCount": 0,
+                "pendingTasksCount": 0,
+                "attributes": [
+                    {"name": "ecs.availability-zone", "value": "us-east-1{}".format("abc"[i % 3])},
+                    {"name": "ecs.instance-type", "value": instance_type},
+                ],
+                "registeredResources": [
+                    {"name": "CPU", "type": "INTEGER", "integerValue": cpu},
+                    {"name": "MEMORY", "type": "INTEGER", "integerValue": memory},
+                    {"name": "PORTS", "type": "STRINGSET", "stringSetValue": ["22", "2375", "2376", "51678"]},
+                ],
+                "remainingResources": [
+                    {"name": "CPU", "type": "INTEGER", "integerValue": cpu},
+                    {"name": "MEMORY", "type": "INTEGER", "integerValue": memory},
+                    {"name": "PORTS", "type": "STRINGSET", "stringSetValue": ["22", "2375", "2376", "51678"]},
+                ],
+            }
+            self.tasks[arn] = []
+
+        instance_arns = list(self.instances.keys())
+        for s in range(services):
+            cpu, memory = rng.choice(TASK_SHAPES)
+            task_def = "arn:aws:ecs:us-east-1:123456789012:task-definition/service-{}:1".format(s)
+            self.task_definitions[task_def] = {
+                "taskDefinitionArn": task_def,
+                "containerDefinitions": [
+                    {"name": "app", "cpu": cpu * 3 // 4, "memory": memory * 3 // 4},
+                    {"name": "sidecar", "cpu": cpu // 4, "memoryReservation": memory // 4},
+                ],
+            }
+            arn = "arn:aws:ecs:us-east-1:123456789012:service/{}/service-{}".format(name, s)
+            desired = rng.randint(1, 10)
+            running = self._place(rng, instance_arns, arn, desired, cpu, memory) if instance_arns else 0
+            self.services[arn] = {
+                "serviceArn": arn,
+                "serviceName": "service-{}".format(s),
+                "status": "ACTIVE",
+                "desiredCount": desired,
+                "runningCount": running,
+                "pendingCount": 0,
+                "taskDefinition": task_def,
+                "deployments": [],
+                "events": [],
+            }
+
+    def _place(self, rng, instance_arns, service_arn, count, cpu, memory):
+        """Places up to count tasks on random instances with room, returns how many were placed"""
+        placed = 0
+        for _ in range(count):
+            for _ in range(5):
+                instance = self.instances[rng.choice(instance_arns)]
+                free = {r["name"]: r for r in instance["remainingResources"]}
+                if free["CPU"]["integerValue"] >= cpu and free["MEMORY"]["integerValue"] >= memory:
+                    free["CPU"]["integerValue"] -= cpu
+                    free["MEMORY"]["integerValue"] -= memory
+                    instance["runningTasksCount"] += 1
+                    # numbered across the cluster, so every task arn is unique
+                    self.task_count += 1
+                    self.tasks[instance["containerInstanceArn"]].append("{}/task-{}".format(service_arn, self.task_count))
+                    placed += 1
+                    break
+        return placed
+
+
+class StubAWS(object):
+    """All of the stub clients for one synthetic cluster, sharing one call counter"""
+
+    def __init__(self, cluster, ecs_limits=None):
+        self.cluster = cluster
+        self.counter = CallCounter()
+        self.clients = {
+            "ecs": StubECS(self.counter, cluster, ecs_limits),
+            "autoscaling": StubAutoScaling(self.counter),
+            "cloudwatch": StubCloudWatch(self.counter),
+            "stepfunctions": StubStepFunctions(self.counter),
+            "sqs": StubSQS(self.counter),
+        }
+
+    def install(self):
+        """Registers the stubs with the lambdas' client registry"""
+        import clients
+        for service, client in self.clients.items():
+            clients.register(service, client)
+        return self
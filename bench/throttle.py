@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""Offline benchmark of drains competing with metric collection for throttled AWS APIs.
+
+The stub ECS API throttles every operation with a server side token bucket. Metric collection
+runs in a loop on several threads while one thread repeatedly drains and checks a batch of
+instances, once without the client side rate limiter and once with it. For each run the drain
+step latency and the throttled attempts and failed calls of each side are reported.
+
+    ./bench/throttle.py
+    ./bench/throttle.py --drains 20 --collectors 4
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, "..", "lambdas"))
+sys.path.insert(0, BENCH_DIR)
+
+import capacity_check
+import cluster_stats
+import drain_batch
+import ratelimit
+from scale import retry_event
+from stub_aws import ServerRateLimit, StubAWS, SyntheticCluster
+
+INSTANCES = 500
+SERVICES = 100
+BATCH_DRAIN_SIZE = 20
+# (requests per second, burst) the stub allows per ECS operation. Scaled down from the real
+# limits so a run takes seconds, the client side rates are set just under them
+SERVER_RATES = {
+    "ListContainerInstances": (20, 20),
+    "DescribeContainerInstances": (20, 20),
+    "ListServices": (20, 20),
+    "DescribeServices": (20, 20),
+    "DescribeTaskDefinition": (20, 20),
+    "UpdateContainerInstancesState": (10, 10),
+    "ListTasks": (20, 20),
+}
+CLIENT_RATE_FACTOR = 0.9
+UNPACED_RATE = 1000
+
+
+class CallerStats(object):
+    """Counts throttled attempts and failed calls by the name of the calling thread"""
+
+    def __init__(self):
+        self.throttles = Counter()
+        self.failures = Counter()
+        self._lock = threading.Lock()
+
+    def attach(self, client):
+        client.meta.events.register("needs-retry", self._needs_retry)
+        client.meta.events.register("after-call-error", self._after_call_error)
+
+    def _caller(self):
+        return threading.current_thread().name.split("-")[0]
+
+    def _needs_retry(self, **kwargs):
+        with self._lock:
+            self.throttles[self._caller()] += 1
+
+    def _after_call_error(self, **kwargs):
+        with self._lock:
+            self.failures[self._caller()] += 1
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else None
+
+
+def run(cluster, limited, drains, collectors):
+    # only ECS is throttled by the stub, the autoscaling calls of a drain aren't paced
+    rates = {op: (UNPACED_RATE, UNPACED_RATE) for op in ratelimit.PRIORITY_OPERATIONS}
+    rates.update({"ecs." + op: (rate * CLIENT_RATE_FACTOR, burst * CLIENT_RATE_FACTOR)
+                  for op, (rate, burst) in SERVER_RATES.items()})
+    ratelimit.limiter = ratelimit.RateLimiter(rates=rates, enabled=limited)
+    # clients picks up the limiter by name at import, point it at the new one
+    import clients
+    clients.limiter = ratelimit.limiter
+    drain_batch.limiter = ratelimit.limiter
+    cluster_stats.limiter = ratelimit.limiter
+    # every step here starts a new drain, which would scan the cluster for room each time. The
+    # bench measures the drain calls themselves against the collectors
+    capacity_check.CAPACITY_CHECK = False
+
+    limits = {op: ServerRateLimit(rate, burst) for op, (rate, burst) in SERVER_RATES.items()}
+    aws = StubAWS(cluster, ecs_limits=limits).install()
+    callers = CallerStats()
+    callers.attach(aws.clients["ecs"])
+
+    stop = threading.Event()
+    collections = Counter()
+
+    def collect():
+        while not stop.is_set():
+            cluster_stats.task_definition_cache = cluster_stats.TaskDefinitionCache()
+            try:
+                cluster_stats.ClusterStatAggregator(cluster.name)
+                collections["completed"] += 1
+            except Exception:
+                collections["failed"] += 1
+
+    threads = [threading.Thread(target=collect, name="metrics-{}".format(i)) for i in range(collectors)]
+    for thread in threads:
+        thread.start()
+
+    instances = list(cluster.instances.values())[:BATCH_DRAIN_SIZE]
+    latencies = []
+    result = {}
+
+    def drain():
+        for _ in range(drains):
+            start = time.perf_counter()
+            drain_batch.handle({"batch": [retry_event(cluster, i) for i in instances],
+                                "state": "state_machine:init"})
+            drain_batch.handle({"batch": [retry_event(cluster, i) for i in instances],
+                                "state": "state_machine:retry"})
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    # give the collectors a head start so the drains meet a busy API
+    time.sleep(0.5)
+    drainer = threading.Thread(target=drain, name="drain")
+    drainer.start()
+    drainer.join()
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    result.update({
+        "rate_limited": limited,
+        "drain_step_ms": {"p50": percentile(latencies, 0.5), "p90": percentile(latencies, 0.9),
+                          "max": max(latencies)},
+        "throttled_attempts": dict(callers.throttles),
+        "failed_calls": dict(callers.failures),
+        "metric_collections": dict(collections),
+    })
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--drains", type=int, default=10, help="drain steps to time")
+    parser.add_argument("--collectors", type=int, default=3, help="concurrent metric collection loops")
+    args = parser.parse_args()
+
+    # the lambdas log every step, every rate limited call and every failed drain call
+    import logging
+    logging.getLogger().setLevel(logging.CRITICAL)
+
+    cluster = SyntheticCluster(INSTANCES, SERVICES)
+    results = [run(cluster, limited, args.drains, args.collectors) for limited in (False, True)]
+    json.dump(results, sys.stdout, indent=4, sort_keys=True)
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
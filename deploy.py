@@ -1,53 +1,211 @@
 #!/usr/bin/env python3
+import argparse
+import ast
 import os
+import re
+import subprocess
+import sys
+import tempfile
 import zipfile
 import boto3
 import botocore
 import hashlib
 import io
+import json
 import yaml
 import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 
-def load_config():
-    with open("config.yml") as f:
+LAMBDA_DIR = "./lambdas/"
+# fixed timestamp for every zip entry, the earliest a zip file can hold
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+# lambda template parameter to the handler module of the function it deploys
+FUNCTIONS = {
+    "MetricLambdaS3Key": "custom_metric_collector",
+    "LifecycleInitS3Key": "lifecycle_init",
+    "LifecycleHandlerS3Key": "lifecycle_handler",
+    "TerminationPolicyS3Key": "termination_policy",
+    "DrainEventsS3Key": "drain_events",
+}
+# platform of the lambda runtime, numpy is installed from the wheels built for it
+LAYER_PLATFORM = ["--platform", "manylinux1_x86_64", "--implementation", "cp",
+                  "--python-version", "3.6", "--abi", "cp36m", "--only-binary=:all:"]
+# local state: the AMI lookup per region and what was last deployed to each stack
+CACHE_FILE = ".deploy_cache.json"
+AMI_CACHE_TTL = 24 * 3600
+TEMPLATES = ["cluster-template.json", "lambda-template.json", "compute-template.json"]
+# stack events are polled every POLL_MIN seconds while they keep coming, backing off to
+# POLL_MAX while nothing happens
+POLL_MIN = 2
+POLL_MAX = 15
+POLL_BACKOFF = 1.5
+# give up on a stack that hasn't finished after this many seconds
+STACK_TIMEOUT = 3600
+
+
+def load_config(path="config.yml"):
+    with open(path) as f:
         config = yaml.load(f.read())
     return config
 
 
-def package_lambda(config):
-    print("Packaging lambda function...")
-    s3 = boto3.client('s3', region_name=config["region"])
+def module_imports(module):
+    """Returns the lambda modules module imports, directly or through the modules it imports"""
+    closure = set()
+    todo = [module]
+    while todo:
+        name = todo.pop()
+        if name in closure or not os.path.exists(os.path.join(LAMBDA_DIR, name + ".py")):
+            continue
+        closure.add(name)
+        with open(os.path.join(LAMBDA_DIR, name + ".py")) as f:
+            tree = ast.parse(f.read())
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                todo.extend(alias.name.split(".")[0] for alias in node.names)
+            elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+                todo.append(node.module.split(".")[0])
+    return closure
 
-    zip_contents = io.BytesIO()
-    zippy = zipfile.ZipFile(zip_contents, mode="w")
-    for script in os.scandir("./lambdas/"):
-        path = script.path
-        zippy.write(path, arcname=script.name)
-    zippy.close()
 
+def build_zip(files):
+    """Zips files (arcname to path) reproducibly: sorted entries, fixed timestamps and permissions"""
+    zip_contents = io.BytesIO()
+    with zipfile.ZipFile(zip_contents, mode="w", compression=zipfile.ZIP_DEFLATED) as zippy:
+        for arcname in sorted(files):
+            info = zipfile.ZipInfo(arcname, date_time=ZIP_DATE_TIME)
+            info.external_attr = 0o644 << 16
+            info.compress_type = zipfile.ZIP_DEFLATED
+            with open(files[arcname], "rb") as f:
+                zippy.writestr(info, f.read())
     zip_contents.seek(0)
-    sha = hashlib.sha256()
-    sha.update(zip_contents.read())
-    s3_path = "ecs/lambdas/{}/code.zip".format(sha.hexdigest())
+    return zip_contents
+
+
+def uploaded(s3, bucket, key):
+    """Returns whether the key already exists"""
+    try:
+        s3.head_object(Bucket=bucket, Key=key)
+    except botocore.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] not in ("404", "NoSuchKey", "NotFound"):
+            raise
+        return False
+    print("s3://{}/{} is already uploaded".format(bucket, key))
+    return True
+
+
+def upload(s3, bucket, key, body):
+    """Uploads body unless the key already exists. Large bodies are uploaded in parts."""
+    if uploaded(s3, bucket, key):
+        return
+    print("Uploading lambda function to s3://{}/{}".format(bucket, key))
+    s3.upload_fileobj(body, bucket, key)
+
+
+def package_key(config, kind, digest):
+    s3_path = "ecs/{}/{}/code.zip".format(kind, digest)
     if config["Environment"]:
         s3_path = config["Environment"] + "/" + s3_path
-    zip_contents.seek(0)
+    return s3_path
 
-    print("Uploading lambda function to s3://{}/{}".format(config["S3Bucket"], s3_path))
-    s3.put_object(
-        Bucket=config["S3Bucket"],
-        Key=s3_path,
-        Body=zip_contents
-    )
 
+def package(s3, config, files, kind="lambdas"):
+    """Zips files and uploads them to their content-addressed key. Returns the key.
+    Without an s3 client the key is only computed."""
+    zip_contents = build_zip(files)
+    s3_path = package_key(config, kind, hashlib.sha256(zip_contents.getvalue()).hexdigest())
+    if s3 is not None:
+        upload(s3, config["S3Bucket"], s3_path, zip_contents)
     return s3_path
 
 
-def format_params(config):
+def package_lambda(config, per_function=False, upload=True):
+    """Packages and uploads the lambdas. Returns a dict of template parameter to S3 key.
+
+    Only the .py files of ./lambdas/ are packaged, so the key only changes with the code. With
+    per_function every function in FUNCTIONS also gets a package of just the modules it imports.
+    Without upload the keys are computed locally and nothing is written to S3.
+    """
+    print("Packaging lambda function...")
+    s3 = boto3.client('s3', region_name=config["region"]) if upload else None
+    files = {
+        script.name: script.path for script in os.scandir(LAMBDA_DIR)
+        if script.is_file() and script.name.endswith(".py")
+    }
+    keys = {"S3Key": package(s3, config, files)}
+    if per_function:
+        for param, module in FUNCTIONS.items():
+            modules = module_imports(module)
+            print("Packaging {} with {}".format(module, ", ".join(sorted(modules))))
+            keys[param] = package(s3, config, {m + ".py": files[m + ".py"] for m in modules})
+    return keys
+
+
+def package_numpy_layer(config, upload=True):
+    """Builds a lambda layer holding config's NumpyVersion of numpy and uploads it. Returns a dict
+    of template parameter to S3 key, empty when no NumpyVersion is configured.
+
+    The key is a hash of the pip requirement and platform rather than of the built files, so the
+    layer is only built when that key isn't uploaded yet, and a plan computes it without pip.
+    The python3.6 runtime has no numpy, without it the metric lambda counts capacity in plain python.
+    """
+    if not config.get("NumpyVersion"):
+        return {}
+    requirement = "numpy==" + str(config["NumpyVersion"])
+    digest = hashlib.sha256(json.dumps([requirement] + LAYER_PLATFORM).encode()).hexdigest()
+    keys = {"NumpyLayerS3Key": package_key(config, "layers/numpy", digest)}
+    if not upload:
+        return keys
+    s3 = boto3.client('s3', region_name=config["region"])
+    if uploaded(s3, config["S3Bucket"], keys["NumpyLayerS3Key"]):
+        return keys
+    print("Packaging numpy {} layer...".format(config["NumpyVersion"]))
+    with tempfile.TemporaryDirectory() as build:
+        target = os.path.join(build, "python")
+        subprocess.check_call([sys.executable, "-m", "pip", "install", "--quiet", "--no-compile",
+                               "--target", target] + LAYER_PLATFORM + [requirement])
+        files = {}
+        for root, _, names in os.walk(target):
+            for name in names:
+                path = os.path.join(root, name)
+                files[os.path.relpath(path, build)] = path
+        print("Uploading numpy layer to s3://{}/{}".format(config["S3Bucket"], keys["NumpyLayerS3Key"]))
+        s3.upload_fileobj(build_zip(files), config["S3Bucket"], keys["NumpyLayerS3Key"])
+    return keys
+
+
+def load_cache():
+    try:
+        with open(CACHE_FILE) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_cache(cache):
+    with open(CACHE_FILE + ".tmp", "w") as f:
+        json.dump(cache, f, indent=4, sort_keys=True)
+    os.replace(CACHE_FILE + ".tmp", CACHE_FILE)
+
+
+def cached_ami(config, cache):
+    """Returns the AMI found by the last lookup in the region if it is younger than AMI_CACHE_TTL"""
+    entry = cache.get("ami", {}).get(config["region"])
+    if entry and time.time() - entry["found_at"] < AMI_CACHE_TTL:
+        return entry["id"]
+    return None
+
+
+def format_params(config, cache=None):
     # not every config item is a param. Blacklist:
     config_blacklist =["region"]
+    cache = {} if cache is None else cache
     # if AmiId is not provided we need to discover it
+    if not config["AmiId"]:
+        config["AmiId"] = cached_ami(config, cache)
+        if config["AmiId"]:
+            print("Using cached AMI: {}".format(config["AmiId"]))
     if not config["AmiId"]:
         ec2 = boto3.client('ec2', region_name=config["region"])
         imgs = ec2.describe_images(
@@ -77,6 +235,7 @@ def format_params(config):
         sorted_imgs = sorted(imgs, key=lambda k: k["CreationDate"])
         config["AmiId"] = sorted_imgs[-1]["ImageId"]
         print("Found AMI: {}".format(config["AmiId"]))
+        cache.setdefault("ami", {})[config["region"]] = {"id": config["AmiId"], "found_at": time.time()}
     params = []
     for k, v in config.items():
         if v and k not in config_blacklist:
@@ -87,70 +246,308 @@ def format_params(config):
     return params
 
 
-def call_cloudformation(template, cluster_name, params, region, environment):
-    stack_name = cluster_name + "-ecs-" + template.split('-')[0] + "-stack"
+class DeployError(Exception):
+    def __init__(self, stack_name, status, reasons=None):
+        self.stack_name = stack_name
+        self.status = status
+        self.reasons = reasons or []
+        message = "{} failed with status {}".format(stack_name, status)
+        if self.reasons:
+            message += ": " + "; ".join(self.reasons)
+        super(DeployError, self).__init__(message)
+
+
+def stack_name(template, cluster_name, environment):
+    name = cluster_name + "-ecs-" + template.split('-')[0] + "-stack"
     if environment:
-        stack_name = environment + "-" + stack_name
+        name = environment + "-" + name
+    return name
+
+
+def _import_names(node):
+    """Yields every string inside the Fn::ImportValue calls of a template"""
+    if isinstance(node, dict):
+        for k, v in node.items():
+            if k == "Fn::ImportValue":
+                for s in _strings(v):
+                    yield s
+            else:
+                for s in _import_names(v):
+                    yield s
+    elif isinstance(node, list):
+        for v in node:
+            for s in _import_names(v):
+                yield s
+
+
+def _strings(node):
+    if isinstance(node, str):
+        yield node
+    elif isinstance(node, dict):
+        for v in node.values():
+            for s in _strings(v):
+                yield s
+    elif isinstance(node, list):
+        for v in node:
+            for s in _strings(v):
+                yield s
 
-    cfn = boto3.client("cloudformation", region_name=region)
-    # check if stack exists
-    with open("./templates/"+ template) as f:
+
+def template_dependencies(templates):
+    """Returns a dict of template to the templates whose stack exports it imports.
+
+    Imports name the exporting stack as ...-ecs-<kind>-stack:<Export>, see stack_name.
+    """
+    kinds = {t.split('-')[0]: t for t in templates}
+    dependencies = {}
+    for template in templates:
+        with open("./templates/" + template) as f:
+            body = json.load(f)
+        dependencies[template] = set()
+        for name in _import_names(body):
+            match = re.search(r"-ecs-(\w+)-stack:", name)
+            if match and kinds.get(match.group(1), template) != template:
+                dependencies[template].add(kinds[match.group(1)])
+    return dependencies
+
+
+def stack_cache_key(config, stack_name):
+    """Returns the key of a stack in the deploy cache, stack names only need to be unique per region"""
+    return "{}/{}".format(config["region"], stack_name)
+
+
+def stack_hash(template, params):
+    """Returns a hash of a template body and the parameters it is deployed with"""
+    sha = hashlib.sha256()
+    with open("./templates/" + template, "rb") as f:
+        sha.update(f.read())
+    sha.update(json.dumps(sorted((p["ParameterKey"], p["ParameterValue"]) for p in params)).encode())
+    return sha.hexdigest()
+
+
+def stack_version(client, stack_name):
+    """Returns (status, time of the last change) of a stack, None if it doesn't exist"""
+    try:
+        stack = client.describe_stacks(StackName=stack_name)["Stacks"][0]
+    except botocore.exceptions.ClientError:
+        return None
+    changed = stack.get("LastUpdatedTime") or stack["CreationTime"]
+    return stack["StackStatus"], changed.isoformat()
+
+
+def plan_stack(client, template, stack_name, params, cached):
+    """Returns (action, hash, version) for a stack, action is "create", "update" or "skip".
+
+    A stack is skipped when the hash of its template and parameters matches the one cached at
+    its last deploy and the stack hasn't changed since, so changes made outside of deploy.py
+    are still deployed over.
+    """
+    digest = stack_hash(template, params)
+    version = stack_version(client, stack_name)
+    if version is None:
+        return "create", digest, version
+    status, changed = version
+    if cached and cached["hash"] == digest and cached["changed"] == changed \
+            and status.endswith("_COMPLETE") and "ROLLBACK" not in status:
+        return "skip", digest, version
+    return "update", digest, version
+
+
+def latest_event_id(client, stack_name):
+    """Returns the id of the newest event of a stack, None if the stack doesn't exist"""
+    try:
+        events = client.describe_stack_events(StackName=stack_name)["StackEvents"]
+    except botocore.exceptions.ClientError:
+        return None
+    return events[0]["EventId"] if events else None
+
+
+def new_stack_events(client, stack_name, seen_id):
+    """Returns the events of a stack after seen_id, oldest first"""
+    events = []
+    for page in client.get_paginator("describe_stack_events").paginate(StackName=stack_name):
+        for event in page["StackEvents"]:
+            if event["EventId"] == seen_id:
+                return list(reversed(events))
+            events.append(event)
+    return list(reversed(events))
+
+
+def call_cloudformation(client, template, stack_name, params):
+    """Creates or updates a stack and waits on it. Returns per-resource timings, None if nothing changed."""
+    with open("./templates/" + template) as f:
         body = f.read()
+    seen_id = latest_event_id(client, stack_name)
+    args = dict(
+        TemplateBody=body,
+        StackName=stack_name,
+        Parameters=params,
+        Capabilities=["CAPABILITY_NAMED_IAM"]
+    )
     try:
-        cfn.create_stack(
-            TemplateBody=body,
-            StackName=stack_name,
-            Parameters=params,
-            Capabilities=["CAPABILITY_NAMED_IAM"]
-        )
-        wait_on_stack(cfn, stack_name, "create")
-    except botocore.exceptions.ClientError as e:
-        print(e)
-        if "AlreadyExistsException" in str(e):
-            try:
-                cfn.update_stack(
-                    TemplateBody=body,
-                    StackName=stack_name,
-                    Parameters=params,
-                    Capabilities=["CAPABILITY_NAMED_IAM"]
-                )
-                wait_on_stack(cfn, stack_name, "update")
-            except botocore.exceptions.ClientError:
-                pass
-
-
-def wait_on_stack(client, stack_name, stack_action):
-    counter = 1
-    for time_to_wait in range(counter, 30, 1):
-
-        res = client.describe_stacks(
-            StackName=stack_name)
-        if res['Stacks'][0]['StackStatus'] == '{}_IN_PROGRESS'.format(
-                stack_action.upper()):
-            time.sleep(30)
-            print("Waiting on CloudFormation...")
-
-        elif res['Stacks'][0][
-                'StackStatus'] == 'UPDATE_COMPLETE_CLEANUP_IN_PROGRESS':
-            time.sleep(30)
-            print("Almost done, Cleaning up.")
-
-        elif res['Stacks'][0]['StackStatus'] == '{}_COMPLETE'.format(
-                stack_action.upper()):
-            return
+        if seen_id is None:
+            client.create_stack(**args)
+            action = "create"
         else:
-            print("Deploy failed: {}".format(
-                res['Stacks'][0]['StackStatus']))
-            raise
+            client.update_stack(**args)
+            action = "update"
+    except botocore.exceptions.ClientError as e:
+        if "No updates are to be performed" in str(e):
+            print("[{}] No changes".format(stack_name))
+            return None
+        raise DeployError(stack_name, "{}_FAILED".format("UPDATE" if seen_id else "CREATE"), [str(e)])
+    return wait_on_stack(client, stack_name, action, seen_id)
+
+
+def wait_on_stack(client, stack_name, stack_action, seen_id=None):
+    """Streams the events of a stack until the action finishes.
+
+    Returns a dict of logical resource id to the seconds it took. Raises DeployError with the
+    reasons of the failed resources if the action fails or doesn't finish within STACK_TIMEOUT.
+    """
+    started = time.time()
+    interval = POLL_MIN
+    resource_started = {}
+    timings = {}
+    failures = []
+    while time.time() - started < STACK_TIMEOUT:
+        events = new_stack_events(client, stack_name, seen_id)
+        for event in events:
+            seen_id = event["EventId"]
+            resource, status = event["LogicalResourceId"], event["ResourceStatus"]
+            reason = event.get("ResourceStatusReason")
+            print("[{}] {} {}{}".format(stack_name, resource, status, " ({})".format(reason) if reason else ""))
+            if status.endswith("_FAILED") and reason:
+                failures.append("{}: {}".format(resource, reason))
+            if event["ResourceType"] == "AWS::CloudFormation::Stack" and resource == stack_name:
+                if status in ("{}_COMPLETE".format(stack_action.upper()), "UPDATE_COMPLETE_CLEANUP_IN_PROGRESS"):
+                    return timings
+                if status.endswith("_FAILED") or "ROLLBACK" in status:
+                    raise DeployError(stack_name, status, failures)
+            elif status.endswith("_IN_PROGRESS"):
+                resource_started.setdefault(resource, event["Timestamp"])
+            elif resource in resource_started:
+                timings[resource] = (event["Timestamp"] - resource_started.pop(resource)).total_seconds()
+        interval = POLL_MIN if events else min(POLL_MAX, interval * POLL_BACKOFF)
+        time.sleep(interval)
+    raise DeployError(stack_name, "TIMED_OUT", ["still in progress after {}s".format(STACK_TIMEOUT)])
+
+
+def template_params(template, params):
+    """Returns the params a template declares, so a change to one only changes the stacks that use it"""
+    with open("./templates/" + template) as f:
+        declared = json.load(f)["Parameters"]
+    return [p for p in params if p["ParameterKey"] in declared]
+
+
+def plan_stacks(client, config, params, cache, templates=TEMPLATES, force=False):
+    """Returns a dict of template to (stack name, action, hash, params) for the stacks of one environment"""
+    plan = {}
+    for template in templates:
+        name = stack_name(template, config["ClusterName"], config["Environment"])
+        stack_params = template_params(template, params)
+        cached = None if force else cache.get(stack_cache_key(config, name))
+        action, digest, _ = plan_stack(client, template, name, stack_params, cached)
+        print("{}: {}".format(name, action))
+        plan[template] = (name, action, digest, stack_params)
+    return plan
+
+
+def deploy_stacks(client, config, plan, templates=TEMPLATES):
+    """Deploys the templates of one environment, each stack as soon as the stacks it imports from are done.
+
+    Independent stacks deploy concurrently and stacks the plan skips aren't touched. Returns a
+    dict of stack cache key (region and stack name) to a result with the stack's status, duration, per-resource timings and
+    the hash and change time to cache. Stacks depending on a failed stack are skipped.
+    """
+    dependencies = template_dependencies(templates)
+    names = {t: plan[t][0] for t in templates}
+    results = {}
+    pending = set(templates)
+    running = {}
+
+    def deploy(template):
+        name, action, digest, params = plan[template]
+        if action == "skip":
+            return {"status": "UNCHANGED", "seconds": 0, "resources": {}}
+        print("Deploying {} to {}".format(template, config["region"]))
+        start = time.time()
+        try:
+            timings = call_cloudformation(client, template, name, params)
+            status = "UNCHANGED" if timings is None else "COMPLETE"
+            version = stack_version(client, name)
+            return {"status": status, "seconds": time.time() - start, "resources": timings or {},
+                    "cache": {"hash": digest, "changed": version[1]}}
+        except DeployError as e:
+            print(e)
+            return {"status": e.status, "seconds": time.time() - start, "resources": {}, "error": str(e)}
+
+    with ThreadPoolExecutor(max_workers=len(templates)) as executor:
+        while pending or running:
+            for template in sorted(pending):
+                failed = [d for d in dependencies[template] if d in results and "error" in results[d]]
+                if failed:
+                    results[template] = {"status": "SKIPPED", "seconds": 0, "resources": {},
+                                         "error": "{} failed".format(", ".join(names[d] for d in failed))}
+                    pending.discard(template)
+                elif all(d in results for d in dependencies[template]):
+                    running[executor.submit(deploy, template)] = template
+                    pending.discard(template)
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                results[running.pop(future)] = future.result()
+    return {stack_cache_key(config, names[t]): results[t] for t in templates}
+
+
+def report(results):
+    for name, result in results.items():
+        print("{}: {} in {:.0f}s".format(name, result["status"], result["seconds"]))
+        if "error" in result:
+            print("    " + result["error"])
+        slowest = sorted(result["resources"].items(), key=lambda r: r[1], reverse=True)
+        for resource, seconds in slowest:
+            print("    {:<40} {:>6.0f}s".format(resource, seconds))
 
 
 def main():
-    config = load_config()
-    config["S3Key"] = package_lambda(config)
-    params = format_params(config)
-    for t in ["cluster-template.json", "lambda-template.json", "compute-template.json"]:
-        print("Deploying {} to {}".format(t, config["region"]))
-        call_cloudformation(t, config["ClusterName"], params, config["region"], config["Environment"])
+    parser = argparse.ArgumentParser(description="Deploys the ECS cluster stacks")
+    parser.add_argument("configs", nargs="*", default=["config.yml"],
+                        help="config files to deploy, one per environment. Environments deploy concurrently")
+    parser.add_argument("--plan", action="store_true", help="only print what would be deployed")
+    parser.add_argument("--force", action="store_true", help="deploy every stack, even unchanged ones")
+    parser.add_argument("--per-function", action="store_true",
+                        help="also package each function with only the modules it imports")
+    args = parser.parse_args()
+
+    cache = load_cache()
+    environments = []
+    for path in args.configs:
+        config = load_config(path)
+        # a plan computes the package keys the stacks would get without uploading anything
+        config.update(package_lambda(config, args.per_function, upload=not args.plan))
+        config.update(package_numpy_layer(config, upload=not args.plan))
+        params = format_params(config, cache)
+        client = boto3.client("cloudformation", region_name=config["region"])
+        environments.append((client, config,
+                             plan_stacks(client, config, params, cache.get("stacks", {}), force=args.force)))
+    save_cache(cache)
+    if args.plan:
+        return
+
+    with ThreadPoolExecutor(max_workers=len(environments)) as executor:
+        futures = [executor.submit(deploy_stacks, *environment) for environment in environments]
+        results = {}
+        for future in futures:
+            results.update(future.result())
+    for key, result in results.items():
+        if "cache" in result:
+            cache.setdefault("stacks", {})[key] = result["cache"]
+    save_cache(cache)
+    report(results)
+    if any("error" in result for result in results.values()):
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,101 @@
+import logging
+from collections import Counter
+
+logger = logging.getLogger()
+logging.basicConfig()
+logger.setLevel(logging.INFO)
+
+# reported when nothing on the cluster constrains placement
+UNCONSTRAINED = 999999
+# number of task shapes evaluated per numpy block, keeps the intermediate matrices small
+# enough for the smallest lambda memory size
+SHAPE_BLOCK_SIZE = 64
+
+_numpy = []
+
+
+def load_numpy():
+    """Imports numpy on first use so it stays out of the lambda's import time. Returns None if it isn't packaged."""
+    if not _numpy:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        _numpy.append(numpy)
+    return _numpy[0]
+
+
+class CapacityEngine(object):
+    """Counts how many whole tasks of a given (cpu, memory) shape still fit on a set of instances.
+
+    A task can't be split across hosts, so each instance contributes
+    min(free_cpu // task_cpu, free_memory // task_memory) tasks. Instances with identical free
+    resources are collapsed into a single weighted row and each distinct task shape is counted
+    once. When numpy is available the counts for every shape are computed as one matrix
+    operation, otherwise the same computation runs over the collapsed rows in plain python.
+    """
+
+    def __init__(self, resource_pairs=(), counts=None):
+        """Takes (free cpu, free memory) per instance, or counts of instances per pair"""
+        if counts is None:
+            counts = Counter((int(cpu), int(memory)) for cpu, memory in resource_pairs)
+        self.free = [pair for pair in counts if counts[pair] > 0]
+        self.weights = [counts[pair] for pair in self.free]
+
+    def schedulable(self, task_shapes):
+        """Returns the number of whole tasks that fit on the instances for every (cpu, memory) shape.
+
+        A shape needing neither cpu nor memory can't be bounded and is reported as UNCONSTRAINED.
+        """
+        task_shapes = [(int(cpu), int(memory)) for cpu, memory in task_shapes]
+        if not task_shapes:
+            return []
+        if not self.free:
+            return [0 if cpu or memory else UNCONSTRAINED for cpu, memory in task_shapes]
+        # services commonly share a task size, so only count each distinct shape once
+        distinct = list(set(task_shapes))
+        numpy = load_numpy()
+        if numpy is not None:
+            counts = self._schedulable_numpy(numpy, distinct)
+        else:
+            counts = self._schedulable_python(distinct)
+        by_shape = dict(zip(distinct, counts))
+        return [by_shape[shape] for shape in task_shapes]
+
+    def _schedulable_python(self, task_shapes):
+        rows = list(zip(self.free, self.weights))
+        results = []
+        for cpu, memory in task_shapes:
+            if not cpu and not memory:
+                results.append(UNCONSTRAINED)
+            elif not cpu:
+                results.append(sum((free_mem // memory) * weight for (free_cpu, free_mem), weight in rows))
+            elif not memory:
+                results.append(sum((free_cpu // cpu) * weight for (free_cpu, free_mem), weight in rows))
+            else:
+                results.append(sum(min(free_cpu // cpu, free_mem // memory) * weight
+                                   for (free_cpu, free_mem), weight in rows))
+        return results
+
+    def _schedulable_numpy(self, numpy, task_shapes):
+        free = numpy.array(self.free, dtype=numpy.int64)
+        weights = numpy.array(self.weights, dtype=numpy.int64)
+        shapes = numpy.array(task_shapes, dtype=numpy.int64)
+        # a zero requirement never limits placement, so give it a divisor that always yields
+        # more fits than the other resource allows
+        unbounded = numpy.iinfo(numpy.int64).max
+        free_cpu = free[:, 0:1]
+        free_mem = free[:, 1:2]
+
+        results = numpy.empty(len(task_shapes), dtype=numpy.int64)
+        for start in range(0, len(task_shapes), SHAPE_BLOCK_SIZE):
+            block = shapes[start:start + SHAPE_BLOCK_SIZE]
+            cpu = block[:, 0]
+            memory = block[:, 1]
+            cpu_fits = numpy.where(cpu > 0, free_cpu // numpy.maximum(cpu, 1), unbounded)
+            mem_fits = numpy.where(memory > 0, free_mem // numpy.maximum(memory, 1), unbounded)
+            fits = numpy.minimum(cpu_fits, mem_fits)
+            results[start:start + SHAPE_BLOCK_SIZE] = weights.dot(numpy.where(fits == unbounded, 0, fits))
+
+        results[(shapes[:, 0] == 0) & (shapes[:, 1] == 0)] = UNCONSTRAINED
+        return [int(count) for count in results]
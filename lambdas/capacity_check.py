@@ -0,0 +1,110 @@
+import logging
+import os
+
+import clients
+from cluster_stats import DESCRIBE_SERVICES_BATCH, ClusterStatAggregator
+from simulation import Simulation
+from snapshot import snapshot_from
+
+logger = logging.getLogger()
+logging.basicConfig()
+logger.setLevel(logging.INFO)
+
+# set to off to drain without checking where the displaced tasks go
+CAPACITY_CHECK = os.environ.get("CAPACITY_CHECK", "on") != "off"
+# seconds a drain may wait for replacement capacity before it goes ahead regardless
+CAPACITY_WAIT = int(os.environ.get("CAPACITY_WAIT", 600))
+# shortest wait between checks while a drain waits for capacity or is watched for stuck tasks
+CAPACITY_CHECK_INTERVAL = 30
+# describe_tasks accepts at most this many tasks per request
+DESCRIBE_TASKS_BATCH = 100
+# part of the service event ECS records when it finds no instance for a task
+UNPLACEABLE_EVENT = "was unable to place a task"
+
+
+def instance_tasks(cluster_name, container_instance_arns):
+    """Returns the described tasks running on container instances"""
+    ecs = clients.get('ecs')
+    arns = []
+    for container_instance in container_instance_arns:
+        for page in ecs.get_paginator('list_tasks').paginate(cluster=cluster_name, containerInstance=container_instance):
+            arns.extend(page["taskArns"])
+    tasks = []
+    for i in range(0, len(arns), DESCRIBE_TASKS_BATCH):
+        tasks.extend(ecs.describe_tasks(cluster=cluster_name, tasks=arns[i:i + DESCRIBE_TASKS_BATCH])["tasks"])
+    return tasks
+
+
+def displaced_tasks(cluster_name, instances):
+    """Checks whether the rest of a cluster can take the tasks of instances about to be drained.
+
+    instances maps the ec2 instance ids to drain to their container instance ARNs. The cluster is
+    aggregated with ClusterStatAggregator, and the tasks on the instances are listed and sized by
+    their task definitions through the same task definition cache. The instances are then drained
+    in a simulation of the cluster, which places those tasks binpacked on the remaining ACTIVE
+    instances. Instances other batches are draining take no tasks, so they are left out. Returns
+    a dict with the tasks that wouldn't fit, the instances of the drained instances' size that
+    would have to be added to fit them and the services the tasks belong to.
+    """
+    cluster = ClusterStatAggregator(cluster_name, group_by=[])
+    snapshot = snapshot_from(cluster)
+    snapshot["instances"] = [
+        instance for instance in snapshot["instances"]
+        if instance["ec2InstanceId"] not in cluster.inactive or instance["ec2InstanceId"] in instances
+    ]
+    simulation = Simulation(snapshot)
+    draining = {i: arn for i, arn in instances.items() if i in simulation.instances}
+    tasks = instance_tasks(cluster_name, list(draining.values()))
+    shapes = cluster._resolve_task_definitions([task["taskDefinitionArn"] for task in tasks])
+    on_instance = {}
+    for task in tasks:
+        on_instance.setdefault(task["containerInstanceArn"], []).append(shapes[task["taskDefinitionArn"]])
+    changes = [{"drain_instance": i, "tasks": on_instance.get(arn, [])} for i, arn in sorted(draining.items())]
+    # only the tasks that don't fit matter here, so the capacity left isn't counted
+    unplaced = simulation.evaluate(changes, placement_only=True)["unplaced_tasks"] if changes else 0
+    needed = 0
+    if unplaced:
+        cpu, memory = max(tuple(simulation.instances[i]["registered"]) for i in draining)
+        # as many instances of the largest drained size as were drained took these tasks before,
+        # which bounds the search. Should binpack still leave some out, that many are asked for
+        needed = simulation.instances_needed(changes, cpu, memory, min_free=0, max_instances=len(draining)) \
+            or len(draining)
+    services = sorted({
+        task["group"][len("service:"):] for task in tasks if task.get("group", "").startswith("service:")
+    })
+    return {"unplaced_tasks": unplaced, "instances_needed": needed, "services": services}
+
+
+def unplaceable_services(cluster_name, services, since):
+    """Returns the services that ECS couldn't find an instance for a task of since a UTC datetime.
+
+    Used while a drain is under way, when the displaced tasks are already moving and a simulation
+    would count them on both their old and new instances.
+    """
+    ecs = clients.get('ecs')
+    stuck = []
+    for i in range(0, len(services), DESCRIBE_SERVICES_BATCH):
+        batch = services[i:i + DESCRIBE_SERVICES_BATCH]
+        for service in ecs.describe_services(cluster=cluster_name, services=batch)["services"]:
+            if any(UNPLACEABLE_EVENT in event["message"] and event["createdAt"] >= since
+                   for event in service.get("events", [])):
+                stuck.append(service["serviceName"])
+    return stuck
+
+
+def request_scale_out(asg_name, instances=1):
+    """Raises an autoscaling group's desired capacity by instances, capped at its MaxSize.
+    Returns the new desired capacity, None if the group is already at its maximum or the call failed."""
+    asg = clients.get('autoscaling')
+    try:
+        group = asg.describe_auto_scaling_groups(AutoScalingGroupNames=[asg_name])["AutoScalingGroups"][0]
+        desired = min(group["DesiredCapacity"] + instances, group["MaxSize"])
+        if desired <= group["DesiredCapacity"]:
+            logger.info("{} is at its MaxSize of {}, can't scale out".format(asg_name, group["MaxSize"]))
+            return None
+        asg.set_desired_capacity(AutoScalingGroupName=asg_name, DesiredCapacity=desired, HonorCooldown=False)
+    except Exception as e:
+        logger.error("Unable to scale out {}: {}".format(asg_name, e))
+        return None
+    logger.info("Scaled {} out to {} instances".format(asg_name, desired))
+    return desired
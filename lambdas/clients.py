@@ -0,0 +1,68 @@
+import logging
+import threading
+
+from instrumentation import api_stats
+from ratelimit import limiter
+
+logger = logging.getLogger()
+logging.basicConfig()
+logger.setLevel(logging.INFO)
+
+# shared by every client. Lambdas run one invocation at a time but fan out on thread pools,
+# so the connection pool is sized for the largest pool (see cluster_stats)
+CLIENT_CONFIG = {
+    "max_pool_connections": 25,
+    "connect_timeout": 5,
+    "read_timeout": 30,
+    "tcp_keepalive": True,
+    "retries": {"max_attempts": 5, "mode": "standard"},
+}
+
+_clients = {}
+_lock = threading.Lock()
+
+
+def _config():
+    """Returns a botocore Config for CLIENT_CONFIG, dropping options older botocore releases don't know"""
+    from botocore.config import Config
+    options = dict(CLIENT_CONFIG)
+    try:
+        return Config(**options)
+    except TypeError:
+        # tcp_keepalive and retry modes arrived in later botocore releases than some lambda runtimes bundle
+        options.pop("tcp_keepalive", None)
+        options["retries"] = {"max_attempts": options["retries"]["max_attempts"]}
+        return Config(**options)
+
+
+def get(service):
+    """Returns the shared client for an AWS service, creating it on first use.
+
+    boto3 itself is only imported when the first client is needed, which keeps it out of the
+    import time of every lambda module. Clients are kept for the life of the lambda container
+    so warm invocations reuse their connection pools.
+    """
+    client = _clients.get(service)
+    if client is None:
+        with _lock:
+            if service not in _clients:
+                import boto3
+                _clients[service] = boto3.client(service, config=_config())
+                api_stats.attach(_clients[service])
+                limiter.attach(_clients[service])
+            client = _clients[service]
+    return client
+
+
+def register(service, client):
+    """Installs a client for a service, such as a local stand-in used for testing"""
+    with _lock:
+        _clients[service] = client
+        api_stats.attach(client)
+        limiter.attach(client)
+
+
+def reset():
+    """Forgets every client so the next get creates a fresh one"""
+    with _lock:
+        _clients.clear()
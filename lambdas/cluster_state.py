@@ -0,0 +1,302 @@
+import calendar
+import logging
+import json
+import os
+import time
+
+import clients
+from cluster_stats import DESCRIBE_SERVICES_BATCH, ClusterStatAggregator
+
+logger = logging.getLogger()
+logging.basicConfig()
+logger.setLevel(logging.INFO)
+
+# seconds between full list/describe scans that reset the store
+RECONCILE_INTERVAL = int(os.environ.get("RECONCILE_INTERVAL", 900))
+# where stores are persisted between invocations. STATE_BUCKET keeps them in S3 so they survive
+# cold starts, without it they are files in STATE_DIR
+STATE_BUCKET = os.environ.get("STATE_BUCKET")
+STATE_PREFIX = os.environ.get("STATE_PREFIX", "ecs/state/")
+STATE_DIR = os.environ.get("STATE_DIR", "/tmp")
+# SQS queue the ECS state change events are delivered to, drained at the start of every run
+STATE_QUEUE_URL = os.environ.get("STATE_QUEUE_URL")
+# most receive calls made per run, what is left is drained by the next run
+MAX_QUEUE_RECEIVES = int(os.environ.get("MAX_QUEUE_RECEIVES", 300))
+
+INSTANCE_EVENT = "ECS Container Instance State Change"
+TASK_EVENT = "ECS Task State Change"
+
+# container instances in these states no longer hold capacity
+REMOVED_INSTANCE_STATUSES = ["INACTIVE", "DEREGISTERING", "REGISTRATION_FAILED"]
+# task statuses after which the task no longer counts towards its service
+STOPPED_TASK_STATUSES = ["DEACTIVATING", "STOPPING", "DEPROVISIONING", "STOPPED"]
+
+INSTANCE_FIELDS = ["containerInstanceArn", "ec2InstanceId", "status", "version", "attributes",
+                   "runningTasksCount", "pendingTasksCount"]
+SERVICE_FIELDS = ["serviceArn", "serviceName", "desiredCount", "runningCount", "pendingCount", "taskDefinition"]
+
+
+def compact_instance(instance):
+    """Returns the parts of a describe_container_instances entry (or event detail) the aggregator uses"""
+    record = {key: instance[key] for key in INSTANCE_FIELDS if key in instance}
+    for key in ["remainingResources", "registeredResources"]:
+        record[key] = [
+            {"name": item["name"], "integerValue": item["integerValue"]}
+            for item in instance[key] if item["name"] in ("CPU", "MEMORY")
+        ]
+    return record
+
+
+def compact_service(service):
+    """Returns the parts of a describe_services entry the aggregator uses"""
+    return {key: service[key] for key in SERVICE_FIELDS if key in service}
+
+
+def timestamp(value):
+    """Converts an ECS event timestamp such as 2018-01-01T00:00:00.123Z to epoch seconds"""
+    seconds, _, fraction = value.rstrip("Z").partition(".")
+    return calendar.timegm(time.strptime(seconds, "%Y-%m-%dT%H:%M:%S")) + float("0." + (fraction or "0"))
+
+
+class ClusterStateStore(object):
+    """Materialized view of one cluster's container instances and services.
+
+    The store is seeded by a full scan and then kept current by applying ECS container instance
+    and task state change events, so the metric can be computed without listing or describing
+    anything. Container instance events carry the full instance including remainingResources and
+    replace the stored instance outright. Task events adjust the running count of their service
+    and mark it as touched. Events don't carry a service's desired count or task definition, so
+    touched services are described again before the next aggregation reads them.
+    """
+
+    def __init__(self, cluster, instances=None, services=None, tasks=None, reconciled_at=0, touched=None):
+        self.cluster = cluster
+        # keyed by containerInstanceArn
+        self.instances = instances or {}
+        # keyed by serviceArn
+        self.services = services or {}
+        # taskArn -> [version, counted] for tasks seen since the last reconcile
+        self.tasks = tasks or {}
+        self.reconciled_at = reconciled_at
+        # names of the services task events touched since they were last described
+        self.touched = set(touched or [])
+
+    @classmethod
+    def path(cls, cluster):
+        return os.path.join(STATE_DIR, "ecs-cluster-state-{}.json".format(cluster))
+
+    @classmethod
+    def key(cls, cluster):
+        return "{}{}.json".format(STATE_PREFIX, cluster)
+
+    @classmethod
+    def load(cls, cluster, path=None):
+        """Loads the store for cluster from STATE_BUCKET or a file, returning an empty store if none was saved"""
+        try:
+            if STATE_BUCKET and path is None:
+                body = clients.get('s3').get_object(Bucket=STATE_BUCKET, Key=cls.key(cluster))["Body"].read()
+                state = json.loads(body.decode())
+            else:
+                with open(path or cls.path(cluster)) as f:
+                    state = json.load(f)
+        except Exception as e:
+            logger.info("No saved state for cluster {}: {}".format(cluster, e))
+            return cls(cluster)
+        return cls(cluster, state["instances"], state["services"], state["tasks"], state["reconciled_at"],
+                   state.get("touched"))
+
+    def save(self, path=None):
+        state = {
+            "cluster": self.cluster,
+            "instances": self.instances,
+            "services": self.services,
+            "tasks": self.tasks,
+            "reconciled_at": self.reconciled_at,
+            "touched": sorted(self.touched)
+        }
+        if STATE_BUCKET and path is None:
+            clients.get('s3').put_object(Bucket=STATE_BUCKET, Key=self.key(self.cluster),
+                                         Body=json.dumps(state).encode())
+            return
+        path = path or self.path(self.cluster)
+        with open(path + ".tmp", "w") as f:
+            json.dump(state, f)
+        os.rename(path + ".tmp", path)
+
+    def needs_reconcile(self, now=None):
+        return (now or time.time()) - self.reconciled_at >= RECONCILE_INTERVAL
+
+    def owns(self, cluster_arn):
+        return cluster_arn == self.cluster or cluster_arn.endswith(":cluster/" + self.cluster)
+
+    def apply_event(self, event):
+        """Applies an ECS state change event. Returns True if the store changed."""
+        detail = event.get("detail", {})
+        if not self.owns(detail.get("clusterArn", "")):
+            return False
+        if event.get("detail-type") == INSTANCE_EVENT:
+            return self._apply_instance_event(detail)
+        if event.get("detail-type") == TASK_EVENT:
+            return self._apply_task_event(detail)
+        return False
+
+    def apply_event_file(self, path):
+        """Applies every event in a file holding either a JSON list or one JSON event per line"""
+        with open(path) as f:
+            body = f.read().strip()
+        if body.startswith("["):
+            events = json.loads(body)
+        else:
+            events = [json.loads(line) for line in body.splitlines() if line.strip()]
+        return sum(1 for event in events if self.apply_event(event))
+
+    def _apply_instance_event(self, detail):
+        arn = detail["containerInstanceArn"]
+        current = self.instances.get(arn)
+        if current and current.get("version", 0) >= detail.get("version", 0):
+            return False
+        if detail.get("status") in REMOVED_INSTANCE_STATUSES:
+            return self.instances.pop(arn, None) is not None
+        self.instances[arn] = compact_instance(detail)
+        return True
+
+    def _apply_task_event(self, detail):
+        group = detail.get("group", "")
+        if not group.startswith("service:"):
+            return False
+        arn = detail["taskArn"]
+        version = detail.get("version", 0)
+        seen = self.tasks.get(arn)
+        if seen and seen[0] >= version:
+            return False
+
+        active = (detail.get("desiredStatus") == "RUNNING"
+                  and detail.get("lastStatus") not in STOPPED_TASK_STATUSES)
+        if seen:
+            counted = seen[1]
+        else:
+            # tasks created before the last scan are already in the service's running count
+            counted = timestamp(detail["createdAt"]) < self.reconciled_at if detail.get("createdAt") else active
+        self.tasks[arn] = [version, active]
+        # a task starting or stopping usually comes with a new desired count or task definition,
+        # and the scan may already have counted a task that stopped while it ran
+        name = group[len("service:"):]
+        self.touched.add(name)
+        if active != counted:
+            service = self._service_for_task(name, detail)
+            service["runningCount"] = max(0, service["runningCount"] + (1 if active else -1))
+        return True
+
+    def _service_for_task(self, name, detail):
+        for service in self.services.values():
+            if service["serviceName"] == name:
+                return service
+        # the service was created after the last scan, refresh_services fills in its desired count
+        arn = detail["clusterArn"].replace(":cluster/", ":service/") + "/" + name
+        self.services[arn] = {
+            "serviceArn": arn,
+            "serviceName": name,
+            "desiredCount": 0,
+            "runningCount": 0,
+            "pendingCount": 0,
+            "taskDefinition": detail["taskDefinitionArn"]
+        }
+        return self.services[arn]
+
+    def reconcile_instances(self, instances):
+        """Generator that stores every instance of a full scan, replacing the previous instances once it is exhausted"""
+        scanned = {}
+        for instance in instances:
+            scanned[instance["containerInstanceArn"]] = compact_instance(instance)
+            yield instance
+        self.instances = scanned
+
+    def reconcile_services(self, services):
+        """Generator that stores every service of a full scan, replacing the previous services once it is exhausted"""
+        scanned = {}
+        for service in services:
+            scanned[service["serviceArn"]] = compact_service(service)
+            yield service
+        self.services = scanned
+        self.tasks = {}
+        self.touched = set()
+        self.reconciled_at = time.time()
+
+    def refresh_services(self, services):
+        """Replaces the stored services with describe_services entries, dropping the deleted ones"""
+        for service in services:
+            name = service["serviceName"]
+            for arn in [arn for arn, stored in self.services.items() if stored["serviceName"] == name]:
+                del self.services[arn]
+            if service.get("status") != "INACTIVE":
+                self.services[service["serviceArn"]] = compact_service(service)
+            self.touched.discard(name)
+
+
+def apply_queued_events(queue_url=STATE_QUEUE_URL, max_receives=MAX_QUEUE_RECEIVES, stores=None):
+    """Applies the ECS state change events waiting in queue_url to the saved store of their cluster.
+
+    stores maps cluster names to stores already in memory, which are used instead of loading the
+    saved ones and gain any store that had to be loaded. Every changed store is saved before the
+    messages are deleted, so a run that fails part way leaves them to be delivered again. Events
+    carry versions, so applying one twice or out of order changes nothing. Returns the number of
+    events read.
+    """
+    sqs = clients.get('sqs')
+    stores = {} if stores is None else stores
+    changed, receipts = set(), []
+    for _ in range(max_receives):
+        messages = sqs.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10).get("Messages", [])
+        if not messages:
+            break
+        for message in messages:
+            receipts.append(message["ReceiptHandle"])
+            event = json.loads(message["Body"])
+            cluster = event.get("detail", {}).get("clusterArn", "").split("/")[-1]
+            if not cluster:
+                continue
+            if cluster not in stores:
+                stores[cluster] = ClusterStateStore.load(cluster)
+            if stores[cluster].apply_event(event):
+                changed.add(cluster)
+    for cluster in changed:
+        stores[cluster].save()
+    for i in range(0, len(receipts), 10):
+        sqs.delete_message_batch(QueueUrl=queue_url, Entries=[
+            {"Id": str(n), "ReceiptHandle": receipt} for n, receipt in enumerate(receipts[i:i + 10])
+        ])
+    logger.info("Read {} queued state change events, {} clusters changed".format(len(receipts), len(changed)))
+    return len(receipts)
+
+
+class StateStoreAggregator(ClusterStatAggregator):
+    """ClusterStatAggregator computed from a ClusterStateStore.
+
+    When the store is due for reconciliation the aggregation runs against a full scan of the
+    cluster and the store is rebuilt from it. Otherwise the only ECS calls made describe the
+    services task events touched since the last run.
+    """
+
+    def __init__(self, store, full_scan=None):
+        self.store = store
+        self.full_scan = store.needs_reconcile() if full_scan is None else full_scan
+        super(StateStoreAggregator, self).__init__(store.cluster)
+        self.output["state_store"] = {
+            "full_scan": self.full_scan,
+            "instances": len(store.instances),
+            "services": len(store.services),
+            "reconciled_at": store.reconciled_at
+        }
+
+    def _resolve_container_instances(self):
+        if self.full_scan:
+            return self.store.reconcile_instances(super(StateStoreAggregator, self)._resolve_container_instances())
+        return iter(list(self.store.instances.values()))
+
+    def _resolve_ecs_services(self):
+        if self.full_scan:
+            return self.store.reconcile_services(super(StateStoreAggregator, self)._resolve_ecs_services())
+        touched = sorted(self.store.touched)
+        for i in range(0, len(touched), DESCRIBE_SERVICES_BATCH):
+            self.store.refresh_services(self._describe_services(touched[i:i + DESCRIBE_SERVICES_BATCH]))
+        return iter(list(self.store.services.values()))
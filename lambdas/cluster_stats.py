@@ -1,180 +1,373 @@
 import logging
 import json
-import sys
+import os
+import threading
+from array import array
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
 
-import boto3
-import botocore
+import clients
+from instrumentation import api_stats, phase
+from ratelimit import limiter
+from capacity import CapacityEngine, UNCONSTRAINED
 
 logger = logging.getLogger()
 logging.basicConfig()
 logger.setLevel(logging.INFO)
 
+# number of task definition revisions kept between invocations
+TASK_DEFINITION_CACHE_SIZE = 5000
+# number of concurrent describe_task_definition calls on a cache miss
+TASK_DEFINITION_WORKERS = 10
+# ECS API limits for the discovery calls
+LIST_PAGE_SIZE = 100
+DESCRIBE_SERVICES_BATCH = 10
+DESCRIBE_CONTAINER_INSTANCES_BATCH = 100
+# number of concurrent describe calls during discovery
+DESCRIBE_WORKERS = 8
+# the parts of a describe_services entry the aggregator uses
+SERVICE_FIELDS = ["serviceName", "desiredCount", "runningCount", "pendingCount", "taskDefinition"]
+# container instance attributes capacity is also counted by, custom attributes can be added
+GROUP_ATTRIBUTES = [name for name in os.environ.get(
+    "GROUP_ATTRIBUTES", "ecs.availability-zone,ecs.instance-type").split(",") if name]
+# attribute values expected in the cluster, as name=value|value,name=value. A known value
+# without instances is still reported, with no room, rather than left out
+KNOWN_GROUPS = [
+    (name, value)
+    for name, _, values in (item.partition("=") for item in os.environ.get("GROUP_VALUES", "").split(",") if item)
+    for value in values.split("|") if value
+]
+
+
+def resource_values(resources):
+    """Returns the (cpu, memory) integer values of a remainingResources or registeredResources list"""
+    cpu = memory = 0
+    for item in resources:
+        if item["name"] == "CPU":
+            cpu = item["integerValue"]
+        elif item["name"] == "MEMORY":
+            memory = item["integerValue"]
+    return cpu, memory
+
+
+class TaskDefinitionCache(object):
+    """Bounded LRU cache of task shapes, (cpu, memory) per task, keyed by task definition ARN.
+
+    Task definition revisions are immutable, so entries never need to be refreshed.
+    A single module level instance is used so the cache survives warm lambda invocations.
+    """
+
+    def __init__(self, max_size=TASK_DEFINITION_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, arn):
+        with self._lock:
+            if arn not in self._entries:
+                return None
+            self._entries.move_to_end(arn)
+            return self._entries[arn]
+
+    def put(self, arn, task_shape):
+        with self._lock:
+            self._entries[arn] = task_shape
+            self._entries.move_to_end(arn)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+task_definition_cache = TaskDefinitionCache()
+
 class ClusterStatAggregator(object):
 
-    def __init__(self, cluster):
-        self.ecs = boto3.client('ecs')
+    def __init__(self, cluster, group_by=None):
         self.cluster = cluster
-        self.setup_instance_stats()
-        self.setup_services_stats()
-        self.calculate_usage_info()
+        # attribute names instances are grouped by, every value gets its own schedulable tasks
+        self.group_by = GROUP_ATTRIBUTES if group_by is None else group_by
+        self.cache_stats = {"hits": 0, "misses": 0}
+        # wall time in milliseconds of each aggregation phase
+        self.phases = {}
+        with phase(self.phases, "setup_instance_stats"):
+            self.setup_instance_stats()
+        with phase(self.phases, "setup_services_stats"):
+            self.setup_services_stats()
+        with phase(self.phases, "calculate_usage_info"):
+            self.calculate_usage_info()
 
         self.output = {
             "cluster": self.cluster,
             "cluster_cpu": self.cpu,
             "cluster_memory": self.memory,
-            "resource_pairs": self.resource_pairs,
+            # distinct (free cpu, free memory, instances) rows rather than one pair per instance
+            "free_resource_counts": self.free_resource_counts,
             "services": self.services,
             "services_required_resources": self.service_requirements,
             "largest_service": self.largest,
             "free_spaces": self.free_spaces,
+            "groups": self.groups,
             "desired_tasks": self.desired_tasks,
-            "percentage_occupied": self.percentage_occupied
+            "percentage_occupied": self.percentage_occupied,
+            "task_definition_cache": self.cache_stats,
+            "instrumentation": {
+                "phases": self.phases,
+                # clients are shared, so with several clusters in flight this covers all of them
+                "api": api_stats.summary()
+            }
         }
 
     def __repr__(self):
         return json.dumps(self.output, sort_keys=True, indent=4)
 
+    @property
+    def ecs(self):
+        return clients.get('ecs')
+
     def calculate_usage_info(self):
-        """Calculate the count of the largest service that can still be scheduled"""
-        if self.largest:
-            spaces = 0
-            for pair in self.resource_pairs:
-                cpu_fits = pair[0]/self.largest["cpu_per_task"]
-                mem_fits = pair[1]/self.largest["memory_per_task"]
-                fits = min(cpu_fits, mem_fits)
-                spaces += fits
-            self.free_spaces = spaces
+        """Calculate how many whole tasks of each service can still be scheduled.
+
+        The cluster-wide figure is the count for the most constrained service, i.e. the number of
+        additional tasks that can be placed whichever service they belong to.
+        """
+        engine = CapacityEngine(self.resource_pairs)
+        self.free_resource_counts = sorted(
+            [cpu, memory, weight] for (cpu, memory), weight in zip(engine.free, engine.weights))
+        shapes = [(svc["cpu_per_task"], svc["memory_per_task"]) for svc in self.services]
+        for svc, count in zip(self.services, engine.schedulable(shapes)):
+            svc["schedulable"] = count
+        self.groups = self._group_capacity(shapes)
+
+        constrained = [svc for svc in self.services if svc["schedulable"] != UNCONSTRAINED]
+        if constrained:
+            self.largest = min(constrained, key=lambda svc: svc["schedulable"])
+            self.free_spaces = self.largest["schedulable"]
             # calculating percentage occupied as
-            # (total # of tasks running) / (tasks running + spaces that the larges task can fit into)
-            self.percentage_occupied = float(self.desired_tasks) / (self.desired_tasks + self.free_spaces)
+            # (total # of tasks running) / (tasks running + spaces that the most constrained task can fit into)
+            if self.desired_tasks + self.free_spaces:
+                self.percentage_occupied = float(self.desired_tasks) / (self.desired_tasks + self.free_spaces)
+            else:
+                self.percentage_occupied = 0
         else:
             logger.info("No Services on cluster")
-            self.free_spaces = 999999
+            self.largest = None
+            self.free_spaces = UNCONSTRAINED
             self.percentage_occupied = 0
 
         logger.info("Number of schedulable tasks for most resource heavy task: {}".format(self.free_spaces))
         logger.info("Total number of desired tasks across all services: {}".format(self.desired_tasks))
 
-    def _get_container_instances(self):
-        """Generator that yields all of the ContainerInstances on self.cluster"""
-        pager = self.ecs.get_paginator("list_container_instances")
-        iterator = pager.paginate(cluster=self.cluster)
-        for page in iterator:
-            arns = page["containerInstanceArns"]
-            for arn in arns:
-                yield arn
+    def _group_capacity(self, shapes):
+        """Returns the schedulable tasks of the most constrained service among the instances sharing
+        each value of each group_by attribute.
+
+        A service placed by spread or by zone can only use the capacity of one group for a task,
+        so a full zone shows up here even while the cluster-wide figure has room. Values in
+        KNOWN_GROUPS with no instances get a group with no room.
+        """
+        groups = []
+        keys = set(self.group_counts).union(key for key in KNOWN_GROUPS if key[0] in self.group_by)
+        for key in sorted(keys, key=lambda key: (self.group_by.index(key[0]), str(key[1]))):
+            group = self.group_counts.get(key, Counter())
+            by_service = [
+                (count, svc["name"])
+                for svc, count in zip(self.services, CapacityEngine(counts=group).schedulable(shapes))
+                if count != UNCONSTRAINED
+            ]
+            free_spaces, largest = min(by_service) if by_service else (UNCONSTRAINED, None)
+            groups.append({
+                "attribute": key[0],
+                "value": key[1],
+                "instances": sum(group.values()),
+                "free_spaces": free_spaces,
+                "largest_service": largest,
+            })
+        return groups
+
+    def _group_keys(self, instance):
+        """Returns (attribute name, value) of every group_by attribute of a container instance, None where missing"""
+        values = {item["name"]: item.get("value") for item in instance.get("attributes", ()) if item["name"] in self.group_by}
+        return [(name, values.get(name)) for name in self.group_by]
+
+    def _stream_resources(self, list_operation, arn_key, describe, batch_size):
+        """Generator that pages through list_operation and yields described resources as batches finish.
+
+        Every page of ARNs is split into describe batches of batch_size which are submitted to a
+        bounded worker pool as soon as the page arrives, so the total time is bounded by the slowest
+        batch rather than the sum of all of them. Results are yielded in completion order.
+        """
+        pager = self.ecs.get_paginator(list_operation)
+        iterator = pager.paginate(cluster=self.cluster, PaginationConfig={"PageSize": LIST_PAGE_SIZE})
+        # the workers make their calls in the lane of the thread aggregating
+        describe = limiter.bind(describe)
+        with ThreadPoolExecutor(max_workers=DESCRIBE_WORKERS) as pool:
+            pending = set()
+            for page in iterator:
+                arns = page[arn_key]
+                for i in range(0, len(arns), batch_size):
+                    pending.add(pool.submit(describe, arns[i:i + batch_size]))
+                # don't let listing run arbitrarily far ahead of the describe calls
+                if len(pending) >= DESCRIBE_WORKERS * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                else:
+                    done = set(future for future in pending if future.done())
+                    pending -= done
+                for future in done:
+                    for resource in future.result():
+                        yield resource
+            for future in as_completed(pending):
+                for resource in future.result():
+                    yield resource
+
+    def _describe_container_instances(self, batch):
+        return self.ecs.describe_container_instances(
+            cluster=self.cluster,
+            containerInstances=batch)["containerInstances"]
 
     def _resolve_container_instances(self):
         """Generator that yields all containerInstance information on self.cluster"""
-        instance_arns = list(self._get_container_instances())
-
-        def chunks(l, n):
-            """Yield successive n-sized chunks from l."""
-            for i in range(0, len(l), n):
-                yield l[i:i + n]
-
-        for batch in chunks(instance_arns, 50):
-            instances = self.ecs.describe_container_instances(
-                cluster=self.cluster,
-                containerInstances=batch)["containerInstances"]
-            for instance in instances:
-                yield instance
+        return self._stream_resources("list_container_instances", "containerInstanceArns",
+                                      self._describe_container_instances, DESCRIBE_CONTAINER_INSTANCES_BATCH)
 
     def setup_instance_stats(self):
-        logger.info("Collecting instance resource statistics")
-        instances = list(self._resolve_container_instances())
-
-        # resource statistics
-        cpu = {"total": 0, "free": 0}
-        memory = {"total": 0, "free": 0}
-        # hold resource pairs (cpu, memory)
-        resource_pairs = []
-
-        for instance in instances:
-            free_cpu = [item["integerValue"] for item in instance["remainingResources"] if item["name"] == "CPU"][0]
-            free_mem = [item["integerValue"] for item in instance["remainingResources"] if item["name"] == "MEMORY"][0]
-
-            total_cpu = [item["integerValue"] for item in instance["registeredResources"] if item["name"] == "CPU"][0]
-            total_mem = [item["integerValue"] for item in instance["registeredResources"] if item["name"] == "MEMORY"][0]
-
-            # for some reason, when the cluster is empty
-            cpu["total"] += total_cpu
-            cpu["free"] += free_cpu
-            memory["total"] += total_mem
-            memory["free"] += free_mem
+        """Folds every described container instance into typed arrays as its describe batch arrives.
 
-            resource_pairs.append((free_cpu, free_mem))
-
-        self.cpu = cpu
-        self.memory = memory
-        self.resource_pairs = resource_pairs
-
-        logger.info("Cluster CPU - Total: {}, Free: {}".format(str(cpu["total"]), str(cpu["free"])))
-        logger.info("Cluster Memory - Total: {}, Free: {}".format(str(memory["total"]), str(memory["free"])))
-
-    def _get_service_arns(self):
-        """Generator that yields all of the ARNs for ECS services on self.cluster."""
-        pager = self.ecs.get_paginator("list_services")
-        iterator = pager.paginate(cluster=self.cluster, PaginationConfig={'MaxItems': 10})
-        for page in iterator:
-            arns = page["serviceArns"]
-            for arn in arns:
-                yield arn
+        Only the fields the metrics need are kept, one machine integer per field per instance, so
+        no describe response outlives the loop iteration that reads it. The same pass counts the
+        instances with each value of the group_by attributes by their free (cpu, memory).
+        """
+        logger.info("Collecting instance resource statistics")
+        self.instance_ids = []
+        self.free_cpu = array("l")
+        self.free_memory = array("l")
+        self.registered_cpu = array("l")
+        self.registered_memory = array("l")
+        # running plus pending tasks
+        self.instance_tasks = array("l")
+        # (attribute name, value) -> Counter of (free cpu, free memory) to instances
+        self.group_counts = {}
+        # the group keys of every instance in the same order as instance_ids, instances with the
+        # same keys share one tuple
+        self.instance_groups = []
+        interned = {}
+        # ec2 instance ids of the instances that aren't ACTIVE, such as those draining
+        self.inactive = set()
+
+        for instance in self._resolve_container_instances():
+            free_cpu, free_mem = resource_values(instance["remainingResources"])
+            total_cpu, total_mem = resource_values(instance["registeredResources"])
+            self.instance_ids.append(instance.get("ec2InstanceId"))
+            self.free_cpu.append(free_cpu)
+            self.free_memory.append(free_mem)
+            self.registered_cpu.append(total_cpu)
+            self.registered_memory.append(total_mem)
+            self.instance_tasks.append(instance.get("runningTasksCount", 0) + instance.get("pendingTasksCount", 0))
+            if instance.get("status", "ACTIVE") != "ACTIVE":
+                self.inactive.add(instance.get("ec2InstanceId"))
+            keys = tuple(self._group_keys(instance))
+            self.instance_groups.append(interned.setdefault(keys, keys))
+            for key in keys:
+                if key not in self.group_counts:
+                    self.group_counts[key] = Counter()
+                self.group_counts[key][(free_cpu, free_mem)] += 1
+
+        self.cpu = {"total": sum(self.registered_cpu), "free": sum(self.free_cpu)}
+        self.memory = {"total": sum(self.registered_memory), "free": sum(self.free_memory)}
+
+        logger.info("Cluster CPU - Total: {}, Free: {}".format(str(self.cpu["total"]), str(self.cpu["free"])))
+        logger.info("Cluster Memory - Total: {}, Free: {}".format(str(self.memory["total"]), str(self.memory["free"])))
+
+    @property
+    def resource_pairs(self):
+        """Iterates (free cpu, free memory) of every instance, in the same order as instance_ids"""
+        return zip(self.free_cpu, self.free_memory)
+
+    @property
+    def registered_pairs(self):
+        """Iterates (registered cpu, registered memory) of every instance, in the same order as instance_ids"""
+        return zip(self.registered_cpu, self.registered_memory)
+
+    def _describe_services(self, batch):
+        return self.ecs.describe_services(cluster=self.cluster, services=batch)["services"]
 
     def _resolve_ecs_services(self):
         """Generator that yields all service definitions ECS services on self.cluster."""
-        # http://stackoverflow.com/questions/312443/how-do-you-split-a-list-into-evenly-sized-chunks
-        def chunks(l, n):
-            """Yield successive n-sized chunks from l."""
-            for i in range(0, len(l), n):
-                yield l[i:i + n]
-
-        service_arns = list(self._get_service_arns())
-
-        for batch in chunks(service_arns, 10):
-            services = self.ecs.describe_services(cluster=self.cluster, services=batch)['services']
-            for service in services:
-                yield service
-
-    def _get_service_stats(self, ecs_service):
+        return self._stream_resources("list_services", "serviceArns",
+                                      self._describe_services, DESCRIBE_SERVICES_BATCH)
+
+    def _describe_task_definition(self, arn):
+        """Returns the (cpu, memory) a task of a task definition needs, summed over its containers"""
+        task_def = self.ecs.describe_task_definition(taskDefinition=arn)
+        cpu = memory = 0
+        for container in task_def["taskDefinition"]["containerDefinitions"]:
+            cpu += container["cpu"]
+            memory += int(max(container.get("memory", 0), container.get("memoryReservation", 0)))
+        return cpu, memory
+
+    def _resolve_task_definitions(self, arns):
+        """Returns a dict of task definition ARN to task shape.
+
+        Cached revisions are served from task_definition_cache, misses are fetched concurrently.
+        """
+        resolved = {}
+        misses = []
+        for arn in set(arns):
+            task_shape = task_definition_cache.get(arn)
+            if task_shape is None:
+                misses.append(arn)
+            else:
+                resolved[arn] = task_shape
+
+        self.cache_stats["hits"] += len(resolved)
+        self.cache_stats["misses"] += len(misses)
+
+        if misses:
+            with ThreadPoolExecutor(max_workers=min(TASK_DEFINITION_WORKERS, len(misses))) as pool:
+                for arn, task_shape in zip(misses, pool.map(limiter.bind(self._describe_task_definition), misses)):
+                    task_definition_cache.put(arn, task_shape)
+                    resolved[arn] = task_shape
+
+        logger.info("Task definition cache - Hits: {}, Misses: {}".format(len(resolved) - len(misses), len(misses)))
+        return resolved
+
+    def _get_service_stats(self, ecs_service, task_shape):
         """Returns stats about the service for use in calculating and publishing metrics.
 
         Args:
             ecs_service: the ECS service details as returned from boto3.ecs.describe_service
+            task_shape: the (cpu, memory) one task of the service's task definition needs
 
         Returns:
             A dictionary containing details about the service.
         """
-        task_def = self.ecs.describe_task_definition(taskDefinition=ecs_service["taskDefinition"])
-        container_defs = task_def["taskDefinition"]["containerDefinitions"]
-        svc_stats = {
+        cpu_per_task, memory_per_task = task_shape
+        return {
             "name": ecs_service["serviceName"],
+            "task_definition": ecs_service["taskDefinition"],
             "desired": ecs_service["desiredCount"],
             "running": ecs_service["runningCount"] + ecs_service["pendingCount"],
-            "containers": [
-                {
-                    "name": container["name"],
-                    "cpu": container["cpu"],
-                    "memory": int(max(container.get("memory", 0),
-                                      container.get("memoryReservation", 0))),
-                }
-                for container in container_defs
-            ]
+            "cpu_per_task": cpu_per_task,
+            "cpu_requirement": cpu_per_task * ecs_service["desiredCount"],
+            "memory_per_task": memory_per_task,
+            "memory_requirement": memory_per_task * ecs_service["desiredCount"],
         }
-        svc_stats['cpu_per_task'] = sum((container['cpu'] for container in svc_stats['containers']))
-        svc_stats['cpu_requirement'] = svc_stats['cpu_per_task'] * svc_stats['desired']
-
-        svc_stats['memory_per_task'] = sum((container['memory'] for container in svc_stats['containers']))
-        svc_stats['memory_requirement'] = svc_stats['memory_per_task'] * svc_stats['desired']
-
-        return svc_stats
 
     # need to collect service desired/running counts, as well as resource needs
     def setup_services_stats(self):
         logger.info("Collecting services statistics")
-        ecs_services = list(self._resolve_ecs_services())
+        # services are trimmed as they stream in, describe_services responses carry each
+        # service's deployments and last hundred events
+        ecs_services = [
+            {key: service[key] for key in SERVICE_FIELDS}
+            for service in self._resolve_ecs_services()
+        ]
 
-        self.services= [self._get_service_stats(ecs_service) for ecs_service in ecs_services]
+        task_defs = self._resolve_task_definitions([svc["taskDefinition"] for svc in ecs_services])
+
+        self.services = [self._get_service_stats(ecs_service, task_defs[ecs_service["taskDefinition"]])
+                         for ecs_service in ecs_services]
 
         self.desired_tasks = sum((service['desired'] for service in self.services))
 
@@ -182,8 +375,3 @@ class ClusterStatAggregator(object):
             'cpu' : sum((service['cpu_requirement'] for service in self.services)),
             'memory': sum((service['memory_requirement'] for service in self.services))
         }
-
-        try:
-            self.largest = list(reversed(sorted(self.services, key=lambda svc: svc['memory_per_task'])))[0]
-        except IndexError:
-            self.largest = None
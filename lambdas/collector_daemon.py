@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""Long running capacity collector publishing high resolution AdditionalTasks metrics.
+
+Aggregates the clusters in CLUSTERS (comma separated) every INTERVAL seconds and publishes
+AdditionalTasks at one second storage resolution whenever it moves by CHANGE_THRESHOLD tasks or
+more, or HEARTBEAT_INTERVAL seconds have passed since the last datapoint. The heartbeat follows
+ALARM_PERIOD, so every alarm period gets a datapoint.
+
+Every round drains the ECS state change events from STATE_QUEUE_URL into a ClusterStateStore per
+cluster, kept in memory between rounds, and aggregates from the stores. A full scan only runs when
+a store is due for reconciliation. The stores are saved as they change, for the metric lambda's
+forecast to read. Without STATE_QUEUE_URL every round is a full scan. The process keeps its AWS
+clients and task definition cache between rounds.
+
+    CLUSTERS=prod-default ./lambdas/collector_daemon.py
+"""
+import asyncio
+import logging
+import os
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from cluster_state import STATE_QUEUE_URL, ClusterStateStore, StateStoreAggregator, apply_queued_events
+from custom_metric_collector import cluster_metric_data, put_metric_data
+
+logger = logging.getLogger()
+logging.basicConfig()
+logger.setLevel(logging.INFO)
+
+CLUSTERS = [c for c in os.environ.get("CLUSTERS", "").split(",") if c]
+# seconds between the starts of two collection rounds
+INTERVAL = float(os.environ.get("INTERVAL", 5))
+# smallest change in AdditionalTasks published before the heartbeat is due
+CHANGE_THRESHOLD = int(os.environ.get("CHANGE_THRESHOLD", 1))
+# period in seconds of the alarms watching AdditionalTasks
+ALARM_PERIOD = float(os.environ.get("ALARM_PERIOD", 60))
+# longest gap between datapoints. A round can run up to INTERVAL late, so a datapoint at most
+# every ALARM_PERIOD - INTERVAL seconds lands in every alarm period and a steady value never
+# leaves the alarms without data
+HEARTBEAT_INTERVAL = float(os.environ.get("HEARTBEAT_INTERVAL", max(INTERVAL, ALARM_PERIOD - INTERVAL)))
+# the scale out alarm fires at or below this value, crossing it is always published
+SCALE_OUT_THRESHOLD = int(os.environ.get("SCALE_OUT_THRESHOLD", 1))
+
+
+class CollectorDaemon(object):
+    """Aggregates clusters concurrently on a fixed cadence and publishes the values that changed"""
+
+    def __init__(self, clusters, interval=INTERVAL, threshold=CHANGE_THRESHOLD, heartbeat=HEARTBEAT_INTERVAL,
+                 clock=time.time, queue_url=STATE_QUEUE_URL):
+        self.clusters = clusters
+        self.interval = interval
+        self.threshold = threshold
+        self.heartbeat = heartbeat
+        self.clock = clock
+        self.queue_url = queue_url
+        # cluster name to (value, time) of the last published datapoint
+        self.published = {}
+        # cluster name to its ClusterStateStore, loaded on the first round
+        self.stores = {}
+        self.pool = ThreadPoolExecutor(max_workers=max(1, len(clusters)))
+        self.stopping = False
+
+    def should_publish(self, cluster, value, now):
+        last = self.published.get(cluster)
+        if last is None:
+            return True
+        last_value, last_time = last
+        crossed = (last_value <= SCALE_OUT_THRESHOLD) != (value <= SCALE_OUT_THRESHOLD)
+        return crossed or abs(value - last_value) >= self.threshold or now - last_time >= self.heartbeat
+
+    def store(self, cluster):
+        if cluster not in self.stores:
+            self.stores[cluster] = ClusterStateStore.load(cluster)
+        return self.stores[cluster]
+
+    def apply_events(self):
+        """Applies the queued state change events to the stores"""
+        for cluster in self.clusters:
+            self.store(cluster)
+        apply_queued_events(self.queue_url, stores=self.stores)
+
+    def aggregate(self, cluster):
+        """Aggregates a cluster from its store, returning None if it could not be aggregated"""
+        try:
+            store = self.store(cluster)
+            full_scan = store.needs_reconcile() or not self.queue_url
+            touched = bool(store.touched)
+            aggregated = StateStoreAggregator(store, full_scan=full_scan)
+            if full_scan or touched:
+                store.save()
+        except Exception as e:
+            logger.error("Unable to aggregate cluster {}: {}".format(cluster, e))
+            return None
+        return aggregated
+
+    async def collect(self, loop):
+        """Runs one round, returning the number of datapoints published"""
+        if self.queue_url:
+            try:
+                await loop.run_in_executor(self.pool, self.apply_events)
+            except Exception as e:
+                logger.error("Unable to apply queued state change events: {}".format(e))
+        clusters = await asyncio.gather(*[
+            loop.run_in_executor(self.pool, self.aggregate, name) for name in self.clusters
+        ])
+        now = self.clock()
+        metric_data = []
+        for cluster in clusters:
+            if cluster is None or not self.should_publish(cluster.cluster, cluster.free_spaces, now):
+                continue
+            for datum in cluster_metric_data(cluster):
+                datum["StorageResolution"] = 1
+                metric_data.append(datum)
+            self.published[cluster.cluster] = (cluster.free_spaces, now)
+        if metric_data:
+            await loop.run_in_executor(self.pool, put_metric_data, metric_data)
+        return len(metric_data)
+
+    async def run(self, loop):
+        while not self.stopping:
+            start = self.clock()
+            try:
+                published = await self.collect(loop)
+                logger.info("Collected {} clusters in {:.2f}s, published {} datapoints".format(
+                    len(self.clusters), self.clock() - start, published))
+            except Exception as e:
+                logger.error("Collection round failed: {}".format(e))
+            await asyncio.sleep(max(0, self.interval - (self.clock() - start)))
+
+    def stop(self):
+        logger.info("Stopping after the current round")
+        self.stopping = True
+
+
+def main():
+    if not CLUSTERS:
+        raise SystemExit("CLUSTERS must name at least one cluster")
+    # the aggregation logs every step, which every few seconds would flood the log stream
+    logger.setLevel(os.environ.get("LOG_LEVEL", "WARNING"))
+    daemon = CollectorDaemon(CLUSTERS)
+    loop = asyncio.get_event_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, daemon.stop)
+    try:
+        loop.run_until_complete(daemon.run(loop))
+    finally:
+        loop.close()
+
+
+if __name__ == "__main__":
+    main()
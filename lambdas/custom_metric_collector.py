@@ -1,35 +1,181 @@
 import logging
 import datetime
 import json
+from concurrent.futures import ThreadPoolExecutor
 
-import dateutil
-import boto3
-
+import clients
+from instrumentation import api_stats
+from capacity import UNCONSTRAINED
 from cluster_stats import ClusterStatAggregator
+from cluster_state import STATE_QUEUE_URL, ClusterStateStore, StateStoreAggregator, apply_queued_events
+from embedded_metrics import EmbeddedMetricLogger
+from forecast import record_and_forecast
 
 logger = logging.getLogger()
 logging.basicConfig()
 logger.setLevel(logging.INFO)
 
-cw = boto3.client('cloudwatch')
+NAMESPACE = 'AWS/ECS'
+# PutMetricData accepts at most this many datums per request
+MAX_METRIC_DATA = 1000
+# number of clusters aggregated at the same time
+CLUSTER_WORKERS = 8
+# describe_clusters accepts at most this many clusters per request
+DESCRIBE_CLUSTERS_BATCH = 100
+# dimension names of the built in grouping attributes, custom attributes keep their own name
+GROUP_DIMENSIONS = {
+    "ecs.availability-zone": "AvailabilityZone",
+    "ecs.instance-type": "InstanceType",
+}
 
-def send_cluster_metrics(cluster):
-    r = cw.put_metric_data(
-        Namespace='AWS/ECS',
-        MetricData=[{
+def cluster_metric_data(cluster, forecast=None):
+    """Returns the CloudWatch datums published for an aggregated cluster"""
+    dimensions = [{
+        "Name": "ClusterName",
+        "Value": cluster.cluster
+    }]
+    now = datetime.datetime.now(datetime.timezone.utc)
+    metric_data = [{
+        "MetricName": "AdditionalTasks",
+        "Dimensions": dimensions,
+        "Timestamp": now,
+        "Value": cluster.free_spaces
+    }]
+    if forecast is not None:
+        metric_data.append({
+            "MetricName": "ForecastAdditionalTasks",
+            "Dimensions": dimensions,
+            "Timestamp": now,
+            "Value": forecast
+        })
+    # the same metric per instance group, so alarms can watch a zone or an instance type
+    for group in cluster.groups:
+        # no service constrains the group, there is no count of tasks to publish
+        if group["free_spaces"] == UNCONSTRAINED:
+            continue
+        metric_data.append({
             "MetricName": "AdditionalTasks",
-            "Dimensions": [{
-                "Name": "ClusterName",
-                "Value": cluster.cluster
+            "Dimensions": dimensions + [{
+                "Name": GROUP_DIMENSIONS.get(group["attribute"], group["attribute"]),
+                "Value": group["value"] or "none"
             }],
-            "Timestamp": datetime.datetime.now(dateutil.tz.tzlocal()),
-            "Value": cluster.free_spaces
-        }]
-    )
-    logger.info('Cloudwatch metric sent {}'.format(r))
+            "Timestamp": now,
+            "Value": group["free_spaces"]
+        })
+    return metric_data
+
+def put_metric_data(metric_data):
+    """Publishes datums in as few PutMetricData requests as the API allows"""
+    for i in range(0, len(metric_data), MAX_METRIC_DATA):
+        r = clients.get('cloudwatch').put_metric_data(
+            Namespace=NAMESPACE,
+            MetricData=metric_data[i:i + MAX_METRIC_DATA]
+        )
+        logger.info('Cloudwatch metrics sent {}'.format(r))
+
+def send_cluster_metrics(cluster):
+    put_metric_data(cluster_metric_data(cluster))
+
+def record_state_change(event):
+    """Applies an ECS state change event to the saved state of its cluster"""
+    cluster = event["detail"]["clusterArn"].split("/")[-1]
+    store = ClusterStateStore.load(cluster)
+    if store.apply_event(event):
+        store.save()
+
+def clusters_with_tags(tags):
+    """Returns the names of every cluster in the account carrying all of the given tags"""
+    ecs = clients.get('ecs')
+    arns = []
+    for page in ecs.get_paginator("list_clusters").paginate():
+        arns.extend(page["clusterArns"])
+
+    names = []
+    for i in range(0, len(arns), DESCRIBE_CLUSTERS_BATCH):
+        clusters = ecs.describe_clusters(clusters=arns[i:i + DESCRIBE_CLUSTERS_BATCH], include=["TAGS"])["clusters"]
+        for cluster in clusters:
+            cluster_tags = {tag["key"]: tag["value"] for tag in cluster.get("tags", [])}
+            if all(cluster_tags.get(key) == value for key, value in tags.items()):
+                names.append(cluster["clusterName"])
+    return names
+
+def target_clusters(event):
+    """Returns the cluster names requested by the event's Cluster, Clusters or ClusterTags keys"""
+    clusters = list(event.get("Clusters", []))
+    if event.get("Cluster"):
+        clusters.append(event["Cluster"])
+    if event.get("ClusterTags"):
+        clusters.extend(clusters_with_tags(event["ClusterTags"]))
+    # keep the requested order, but only aggregate each cluster once
+    return list(dict.fromkeys(clusters))
+
+def aggregate(cluster_name, incremental=False, save=True):
+    """Aggregates a cluster, returning None if it could not be aggregated.
+    Incremental aggregations read the saved state of the cluster, and only write it back with save."""
+    try:
+        if incremental:
+            store = ClusterStateStore.load(cluster_name)
+            cluster = StateStoreAggregator(store)
+            if save:
+                store.save()
+        else:
+            cluster = ClusterStatAggregator(cluster_name)
+    except Exception as e:
+        logger.error('Unable to aggregate cluster {}: {}'.format(cluster_name, e))
+        return None
+    logger.info('\n{}'.format(cluster))
+    return cluster
+
+def forecast(cluster, horizon):
+    """Records a cluster in its history and forecasts it, returning None if that failed"""
+    if cluster is None:
+        return None
+    try:
+        value = record_and_forecast(cluster, horizon)
+    except Exception as e:
+        logger.error('Unable to forecast cluster {}: {}'.format(cluster.cluster, e))
+        return None
+    logger.info('Forecast AdditionalTasks for {} in {} minutes: {}'.format(cluster.cluster, horizon, value))
+    return value
 
 def main(event, context):
     logger.info(json.dumps(event))
-    cluster = ClusterStatAggregator(event["Cluster"])
-    logger.info('\n{}'.format(cluster))
-    send_cluster_metrics(cluster)
+    api_stats.reset()
+    # ECS state change events keep the incremental state up to date, the cron publishes the metric
+    if "detail-type" in event:
+        record_state_change(event)
+        return
+    # with ForecastOnly the collector daemon drains the queue and keeps the saved state, which the
+    # lambda then only reads
+    owns_state = not event.get("ForecastOnly")
+    if event.get("Incremental") and STATE_QUEUE_URL and owns_state:
+        try:
+            apply_queued_events()
+        except Exception as e:
+            logger.error('Unable to apply queued state change events: {}'.format(e))
+    cluster_names = target_clusters(event)
+    logger.info('Collecting metrics for {} clusters'.format(len(cluster_names)))
+
+    with ThreadPoolExecutor(max_workers=max(1, min(CLUSTER_WORKERS, len(cluster_names)))) as pool:
+        clusters = list(pool.map(
+            lambda name: aggregate(name, event.get("Incremental", False), owns_state), cluster_names))
+        forecasts = [None] * len(clusters)
+        if event.get("ForecastHorizon"):
+            forecasts = list(pool.map(lambda cluster: forecast(cluster, event["ForecastHorizon"]), clusters))
+
+    metric_data = []
+    # per-service and per-instance metrics go out through the log stream instead of the API
+    embedded = EmbeddedMetricLogger() if event.get("EmbeddedMetrics") else None
+    for cluster, cluster_forecast in zip(clusters, forecasts):
+        if cluster:
+            cluster_data = cluster_metric_data(cluster, cluster_forecast)
+            if event.get("ForecastOnly"):
+                # the collector daemon publishes AdditionalTasks, a second publisher would interleave with it
+                cluster_data = [datum for datum in cluster_data if datum["MetricName"] != "AdditionalTasks"]
+            metric_data.extend(cluster_data)
+            if embedded:
+                embedded.put_cluster(cluster)
+    put_metric_data(metric_data)
+    if embedded:
+        embedded.flush()
+    logger.info('AWS API usage: {}'.format(json.dumps(api_stats.summary(), sort_keys=True)))
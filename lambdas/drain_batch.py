@@ -0,0 +1,340 @@
+import logging
+import datetime
+import json
+
+import capacity_check
+import clients
+import drain_events
+from ratelimit import HIGH, LOW, limiter
+from lifecycle_event import MIN_CHECK_INTERVAL, LifecycleEvent, index_instances, next_check_interval
+
+logger = logging.getLogger()
+logging.basicConfig()
+logger.setLevel(logging.INFO)
+
+# update_container_instances_state accepts at most this many instances per request
+DRAIN_BATCH_SIZE = 10
+# describe_container_instances accepts at most this many instances per request
+DESCRIBE_BATCH_SIZE = 100
+# shortest wait between checks while task events complete the drains. It stays below the
+# lifecycle hook's 60 second heartbeat timeout, since the checks also send the heartbeats
+FALLBACK_CHECK_INTERVAL = 30
+
+# draining instances shared with the drain_events lambda, None when drains are only polled
+registry = drain_events.drain_registry()
+
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def chunks(l, n):
+    """Yield successive n-sized chunks from l."""
+    for i in range(0, len(l), n):
+        yield l[i:i + n]
+
+
+def sns_event(message):
+    """Wraps an SNS message body in the event shape LifecycleEvent expects"""
+    return {"Records": [{"EventSource": "aws:sns", "Sns": {"Message": message}}]}
+
+
+def lifecycle_messages(event):
+    """Returns (SQS message id, autoscaling lifecycle message) for the lifecycle notifications of an SQS batch"""
+    messages = []
+    for record in event["Records"]:
+        message = json.loads(record["body"])["Message"]
+        if "LifecycleActionToken" not in json.loads(message):
+            # autoscaling sends a test notification when the hook is created
+            logger.info("Skipping non lifecycle message {}".format(message))
+            continue
+        messages.append((record["messageId"], message))
+    return messages
+
+
+def group_by_cluster(messages):
+    """Returns a dict of ECS cluster name to (SQS message ids, SNS events) of the lifecycle messages for that cluster"""
+    clusters = {}
+    for message_id, message in messages:
+        metadata = json.loads(json.loads(message)["NotificationMetadata"])
+        message_ids, events = clusters.setdefault(metadata["ecs_cluster"], ([], []))
+        message_ids.append(message_id)
+        events.append(sns_event(message))
+    return clusters
+
+
+def start_events(cluster, events):
+    """Returns LifecycleEvents for a group of SNS events, resolving all their container instances at once"""
+    index_instances(cluster, [json.loads(e["Records"][0]["Sns"]["Message"])["EC2InstanceId"] for e in events])
+    return [LifecycleEvent(e) for e in events]
+
+
+class DrainBatch(object):
+    """Drains every terminating instance of one cluster together.
+
+    The batch is carried through the state machine as {"batch": [lifecycle events], "state": ...}.
+    Instances are set to DRAINING with one call per ten instances, their remaining tasks are
+    checked with one describe call per hundred instances, and each lifecycle action is completed
+    as soon as its own instance is empty or past its endtime.
+
+    With a drain registry, the instances are registered with their tasks' ARNs once they are
+    DRAINING, and the drain_events lambda completes each one as soon as its last task stops.
+    The checks then only pick up those completions and catch instances whose events went missing.
+
+    Before the drain the rest of the cluster is checked for room for the members' tasks, and
+    during it the services of those tasks are watched for tasks ECS can't place. Either way the
+    drain pauses with the members ACTIVE and the autoscaling group is asked for more instances,
+    until there is room or the batch has waited CAPACITY_WAIT seconds.
+    """
+
+    def __init__(self, event, registry=None):
+        self.event = event
+        self.registry = registry
+        members = [LifecycleEvent(member) for member in event["batch"]]
+        self.members = [member for member in members if member.ecsinstanceid]
+        # members whose container instance wasn't found. ECS knows of no tasks on them, but the
+        # lookup may have failed, so they are completed at their endtime
+        self.unresolved = [member for member in members if not member.ecsinstanceid]
+        self.cluster = members[0].ecs_cluster if members else None
+        # total number of tasks left on the draining members at the last check
+        self.remaining = None
+
+    @property
+    def ecs(self):
+        return clients.get('ecs')
+
+    def drain(self):
+        self.set_state('DRAINING')
+
+    def remaining_tasks(self):
+        """Returns a dict of container instance ARN to the number of tasks still on it"""
+        remaining = {}
+        for batch in chunks([member.ecsinstanceid for member in self.members], DESCRIBE_BATCH_SIZE):
+            try:
+                instances = self.ecs.describe_container_instances(
+                    cluster=self.cluster,
+                    containerInstances=batch
+                )["containerInstances"]
+            except Exception as e:
+                logger.error(e)
+                continue
+            for instance in instances:
+                remaining[instance["containerInstanceArn"]] = \
+                    instance["runningTasksCount"] + instance["pendingTasksCount"]
+        return remaining
+
+    def set_state(self, status):
+        for batch in chunks([member.ecsinstanceid for member in self.members], DRAIN_BATCH_SIZE):
+            try:
+                self.ecs.update_container_instances_state(
+                    cluster=self.cluster,
+                    containerInstances=batch,
+                    status=status
+                )
+                logger.info("Set instances {} to {}".format(batch, status))
+            except Exception as e:
+                logger.error(e)
+
+    def capacity_waived(self, now):
+        """Returns whether the drain goes ahead without looking for room, the check being off or
+        the batch having waited CAPACITY_WAIT"""
+        deadline = self.event.get("capacity_deadline")
+        return not capacity_check.CAPACITY_CHECK or bool(deadline and now > datetime.datetime.strptime(deadline, TIME_FORMAT))
+
+    def has_room(self, now):
+        """Returns whether the rest of the cluster can take the members' tasks. Asks for more
+        instances the first time it can't. Only checked before the members are DRAINING, since
+        once their tasks move they would be counted on both their old and new instances."""
+        if self.capacity_waived(now):
+            return True
+        try:
+            # a full aggregation of the cluster, it leaves the reserve of each bucket to the drain calls
+            with limiter.lane(LOW):
+                result = capacity_check.displaced_tasks(
+                    self.cluster, {member.ec2instanceid: member.ecsinstanceid for member in self.members})
+        except Exception as e:
+            # a failed check never holds up a scale-in
+            logger.error("Unable to check the capacity of {}, draining anyway: {}".format(self.cluster, e))
+            return True
+        self.event["capacity_check"] = result
+        if not result["unplaced_tasks"]:
+            return True
+        logger.info("{} tasks of the draining instances don't fit on the rest of {}".format(
+            result["unplaced_tasks"], self.cluster))
+        self.scale_out(result["instances_needed"] or 1)
+        return False
+
+    def stuck(self, now):
+        """Returns whether ECS has been unable to place a task of the members' services since the
+        drain started. Looked up at most every CAPACITY_CHECK_INTERVAL while the drain is under way."""
+        services = self.event.get("capacity_check", {}).get("services")
+        started = self.event.get("drain_started_at")
+        if not services or not started or self.capacity_waived(now):
+            return False
+        checked = self.event.get("capacity_checked_at")
+        if checked and (now - datetime.datetime.strptime(checked, TIME_FORMAT)).total_seconds() < capacity_check.CAPACITY_CHECK_INTERVAL:
+            return False
+        self.event["capacity_checked_at"] = now.strftime(TIME_FORMAT)
+        try:
+            stuck = capacity_check.unplaceable_services(
+                self.cluster, services, datetime.datetime.strptime(started, TIME_FORMAT).replace(tzinfo=datetime.timezone.utc))
+        except Exception as e:
+            logger.error("Unable to check the services of {}, draining anyway: {}".format(self.cluster, e))
+            return False
+        if not stuck:
+            return False
+        logger.info("ECS can't place tasks of {} on the rest of {}".format(", ".join(stuck), self.cluster))
+        self.scale_out(1)
+        return True
+
+    def scale_out(self, instances):
+        """Asks the members' autoscaling group for more instances, once per batch"""
+        if not self.event.get("scale_out_requested"):
+            capacity_check.request_scale_out(self.members[0].asgname, instances)
+            self.event["scale_out_requested"] = True
+
+    def extend_endtimes(self, now):
+        """Gives every member its full stop timeout again, counted from now"""
+        for member in self.members:
+            member.endtime = now + datetime.timedelta(seconds=member.ecs_timeout) + datetime.timedelta(minutes=1)
+            member.event["endtime"] = member.endtime.strftime(TIME_FORMAT)
+
+    def start(self, now):
+        """Sets the members to DRAINING, the first time or after a pause"""
+        if self.event.get("capacity_paused"):
+            self.extend_endtimes(now)
+        self.drain()
+        # in UTC, to compare with the times of service events
+        self.event["drain_started_at"] = now.astimezone(datetime.timezone.utc).strftime(TIME_FORMAT)
+        if self.registry:
+            self.register()
+        for member in self.members:
+            member.send_heartbeat()
+            member.set_type("state_machine:retry")
+        self.event["capacity_paused"] = False
+
+    def pause(self, now):
+        """Holds the drain until there is room, with the members back to ACTIVE if they were draining"""
+        if self.event.get("state") != "state_machine:init" and not self.event.get("capacity_paused"):
+            self.set_state("ACTIVE")
+            if self.registry:
+                # an ACTIVE instance can take new tasks, so its task count no longer holds
+                for member in self.members:
+                    self.registry.remove(self.cluster, member.ecsinstanceid)
+        self.extend_endtimes(now)
+        for member in self.members:
+            member.send_heartbeat()
+            member.set_type("state_machine:retry")
+        self.event["capacity_paused"] = True
+
+    def register(self):
+        """Registers the members with the tasks left on them, for task events to count down"""
+        for member in self.members:
+            try:
+                tasks = drain_events.tasks_on(self.cluster, member.ecsinstanceid)
+            except Exception as e:
+                # an unregistered member still finishes at the next check
+                logger.error("Unable to list the tasks on {}: {}".format(member.ec2instanceid, e))
+                continue
+            drain_events.register(self.registry, member, tasks)
+
+    def completed_by_events(self):
+        """Drops the members whose drain task events already completed, returning them"""
+        done = self.registry.done(self.cluster)
+        completed = [member for member in self.members if drain_events.instance_id(member.ecsinstanceid) in done]
+        for member in completed:
+            logger.info("Task events completed the drain of {}".format(member.ec2instanceid))
+            member.set_type("state_machine:end")
+            self.registry.remove(self.cluster, member.ecsinstanceid)
+        self.members = [member for member in self.members if member not in completed]
+        return completed
+
+    def check_unresolved(self, now):
+        """Completes the lifecycle actions of the unresolved members past their endtime and sends
+        the others a heartbeat"""
+        waiting = []
+        for member in self.unresolved:
+            if member.endtime and now > member.endtime:
+                logger.info('No container instance found for {}, completing it at its endtime of {}'.format(
+                    member.ec2instanceid, member.event["endtime"]))
+                member.set_type("state_machine:end")
+                member.complete_asg_lifecycle()
+            else:
+                member.send_heartbeat()
+                member.set_type("state_machine:retry")
+                waiting.append(member)
+        self.unresolved = waiting
+
+    def finish(self, member):
+        member.set_type("state_machine:end")
+        member.complete_asg_lifecycle()
+        if self.registry:
+            self.registry.remove(self.cluster, member.ecsinstanceid)
+
+    def check(self, now=None):
+        """Completes the lifecycle actions of finished instances. Returns the members still draining."""
+        now = now or datetime.datetime.now()
+        remaining = self.remaining_tasks()
+        draining = []
+        self.remaining = 0
+        for member in self.members:
+            tasks = remaining.get(member.ecsinstanceid)
+            if tasks == 0:
+                logger.info("No tasks running on {}".format(member.ec2instanceid))
+                self.finish(member)
+            elif member.endtime and now > member.endtime:
+                logger.info('Instance {} passed its endtime of {} and is being shut down'.format(
+                    member.ec2instanceid, member.event["endtime"]))
+                self.finish(member)
+            else:
+                logger.info("{} tasks still running on {} - waiting....".format(tasks, member.ec2instanceid))
+                member.send_heartbeat()
+                draining.append(member)
+                self.remaining += tasks or 0
+        self.members = draining
+        return draining
+
+    def endtime(self):
+        """Returns the earliest endtime of the members still draining"""
+        endtimes = [member.endtime for member in self.members + self.unresolved if member.endtime]
+        return min(endtimes) if endtimes else None
+
+    def to_event(self, state):
+        self.event["batch"] = [member.event for member in self.members + self.unresolved]
+        self.event["state"] = state
+        if state == "state_machine:retry":
+            floor = FALLBACK_CHECK_INTERVAL if self.registry else MIN_CHECK_INTERVAL
+            if self.event.get("capacity_paused"):
+                floor = capacity_check.CAPACITY_CHECK_INTERVAL
+            next_check_interval(self.event, self.remaining, self.endtime(), floor=floor)
+        return self.event
+
+
+def handle(event):
+    """State machine step for a batch of lifecycle events"""
+    # every call of a drain, describes included, goes ahead of metric collection
+    with limiter.lane(HIGH):
+        return _handle(event)
+
+
+def _handle(event, now=None):
+    now = now or datetime.datetime.now()
+    batch = DrainBatch(event, registry)
+    batch.check_unresolved(now)
+    if not batch.members:
+        return batch.to_event("state_machine:retry" if batch.unresolved else "state_machine:end")
+    if event.get("state") == "state_machine:init":
+        event["capacity_deadline"] = (now + datetime.timedelta(seconds=capacity_check.CAPACITY_WAIT)).strftime(TIME_FORMAT)
+    if event.get("state") == "state_machine:init" or event.get("capacity_paused"):
+        if batch.has_room(now):
+            batch.start(now)
+        else:
+            batch.pause(now)
+        return batch.to_event("state_machine:retry")
+    # members task events completed are terminating, a pause must not set them back to ACTIVE
+    if batch.registry:
+        batch.completed_by_events()
+    if batch.members and batch.stuck(now):
+        batch.pause(now)
+        return batch.to_event("state_machine:retry")
+    if batch.check(now) or batch.unresolved:
+        return batch.to_event("state_machine:retry")
+    return batch.to_event("state_machine:end")
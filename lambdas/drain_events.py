@@ -0,0 +1,230 @@
+import logging
+import json
+import os
+import uuid
+
+import clients
+from instrumentation import api_stats
+from lifecycle_event import LifecycleEvent
+from ratelimit import HIGH, limiter
+
+logger = logging.getLogger()
+logging.basicConfig()
+logger.setLevel(logging.INFO)
+
+# where draining instances are registered. The lifecycle lambda registers them and this lambda
+# counts down their tasks, so without a bucket to share drains finish by polling alone
+DRAIN_BUCKET = os.environ.get("DRAIN_BUCKET")
+DRAIN_PREFIX = os.environ.get("DRAIN_PREFIX", "ecs/draining/")
+STATE_DIR = os.environ.get("STATE_DIR", "/tmp")
+
+TASK_EVENT = "ECS Task State Change"
+
+
+def instance_id(container_instance_arn):
+    return container_instance_arn.split("/")[-1]
+
+
+class FileDrainRegistry(object):
+    """Draining instances as files in a directory, one record and one done marker per instance"""
+
+    def __init__(self, directory=STATE_DIR):
+        self.directory = directory
+
+    def path(self, cluster, arn, suffix):
+        return os.path.join(self.directory, "ecs-draining-{}-{}.{}".format(cluster, instance_id(arn), suffix))
+
+    def load(self, cluster, arn):
+        try:
+            with open(self.path(cluster, arn, "json")) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def save(self, record):
+        path = self.path(record["cluster"], record["containerInstanceArn"], "json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(record, f)
+        os.rename(path + ".tmp", path)
+
+    def mark_done(self, cluster, arn):
+        open(self.path(cluster, arn, "done"), "w").close()
+
+    def done(self, cluster):
+        """Returns the ids of the container instances of cluster whose drain finished"""
+        prefix, suffix = "ecs-draining-{}-".format(cluster), ".done"
+        return {
+            name[len(prefix):-len(suffix)] for name in os.listdir(self.directory)
+            if name.startswith(prefix) and name.endswith(suffix)
+        }
+
+    def remove(self, cluster, arn):
+        for suffix in ("json", "done"):
+            try:
+                os.remove(self.path(cluster, arn, suffix))
+            except OSError:
+                pass
+
+
+class S3DrainRegistry(object):
+    """Draining instances as S3 objects under a prefix, one record and one done marker per instance"""
+
+    def __init__(self, bucket, prefix=DRAIN_PREFIX):
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def key(self, cluster, arn, suffix):
+        return "{}{}/{}.{}".format(self.prefix, cluster, instance_id(arn), suffix)
+
+    def load(self, cluster, arn):
+        try:
+            body = clients.get('s3').get_object(Bucket=self.bucket, Key=self.key(cluster, arn, "json"))["Body"].read()
+        except Exception:
+            return None
+        return json.loads(body.decode())
+
+    def save(self, record):
+        clients.get('s3').put_object(
+            Bucket=self.bucket,
+            Key=self.key(record["cluster"], record["containerInstanceArn"], "json"),
+            Body=json.dumps(record).encode()
+        )
+
+    def mark_done(self, cluster, arn):
+        clients.get('s3').put_object(Bucket=self.bucket, Key=self.key(cluster, arn, "done"), Body=b"")
+
+    def done(self, cluster):
+        """Returns the ids of the container instances of cluster whose drain finished"""
+        prefix = "{}{}/".format(self.prefix, cluster)
+        done = set()
+        for page in clients.get('s3').get_paginator("list_objects_v2").paginate(Bucket=self.bucket, Prefix=prefix):
+            for item in page.get("Contents", []):
+                if item["Key"].endswith(".done"):
+                    done.add(item["Key"][len(prefix):-len(".done")])
+        return done
+
+    def remove(self, cluster, arn):
+        clients.get('s3').delete_objects(Bucket=self.bucket, Delete={"Objects": [
+            {"Key": self.key(cluster, arn, suffix)} for suffix in ("json", "done")
+        ]})
+
+
+def drain_registry():
+    if DRAIN_BUCKET:
+        return S3DrainRegistry(DRAIN_BUCKET)
+    return None
+
+
+def tasks_on(cluster, container_instance_arn):
+    """Returns the ARNs of the tasks not yet stopped on a container instance. A draining instance's
+    tasks are listed under both desired statuses, and those already STOPPED are left out."""
+    ecs = clients.get('ecs')
+    paginator = ecs.get_paginator('list_tasks')
+    tasks = set()
+    stopping = []
+    for status in ("RUNNING", "STOPPED"):
+        for page in paginator.paginate(cluster=cluster, containerInstance=container_instance_arn, desiredStatus=status):
+            if status == "RUNNING":
+                tasks.update(page["taskArns"])
+            else:
+                stopping.extend(page["taskArns"])
+    # describe_tasks accepts at most 100 tasks per request
+    for i in range(0, len(stopping), 100):
+        for task in ecs.describe_tasks(cluster=cluster, tasks=stopping[i:i + 100])["tasks"]:
+            if task["lastStatus"] != "STOPPED":
+                tasks.add(task["taskArn"])
+    return sorted(tasks)
+
+
+def register(registry, member, tasks):
+    """Records a draining lifecycle event with the ARNs of the tasks still on its instance"""
+    registry.save({
+        "cluster": member.ecs_cluster,
+        "containerInstanceArn": member.ecsinstanceid,
+        "event": member.event,
+        # tells this registration from a later one of the same instance
+        "registration": uuid.uuid4().hex,
+        # a task is removed when its stopped event arrives, events for any other task are ignored
+        "tasks": tasks,
+        "completed": False
+    })
+
+
+def current(registry, record):
+    """Returns whether record is still the registry's registration of its instance"""
+    latest = registry.load(record["cluster"], record["containerInstanceArn"])
+    return latest is not None and not latest["completed"] and latest.get("registration") == record.get("registration")
+
+
+def draining(cluster, container_instance_arn):
+    """Returns whether ECS still has a container instance DRAINING, False if that can't be told"""
+    try:
+        instances = clients.get('ecs').describe_container_instances(
+            cluster=cluster, containerInstances=[container_instance_arn])["containerInstances"]
+    except Exception as e:
+        logger.error("Unable to describe {}: {}".format(container_instance_arn, e))
+        return False
+    return bool(instances) and instances[0]["status"] == "DRAINING"
+
+
+def apply_task_event(registry, event):
+    """Removes a stopped task from its instance's record. Completes the instance's lifecycle
+    action when no tasks are left. Returns True if it did."""
+    detail = event.get("detail", {})
+    if event.get("detail-type") != TASK_EVENT or detail.get("lastStatus") != "STOPPED":
+        return False
+    arn = detail.get("containerInstanceArn")
+    if not arn:
+        return False
+    cluster = detail["clusterArn"].split("/")[-1]
+    record = registry.load(cluster, arn)
+    # a repeated event, or one for a task that wasn't on the instance when it was registered
+    if record is None or record["completed"] or detail["taskArn"] not in record["tasks"]:
+        return False
+
+    record["tasks"].remove(detail["taskArn"])
+    # the lifecycle lambda removes the record when it pauses a drain and writes a new one when it
+    # resumes. Reading it again right before writing keeps an old registration from coming back
+    if not current(registry, record):
+        logger.info("The drain of {} was paused or registered again, ignoring the event".format(arn))
+        return False
+    if record["tasks"]:
+        logger.info("{} tasks still running on {}".format(len(record["tasks"]), arn))
+        registry.save(record)
+        return False
+
+    if not draining(cluster, arn):
+        # left to the state machine, which completes it once the instance drains again
+        logger.info("{} is no longer DRAINING, not completing it".format(arn))
+        return False
+    member = LifecycleEvent(record["event"])
+    logger.info("Last task stopped on {}, completing its lifecycle action".format(member.ec2instanceid))
+    member.complete_asg_lifecycle()
+    record["completed"] = True
+    registry.save(record)
+    registry.mark_done(cluster, arn)
+    return True
+
+
+def apply_event_file(registry, path):
+    """Applies every event in a file holding either a JSON list or one JSON event per line"""
+    with open(path) as f:
+        body = f.read().strip()
+    if body.startswith("["):
+        events = json.loads(body)
+    else:
+        events = [json.loads(line) for line in body.splitlines() if line.strip()]
+    return sum(1 for event in events if apply_task_event(registry, event))
+
+
+def lambda_handler(event, context):
+    logger.info(json.dumps(event))
+    api_stats.reset()
+    registry = drain_registry()
+    if registry is None:
+        logger.error("DRAIN_BUCKET is not set, ignoring task event")
+        return
+    # completing a lifecycle action is part of a drain and goes ahead of metric collection
+    with limiter.lane(HIGH):
+        apply_task_event(registry, event)
+    logger.info('AWS API usage: {}'.format(json.dumps(api_stats.summary(), sort_keys=True)))
@@ -0,0 +1,62 @@
+import json
+import sys
+import time
+
+# CloudWatch rejects embedded metrics in the AWS/ namespaces
+NAMESPACE = 'ECS/ClusterCapacity'
+
+
+class EmbeddedMetricLogger(object):
+    """Buffers metrics and writes them as CloudWatch Embedded Metric Format log lines.
+
+    CloudWatch extracts the metrics from the lambda's log stream, so publishing them costs no
+    API calls. Records are buffered until flush, which should be called once per invocation.
+    """
+
+    def __init__(self, namespace=NAMESPACE, stream=None):
+        self.namespace = namespace
+        self.stream = stream or sys.stdout
+        self.records = []
+
+    def put(self, dimensions, metrics, units=None):
+        """Buffers one record.
+
+        Args:
+            dimensions: dict of dimension name to value
+            metrics: dict of metric name to value
+            units: dict of metric name to CloudWatch unit, metrics not listed are a Count
+        """
+        units = units or {}
+        record = {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": self.namespace,
+                    "Dimensions": [sorted(dimensions.keys())],
+                    "Metrics": [{"Name": name, "Unit": units.get(name, "Count")} for name in sorted(metrics.keys())]
+                }]
+            }
+        }
+        record.update(dimensions)
+        record.update(metrics)
+        self.records.append(record)
+
+    def put_cluster(self, cluster):
+        """Buffers the per-service and per-instance capacity of an aggregated cluster"""
+        for service in cluster.services:
+            self.put({"ClusterName": cluster.cluster, "ServiceName": service["name"]}, {
+                "DesiredTasks": service["desired"],
+                "RunningTasks": service["running"],
+                "SchedulableTasks": service["schedulable"]
+            })
+        for instance_id, (free_cpu, free_mem) in zip(cluster.instance_ids, cluster.resource_pairs):
+            self.put({"ClusterName": cluster.cluster, "InstanceId": instance_id}, {
+                "FreeCPU": free_cpu,
+                "FreeMemory": free_mem
+            }, units={"FreeCPU": "None", "FreeMemory": "Megabytes"})
+
+    def flush(self):
+        for record in self.records:
+            self.stream.write(json.dumps(record) + "\n")
+        self.stream.flush()
+        self.records = []
@@ -0,0 +1,174 @@
+import logging
+import json
+import os
+import time
+
+import clients
+from capacity import UNCONSTRAINED
+
+logger = logging.getLogger()
+logging.basicConfig()
+logger.setLevel(logging.INFO)
+
+# samples kept per cluster, three hours of one minute cron runs
+HISTORY_SIZE = 180
+# where histories are persisted between invocations. HISTORY_BUCKET keeps them in S3 so they
+# survive cold starts, without it they are files in STATE_DIR
+HISTORY_BUCKET = os.environ.get("HISTORY_BUCKET")
+HISTORY_PREFIX = os.environ.get("HISTORY_PREFIX", "ecs/history/")
+STATE_DIR = os.environ.get("STATE_DIR", "/tmp")
+
+# minutes ahead the forecast looks by default, roughly an instance boot plus ECS agent start
+FORECAST_HORIZON = int(os.environ.get("FORECAST_HORIZON", 10))
+# Holt smoothing factors for the level and the trend
+ALPHA = 0.5
+BETA = 0.3
+# fewer samples than this and the forecast is the current value
+MIN_SAMPLES = 5
+# a gap longer than this many seconds between samples starts the history over
+MAX_SAMPLE_GAP = 600
+
+
+class History(object):
+    """Fixed size ring buffer of (time, free task slots, desired tasks) samples for one cluster"""
+
+    FIELDS = ["times", "free", "desired"]
+
+    def __init__(self, cluster, size=HISTORY_SIZE, times=None, free=None, desired=None, head=0, count=0):
+        self.cluster = cluster
+        self.size = size
+        self.times = times or [0] * size
+        self.free = free or [0] * size
+        self.desired = desired or [0] * size
+        # index the next sample is written to
+        self.head = head
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def append(self, when, free, desired):
+        if self.count and when - self.series("times")[-1] > MAX_SAMPLE_GAP:
+            logger.info("History of {} is stale, starting over".format(self.cluster))
+            self.head = self.count = 0
+        self.times[self.head] = int(when)
+        self.free[self.head] = free
+        self.desired[self.head] = desired
+        self.head = (self.head + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def series(self, field):
+        """Returns the samples of a field, oldest first"""
+        values = getattr(self, field)
+        start = (self.head - self.count) % self.size
+        if start + self.count <= self.size:
+            return values[start:start + self.count]
+        return values[start:] + values[:self.head]
+
+    def to_dict(self):
+        # stored oldest first, so a history read back with another size keeps its newest samples
+        state = {field: self.series(field) for field in self.FIELDS}
+        state["cluster"] = self.cluster
+        return state
+
+    @classmethod
+    def from_dict(cls, cluster, state, size=HISTORY_SIZE):
+        history = cls(cluster, size)
+        for sample in list(zip(*(state[field] for field in cls.FIELDS)))[-size:]:
+            history.append(*sample)
+        return history
+
+
+class FileHistoryBackend(object):
+    def __init__(self, directory=STATE_DIR):
+        self.directory = directory
+
+    def path(self, cluster):
+        return os.path.join(self.directory, "ecs-history-{}.json".format(cluster))
+
+    def load(self, cluster):
+        try:
+            with open(self.path(cluster)) as f:
+                return History.from_dict(cluster, json.load(f))
+        except (IOError, ValueError):
+            logger.info("No saved history for cluster {}".format(cluster))
+            return History(cluster)
+
+    def save(self, history):
+        path = self.path(history.cluster)
+        with open(path + ".tmp", "w") as f:
+            json.dump(history.to_dict(), f)
+        os.rename(path + ".tmp", path)
+
+
+class S3HistoryBackend(object):
+    def __init__(self, bucket, prefix=HISTORY_PREFIX):
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def key(self, cluster):
+        return "{}{}.json".format(self.prefix, cluster)
+
+    def load(self, cluster):
+        s3 = clients.get('s3')
+        try:
+            body = s3.get_object(Bucket=self.bucket, Key=self.key(cluster))["Body"].read()
+            return History.from_dict(cluster, json.loads(body.decode()))
+        except Exception as e:
+            logger.info("No saved history for cluster {}: {}".format(cluster, e))
+            return History(cluster)
+
+    def save(self, history):
+        clients.get('s3').put_object(
+            Bucket=self.bucket,
+            Key=self.key(history.cluster),
+            Body=json.dumps(history.to_dict()).encode()
+        )
+
+
+def history_backend():
+    if HISTORY_BUCKET:
+        return S3HistoryBackend(HISTORY_BUCKET)
+    return FileHistoryBackend()
+
+
+def holt(values, steps, alpha=ALPHA, beta=BETA):
+    """Holt's linear exponential smoothing. Returns the value forecast steps samples past the last."""
+    level, trend = values[0], 0.0
+    if len(values) > 1:
+        trend = values[1] - values[0]
+    for value in values[1:]:
+        previous = level
+        level = alpha * value + (1 - alpha) * (level + trend)
+        trend = beta * (level - previous) + (1 - beta) * trend
+    return level + steps * trend
+
+
+def forecast_additional_tasks(history, horizon=FORECAST_HORIZON):
+    """Forecasts the AdditionalTasks metric horizon minutes ahead.
+
+    Free task slots are smoothed with Holt's method and projected along their trend. Growth in
+    desired tasks is projected the same way and taken out of the current free slots, since
+    every new task takes at most one slot of the most constrained service. The lower of the two
+    is the forecast, so a ramp shows up in either signal. Like AdditionalTasks it doesn't go
+    below zero, which keeps it inside the step adjustments of the scale-out policy.
+    """
+    free, desired, times = history.series("free"), history.series("desired"), history.series("times")
+    if not free:
+        return None
+    if len(free) < MIN_SAMPLES or UNCONSTRAINED in free:
+        return free[-1]
+    # the cron runs every minute but invocations drift or get skipped
+    interval = float(times[-1] - times[0]) / (len(times) - 1) or 60
+    steps = horizon * 60 / interval
+    desired_growth = max(0, holt(desired, steps) - desired[-1])
+    return max(0, round(min(holt(free, steps), free[-1] - desired_growth), 2))
+
+
+def record_and_forecast(cluster, horizon=FORECAST_HORIZON, backend=None, now=None):
+    """Adds an aggregated cluster to its history and returns the forecast AdditionalTasks"""
+    backend = backend or history_backend()
+    history = backend.load(cluster.cluster)
+    history.append(now or time.time(), cluster.free_spaces, cluster.desired_tasks)
+    backend.save(history)
+    return forecast_additional_tasks(history, horizon)
@@ -0,0 +1,135 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger()
+logging.basicConfig()
+logger.setLevel(logging.INFO)
+
+# upper bounds of the latency histogram buckets, in milliseconds
+LATENCY_BUCKETS_MS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500]
+THROTTLE_CODES = [
+    "Throttling",
+    "ThrottlingException",
+    "ThrottledException",
+    "RequestThrottledException",
+    "TooManyRequestsException",
+    "RequestLimitExceeded",
+    "Rate exceeded",
+]
+
+
+def _bucket(ms):
+    for bound in LATENCY_BUCKETS_MS:
+        if ms <= bound:
+            return "<={}".format(bound)
+    return ">{}".format(LATENCY_BUCKETS_MS[-1])
+
+
+def _operation(event_name):
+    """Returns "service.Operation" for a botocore event name such as before-call.ecs.ListTasks"""
+    return event_name.split(".", 1)[1] if "." in event_name else event_name
+
+
+def is_throttle(response=None, exception=None):
+    """True if a needs-retry response or exception is a throttling error"""
+    code = None
+    if response is not None:
+        code = (response[1] or {}).get("Error", {}).get("Code")
+    elif exception is not None:
+        code = getattr(exception, "response", {}).get("Error", {}).get("Code")
+    return code in THROTTLE_CODES
+
+
+class Instrumentation(object):
+    """Per-operation AWS API statistics gathered through the botocore event system.
+
+    attach registers handlers on a client's event emitter, so every call made through the
+    client (including paginators) is counted with its latency, retries, throttles and errors.
+    The statistics are shared by all attached clients and are thread safe.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.operations = {}
+
+    def attach(self, client):
+        events = getattr(getattr(client, "meta", None), "events", None)
+        if events is None:
+            return
+        events.register_first("before-call", self._before_call)
+        events.register("after-call", self._after_call)
+        events.register("after-call-error", self._after_call_error)
+        events.register_first("needs-retry", self._needs_retry)
+
+    def _stats(self, operation):
+        stats = self.operations.get(operation)
+        if stats is None:
+            stats = self.operations[operation] = {
+                "calls": 0,
+                "errors": 0,
+                "retries": 0,
+                "throttles": 0,
+                "total_ms": 0.0,
+                "latency_ms": {},
+            }
+        return stats
+
+    def _before_call(self, context=None, **kwargs):
+        if context is not None:
+            context["instrumentation_start"] = time.time()
+
+    def _finish(self, event_name, context, error=False):
+        start = (context or {}).get("instrumentation_start")
+        ms = (time.time() - start) * 1000 if start else 0.0
+        with self._lock:
+            stats = self._stats(_operation(event_name))
+            stats["calls"] += 1
+            stats["total_ms"] += ms
+            bucket = _bucket(ms)
+            stats["latency_ms"][bucket] = stats["latency_ms"].get(bucket, 0) + 1
+            if error:
+                stats["errors"] += 1
+        return stats
+
+    def _after_call(self, event_name, parsed=None, context=None, **kwargs):
+        self._finish(event_name, context)
+        retries = (parsed or {}).get("ResponseMetadata", {}).get("RetryAttempts", 0)
+        if retries:
+            with self._lock:
+                self._stats(_operation(event_name))["retries"] += retries
+
+    def _after_call_error(self, event_name, exception=None, context=None, **kwargs):
+        self._finish(event_name, context, error=True)
+
+    def _needs_retry(self, event_name, response=None, caught_exception=None, **kwargs):
+        # registered first so it sees every attempt, returns None so retrying is left to botocore
+        if is_throttle(response, caught_exception):
+            with self._lock:
+                self._stats(_operation(event_name))["throttles"] += 1
+
+    def summary(self):
+        with self._lock:
+            return {
+                operation: dict(stats, latency_ms=dict(stats["latency_ms"]), total_ms=round(stats["total_ms"], 3))
+                for operation, stats in self.operations.items()
+            }
+
+
+@contextmanager
+def phase(phases, name):
+    """Records the wall time of a block in milliseconds under phases[name]"""
+    start = time.time()
+    try:
+        yield
+    finally:
+        phases[name] = round((time.time() - start) * 1000, 3)
+
+
+# shared by every client created through the clients registry
+api_stats = Instrumentation()
@@ -1,9 +1,8 @@
-import boto3
-import time
 import logging
 import datetime
 import json
-from pprint import pprint
+
+import clients
 
 logger = logging.getLogger()
 logging.basicConfig()
@@ -16,12 +15,29 @@ time_convert = {
     's': 1
 }
 
+# bounds in seconds for the state machine's wait between drain checks. The checks send the
+# heartbeats, so the longest wait stays well below the lifecycle hook's 60 second HeartbeatTimeout
+MIN_CHECK_INTERVAL = 5
+MAX_CHECK_INTERVAL = 30
+
+# (cluster, ec2InstanceId) -> containerInstanceArn, kept across warm invocations
+instance_index = {}
+# number of ec2 instance ids per cluster query filter
+INDEX_BATCH_SIZE = 20
+
 class LifecycleEvent:
-    ecs = boto3.client('ecs')
-    asg = boto3.client('autoscaling')
+    @property
+    def ecs(self):
+        return clients.get('ecs')
+
+    @property
+    def asg(self):
+        return clients.get('autoscaling')
 
     def __init__(self, event):
         self.event = event
+        # number of tasks left on the instance at the last check_done
+        self.remaining_tasks = None
         self.message = json.loads(event['Records'][0]['Sns']['Message'])
         self.type = self.get_type(self.event)
         self.ecsinstanceid = self.get_ecs_instance()
@@ -39,31 +55,51 @@ class LifecycleEvent:
 
 
     def get_ecs_instance(self):
-        # if not init this should be set
-        if self.event.get("containerInstanceArn"):
+        # if not init this should be set, None when the init lookup found nothing
+        if "containerInstanceArn" in self.event:
             return self.event["containerInstanceArn"]
-        # this sucks. Only way to link EC2 Instance + ECS Instance
-        # is to list all containers for cluster, then describe each instance
-        # and check for the EC2InstanceID
-        else:
+
+        api_calls = 0
+        arn = instance_index.get((self.ecs_cluster, self.ec2instanceid))
+        if not arn:
+            # server side lookup through the cluster query language
+            api_calls += 1
+            try:
+                arns = self.ecs.list_container_instances(
+                    cluster=self.ecs_cluster,
+                    filter="ec2InstanceId == {}".format(self.ec2instanceid)
+                )["containerInstanceArns"]
+                if len(arns) == 1:
+                    arn = arns[0]
+                    instance_index[(self.ecs_cluster, self.ec2instanceid)] = arn
+            except Exception as e:
+                logger.error(e)
+        if not arn:
+            # fall back to listing all containers for the cluster, then describing each instance
+            # and checking for the EC2InstanceID. Every instance seen is indexed for later lookups.
             pager = self.ecs.get_paginator("list_container_instances")
             iterator = pager.paginate(cluster=self.ecs_cluster)
-            instance_info = []
             for page in iterator:
+                api_calls += 1
+                if not page['containerInstanceArns']:
+                    continue
+                api_calls += 1
                 full_instances = self.ecs.describe_container_instances(
                     cluster=self.ecs_cluster,
                     containerInstances=page['containerInstanceArns']
                     )["containerInstances"]
-
-                instance_info.extend(full_instances)
-            matching_instance = [i for i in instance_info if i["ec2InstanceId"] == self.ec2instanceid]
-            if matching_instance:
-                # save to event
-                self.event["containerInstanceArn"] = matching_instance[0]["containerInstanceArn"]
-                logger.info("Found container instance {} for ec2Instance {}".format(matching_instance[0]["containerInstanceArn"], self.ec2instanceid))
-                return matching_instance[0]["containerInstanceArn"]
-            else:
-                logger.error('Unable to find corresponding ecsInstanceId in cluster {} for ec2InstanceId {}'.format(self.ecs_cluster, self.ec2instanceid))
+                for instance in full_instances:
+                    instance_index[(self.ecs_cluster, instance["ec2InstanceId"])] = instance["containerInstanceArn"]
+            arn = instance_index.get((self.ecs_cluster, self.ec2instanceid))
+        logger.info("Container instance lookup for {} took {} API calls".format(self.ec2instanceid, api_calls))
+
+        if arn:
+            # save to event
+            self.event["containerInstanceArn"] = arn
+            logger.info("Found container instance {} for ec2Instance {}".format(arn, self.ec2instanceid))
+            return arn
+        else:
+            logger.error('Unable to find corresponding ecsInstanceId in cluster {} for ec2InstanceId {}'.format(self.ecs_cluster, self.ec2instanceid))
 
 
     def set_type(self, t):
@@ -111,6 +147,7 @@ class LifecycleEvent:
                 containerInstance = self.ecsinstanceid,
                 desiredStatus = 'RUNNING'
             )
+            self.remaining_tasks = len(tasks.get('taskArns', []))
             if tasks.get('taskArns'):
                 logger.info("{} tasks still running on {} - waiting....".format(str(len(tasks.get('taskArns'))),
                                                                                 self.ec2instanceid))
@@ -148,3 +185,59 @@ class LifecycleEvent:
                 logger.info("ASG Complete Lifecycle Action Response: %s" % res[u'ResponseMetadata'][u'HTTPStatusCode'])
             except Exception as e:
                 logger.error(e)
+
+
+def index_instances(cluster, ec2_instance_ids):
+    """Resolves the container instances of several ec2 instances at once into instance_index"""
+    missing = [i for i in ec2_instance_ids if (cluster, i) not in instance_index]
+    for start in range(0, len(missing), INDEX_BATCH_SIZE):
+        batch = missing[start:start + INDEX_BATCH_SIZE]
+        try:
+            arns = clients.get('ecs').list_container_instances(
+                cluster=cluster,
+                filter="ec2InstanceId in [{}]".format(", ".join("'{}'".format(i) for i in batch))
+            )["containerInstanceArns"]
+            if not arns:
+                continue
+            instances = clients.get('ecs').describe_container_instances(
+                cluster=cluster,
+                containerInstances=arns
+            )["containerInstances"]
+        except Exception as e:
+            logger.error(e)
+            continue
+        for instance in instances:
+            instance_index[(cluster, instance["ec2InstanceId"])] = instance["containerInstanceArn"]
+
+
+def next_check_interval(event, remaining, endtime, now=None, floor=MIN_CHECK_INTERVAL):
+    """Returns the seconds to wait before the next drain check and records this check in the event.
+
+    While tasks are stopping the wait is the time the observed stop rate needs to empty the
+    instance. Without progress the previous wait is doubled. The wait is at least floor, never
+    overshoots endtime and stays within MIN_CHECK_INTERVAL and MAX_CHECK_INTERVAL.
+
+    Args:
+        event: the state machine event, holds the previous check under "last_check"
+        remaining: tasks still running, None if unknown
+        endtime: datetime at which the instance is shut down regardless
+        floor: shortest wait, raised when task events complete the drain and checks are a fallback
+    """
+    now = now or datetime.datetime.now()
+    last = event.get("last_check")
+    wait = MIN_CHECK_INTERVAL
+    if last and remaining is not None and last.get("remaining") is not None:
+        elapsed = (now - datetime.datetime.strptime(last["time"], '%Y-%m-%dT%H:%M:%S.%f')).total_seconds()
+        stopped = last["remaining"] - remaining
+        if stopped > 0 and elapsed > 0:
+            wait = remaining / (stopped / elapsed)
+        else:
+            wait = event.get("wait_seconds", MIN_CHECK_INTERVAL) * 2
+    wait = max(wait, floor)
+    if endtime:
+        wait = min(wait, (endtime - now).total_seconds())
+    wait = int(min(max(wait, MIN_CHECK_INTERVAL), MAX_CHECK_INTERVAL))
+
+    event["last_check"] = {"time": now.strftime('%Y-%m-%dT%H:%M:%S.%f'), "remaining": remaining}
+    event["wait_seconds"] = wait
+    return wait
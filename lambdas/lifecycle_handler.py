@@ -1,16 +1,18 @@
-import boto3
 import traceback
 import logging
 import json
-import os
 import datetime
-from lifecycle_event import LifecycleEvent
+from lifecycle_event import LifecycleEvent, next_check_interval
+from instrumentation import api_stats
+import drain_batch
 
 logger = logging.getLogger()
 logging.basicConfig()
 logger.setLevel(logging.INFO)
 
 def main(event):
+    if "batch" in event:
+        return drain_batch.handle(event)
     ecs_event = LifecycleEvent(event)
     endtime = ecs_event.endtime
     logger.info("Event Type: {}".format(ecs_event.type))
@@ -21,6 +23,7 @@ def main(event):
         ecs_event.send_heartbeat()
         # set event_type
         ecs_event.set_type("state_machine:retry")
+        next_check_interval(ecs_event.event, None, endtime)
         return ecs_event.event
     else:
         # send heartbeat
@@ -35,13 +38,18 @@ def main(event):
             ecs_event.complete_asg_lifecycle()
             return ecs_event.event
         else:
-            logger.info('Checking back in a bit on {}'.format(ecs_event.ec2instanceid))
+            wait = next_check_interval(ecs_event.event, ecs_event.remaining_tasks, endtime)
+            logger.info('Checking back in {}s on {}'.format(wait, ecs_event.ec2instanceid))
             return ecs_event.event
 
 def lambda_handler(event, context):
     logger.info(json.dumps(event))
+    api_stats.reset()
     try:
-        return main(event)
+        result = main(event)
+        if result is not None:
+            result["instrumentation"] = api_stats.summary()
+        return result
     except Exception as err:
         print(err)
         traceback.print_exc()
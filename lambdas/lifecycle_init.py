@@ -1,10 +1,12 @@
-import boto3
 import traceback
 import logging
 import json
 import datetime
 import os
+import clients
+from instrumentation import api_stats
 from lifecycle_event import LifecycleEvent
+import drain_batch
 
 # default is for testing
 state_fxn_arn = os.environ.get("STATE_FUNCTION", "arn:aws:states:us-east-1:056684691971:stateMachine:fake_state_machine")
@@ -13,15 +15,18 @@ logger = logging.getLogger()
 logging.basicConfig()
 logger.setLevel(logging.INFO)
 
-def main(event):
-    ecs_event = LifecycleEvent(event)
-    # sns kicks off state machine
-    step = boto3.client('stepfunctions')
-    # set end time
+def set_endtime(ecs_event):
     # end time = task timeout time + 1m for stopped tasks to start on another host
     endtime = datetime.datetime.now() + datetime.timedelta(seconds=ecs_event.ecs_timeout) + datetime.timedelta(minutes=1)
     ecs_event.event["endtime"] = endtime.isoformat()
+
+def main(event):
+    ecs_event = LifecycleEvent(event)
+    # sns kicks off state machine
+    step = clients.get('stepfunctions')
+    set_endtime(ecs_event)
     ecs_event.set_type("state_machine:init")
+    ecs_event.event["instrumentation"] = api_stats.summary()
     logger.info('Starting state function for instance {}'.format(ecs_event.ec2instanceid))
     logger.info('State function input: \n{}'.format(json.dumps(ecs_event.event)))
     step.start_execution(
@@ -30,8 +35,53 @@ def main(event):
     )
     return ecs_event.event
 
+def start_batch(step, cluster, events):
+    """Starts the state machine execution draining the instances of one cluster"""
+    members = drain_batch.start_events(cluster, events)
+    for ecs_event in members:
+        set_endtime(ecs_event)
+        ecs_event.set_type("state_machine:init")
+        if not ecs_event.ecsinstanceid:
+            # the batch completes it at its endtime, later steps don't look it up again
+            ecs_event.event["containerInstanceArn"] = None
+    batch = {
+        "batch": [ecs_event.event for ecs_event in members],
+        "state": "state_machine:init",
+        "instrumentation": api_stats.summary()
+    }
+    logger.info('Starting state function for {} instances in cluster {}'.format(len(batch["batch"]), cluster))
+    logger.info('State function input: \n{}'.format(json.dumps(batch)))
+    step.start_execution(
+        stateMachineArn=state_fxn_arn,
+        input=json.dumps(batch)
+    )
+    return batch
+
+def batch_main(event):
+    """Starts one state machine execution per cluster for an SQS batch of lifecycle notifications.
+
+    Returns the messages of the clusters that failed as SQS batch item failures, so only those
+    are delivered again.
+    """
+    step = clients.get('stepfunctions')
+    clusters = drain_batch.group_by_cluster(drain_batch.lifecycle_messages(event))
+    failures = []
+    for cluster, (message_ids, events) in clusters.items():
+        try:
+            start_batch(step, cluster, events)
+        except Exception as err:
+            logger.error('Unable to start the drain of cluster {}: {}'.format(cluster, err))
+            traceback.print_exc()
+            failures.extend({"itemIdentifier": message_id} for message_id in message_ids)
+    return {"batchItemFailures": failures}
+
 def lambda_handler(event, context):
     logger.info(json.dumps(event))
+    api_stats.reset()
+    # lifecycle notifications batched through SQS are drained together. Errors aren't caught
+    # here, so SQS keeps the messages and delivers them again
+    if event['Records'][0].get('eventSource') == 'aws:sqs':
+        return batch_main(event)
     try:
         main(event)
     except Exception as err:
@@ -0,0 +1,220 @@
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from instrumentation import is_throttle
+
+logger = logging.getLogger()
+logging.basicConfig()
+logger.setLevel(logging.INFO)
+
+HIGH = "high"
+LOW = "low"
+
+# operations are named like botocore's call events, by the hyphenated service id of the client
+# (auto-scaling for autoscaling, sfn for stepfunctions) and the operation name
+
+# calls that hold up a scale-in. They may use the whole bucket, everything else leaves
+# LOW_PRIORITY_RESERVE of it for them
+PRIORITY_OPERATIONS = [
+    "ecs.UpdateContainerInstancesState",
+    "ecs.ListTasks",
+    "auto-scaling.CompleteLifecycleAction",
+    "auto-scaling.RecordLifecycleActionHeartbeat",
+]
+LOW_PRIORITY_RESERVE = 0.5
+
+# (requests per second, burst) per operation, below the account level API limits
+RATES = {
+    "ecs.ListContainerInstances": (20, 40),
+    "ecs.DescribeContainerInstances": (20, 40),
+    "ecs.ListServices": (20, 40),
+    "ecs.DescribeServices": (20, 40),
+    "ecs.DescribeTaskDefinition": (20, 40),
+    "ecs.ListTasks": (20, 40),
+    "ecs.UpdateContainerInstancesState": (10, 20),
+    # a drain batch sends one heartbeat per instance per check, bursts fit the largest SQS batch
+    "auto-scaling.CompleteLifecycleAction": (20, 100),
+    "auto-scaling.RecordLifecycleActionHeartbeat": (20, 100),
+}
+DEFAULT_RATE = (10, 20)
+# share of every rate and burst this process may use. Buckets live in one process, so they
+# can't arbitrate between lambdas. The metric collectors run with a share below 1 to leave
+# the rest of each limit to the drain lambdas
+RATE_SHARE = float(os.environ.get("RATE_SHARE", 1))
+
+# after a throttle the rate is multiplied by THROTTLE_DECREASE, every success adds
+# RECOVERY_INCREASE requests per second back until the configured rate is reached
+THROTTLE_DECREASE = 0.5
+RECOVERY_INCREASE = 0.5
+MIN_RATE = 0.5
+# exponential backoff after consecutive throttles, with full jitter
+BACKOFF_BASE = 0.1
+BACKOFF_MAX = 5.0
+
+
+class TokenBucket(object):
+    """Token bucket whose rate adapts to throttling (additive increase, multiplicative decrease)"""
+
+    def __init__(self, rate, burst, clock=time.time, rng=random.random):
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.capacity = float(burst)
+        self.tokens = float(burst)
+        self.clock = clock
+        self.rng = rng
+        self.updated = clock()
+        self.blocked_until = 0
+        self.consecutive_throttles = 0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, floor=0):
+        """Takes a token if more than floor would be left. Returns 0 on success or the seconds to wait before retrying."""
+        with self._lock:
+            now = self.clock()
+            if now < self.blocked_until:
+                return self.blocked_until - now
+            self._refill(now)
+            if self.tokens - 1 >= floor:
+                self.tokens -= 1
+                return 0
+            return (1 + floor - self.tokens) / self.rate
+
+    def throttled(self):
+        with self._lock:
+            self.consecutive_throttles += 1
+            self.rate = max(MIN_RATE, self.rate * THROTTLE_DECREASE)
+            self.tokens = min(self.tokens, 0)
+            backoff = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** self.consecutive_throttles)
+            self.blocked_until = self.clock() + backoff * self.rng()
+
+    def succeeded(self):
+        with self._lock:
+            self.consecutive_throttles = 0
+            self.rate = min(self.max_rate, self.rate + RECOVERY_INCREASE)
+
+
+class RateLimiter(object):
+    """Per-operation client side rate limiting with priority lanes.
+
+    attach hooks the botocore events of a client so every call, and every retry of a failed
+    call, first takes a token from its operation's bucket. Throttling errors slow the bucket
+    down and back it off with jitter, successful calls speed it back up. Calls in
+    PRIORITY_OPERATIONS may empty a bucket while all other calls leave LOW_PRIORITY_RESERVE of
+    it, so drain calls keep moving while a capacity check in the same process competes for the
+    same API limits. One limiter is shared by every client in the process. Other processes
+    only see its effect through the throttling errors, share scales the rates down for the
+    ones that should yield.
+    """
+
+    def __init__(self, rates=None, sleep=time.sleep, clock=time.time, rng=random.random, enabled=True,
+                 share=RATE_SHARE):
+        self.enabled = enabled
+        self.rates = RATES if rates is None else rates
+        self.share = share
+        self.sleep = sleep
+        self.clock = clock
+        self.rng = rng
+        self.buckets = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def bucket(self, operation):
+        bucket = self.buckets.get(operation)
+        if bucket is None:
+            with self._lock:
+                if operation not in self.buckets:
+                    rate, burst = self.rates.get(operation, DEFAULT_RATE)
+                    self.buckets[operation] = TokenBucket(
+                        rate * self.share, max(1, burst * self.share), self.clock, self.rng)
+                bucket = self.buckets[operation]
+        return bucket
+
+    def priority(self, operation):
+        lane = getattr(self._local, "priority", None)
+        if lane:
+            return lane
+        return HIGH if operation in PRIORITY_OPERATIONS else LOW
+
+    @contextmanager
+    def lane(self, priority):
+        """Runs every call made by the current thread inside the block at priority. Thread pool
+        workers don't inherit it, work submitted to them goes through bind"""
+        previous = getattr(self._local, "priority", None)
+        self._local.priority = priority
+        try:
+            yield
+        finally:
+            self._local.priority = previous
+
+    def bind(self, fn):
+        """Returns fn wrapped to run in the current thread's lane, for work handed to another thread"""
+        lane = getattr(self._local, "priority", None)
+        if lane is None:
+            return fn
+
+        def run(*args, **kwargs):
+            with self.lane(lane):
+                return fn(*args, **kwargs)
+        return run
+
+    def acquire(self, operation, priority=None):
+        """Blocks until operation may be called. Returns the seconds spent waiting."""
+        if not self.enabled:
+            return 0
+        priority = priority or self.priority(operation)
+        bucket = self.bucket(operation)
+        floor = 0 if priority == HIGH else bucket.capacity * LOW_PRIORITY_RESERVE
+        waited = 0
+        while True:
+            wait = bucket.try_acquire(floor)
+            if not wait:
+                return waited
+            # jitter so callers that were blocked together don't retry together
+            wait *= 1 + self.rng() * 0.5
+            self.sleep(wait)
+            waited += wait
+
+    def attach(self, client):
+        events = getattr(getattr(client, "meta", None), "events", None)
+        if events is None:
+            return
+        events.register_first("before-call", self._before_call)
+        events.register("after-call", self._after_call)
+        events.register_first("needs-retry", self._needs_retry)
+
+    def _operation(self, event_name):
+        return event_name.split(".", 1)[1]
+
+    def _before_call(self, event_name, **kwargs):
+        waited = self.acquire(self._operation(event_name))
+        if waited:
+            logger.info("Rate limited {} for {:.3f}s".format(self._operation(event_name), waited))
+
+    def _after_call(self, event_name, **kwargs):
+        if self.enabled:
+            self.bucket(self._operation(event_name)).succeeded()
+
+    def _needs_retry(self, event_name, response=None, caught_exception=None, **kwargs):
+        if not self.enabled:
+            return
+        operation = self._operation(event_name)
+        if is_throttle(response, caught_exception):
+            self.bucket(operation).throttled()
+        # before-call only runs for the first attempt, a failed attempt may be retried so the
+        # retry takes its token here. A final attempt that isn't retried takes one it won't use
+        if caught_exception is not None or (response is not None and (response[1] or {}).get("Error")):
+            waited = self.acquire(operation)
+            if waited:
+                logger.info("Rate limited the retry of {} for {:.3f}s".format(operation, waited))
+
+
+# shared by every client created through the clients registry
+limiter = RateLimiter(enabled=os.environ.get("RATE_LIMIT", "on") != "off")
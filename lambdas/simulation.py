@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""What-if capacity simulation against cluster snapshots.
+
+    ./lambdas/simulation.py capture my-cluster snapshot.json
+    ./lambdas/simulation.py rerun snapshot.json
+    ./lambdas/simulation.py whatif snapshot.json scenarios.json
+    ./lambdas/simulation.py size snapshot.json --service web --desired 40 --cpu 2048 --memory 7680
+
+A scenarios file is a list of {"name": ..., "changes": [...]} where every change is one of
+{"add_instances": {"count": N, "cpu": CPU, "memory": MEMORY}},
+{"scale_service": {"service": NAME, "desired": K}} or {"drain_instance": EC2_INSTANCE_ID}. A drain
+can list the (cpu, memory) of the tasks the instance runs as "tasks": [[CPU, MEMORY], ...].
+"""
+import argparse
+import json
+import sys
+import time
+from collections import Counter
+
+from capacity import CapacityEngine, UNCONSTRAINED
+import snapshot as snapshots
+
+
+def _sorted_rows(rows):
+    # ECS binpack on memory: instances with the least free memory are filled first
+    return sorted((row for row in rows if rows[row] > 0), key=lambda row: (row[1], row[0]))
+
+
+def free_counts(rows):
+    """Collapses rows to the Counter of (free cpu, free memory) to instances CapacityEngine counts from"""
+    counts = Counter()
+    for row, instances in rows.items():
+        if instances > 0:
+            counts[row[:2]] += instances
+    return counts
+
+
+def place(rows, count, cpu, memory):
+    """Places count tasks of a shape on rows, a Counter of
+    (free cpu, free memory, registered cpu, registered memory) to instances.
+
+    Whole groups of identical instances are filled at once, so the cost grows with the number
+    of distinct rows rather than instances or tasks. Returns the number of tasks that didn't fit.
+    """
+    if not cpu and not memory:
+        return 0
+    for row in _sorted_rows(rows):
+        if not count:
+            break
+        free_cpu, free_memory, registered = row[0], row[1], row[2:]
+        fits = min(free_cpu // cpu if cpu else count, free_memory // memory if memory else count)
+        if fits <= 0:
+            continue
+        fits = min(fits, count)
+        full = min(rows[row], count // fits)
+        if full:
+            rows[row] -= full
+            rows[(free_cpu - fits * cpu, free_memory - fits * memory) + registered] += full
+            count -= full * fits
+        if count and rows[row] and count < fits:
+            rows[row] -= 1
+            rows[(free_cpu - count * cpu, free_memory - count * memory) + registered] += 1
+            count = 0
+    return count
+
+
+def release(rows, count, cpu, memory):
+    """Frees count tasks of a shape from rows, one per instance starting with the fullest instances.
+
+    Snapshots don't record which instance runs which task, so this is where binpack would have
+    put them. An instance only frees a task while its free resources stay within what it
+    registered, tasks left over once no instance can free one are dropped.
+    """
+    while count > 0:
+        freed_any = False
+        for row in _sorted_rows(rows):
+            if not count:
+                break
+            free_cpu, free_memory, registered_cpu, registered_memory = row
+            if free_cpu + cpu > registered_cpu or free_memory + memory > registered_memory:
+                continue
+            freed = min(rows[row], count)
+            rows[row] -= freed
+            rows[(free_cpu + cpu, free_memory + memory, registered_cpu, registered_memory)] += freed
+            count -= freed
+            freed_any = True
+        if not freed_any:
+            return
+
+
+class Simulation(object):
+    """Evaluates what-if scenarios against a snapshot without the ECS API.
+
+    Instances are held as counts of distinct (free cpu, free memory, registered cpu, registered
+    memory) rows, which collapse to the form CapacityEngine counts from, and each scenario works
+    on a copy of them. Adding instances adds
+    a row, scaling a service up places its new tasks binpacked on memory, scaling it down frees
+    them from the fullest instances, and draining an instance removes it and places its tasks on
+    the rest of the cluster. The tasks take the shapes the change lists, largest first, or else
+    the average of what the instance runs.
+    """
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.rows = Counter(tuple(instance["free"]) + tuple(instance["registered"]) for instance in snapshot["instances"])
+        self.instances = {instance["ec2InstanceId"]: instance for instance in snapshot["instances"]}
+        self.services = {}
+        # services commonly share a task size, so capacity is counted once per distinct shape. The
+        # first service of each shape names it, the same service the aggregator would report
+        self.shape_names = {}
+        for service in snapshot["services"]:
+            cpu, memory = snapshot["task_definitions"][service["task_definition"]]
+            self.services[service["name"]] = {"desired": service["desired"], "cpu": cpu, "memory": memory}
+            self.shape_names.setdefault((cpu, memory), service["name"])
+        self.shapes = list(self.shape_names)
+        self.desired_tasks = sum(svc["desired"] for svc in self.services.values())
+
+    def evaluate(self, changes, detail=False, placement_only=False):
+        """Returns the capacity of the cluster after applying changes. detail adds the schedulable
+        tasks of every service. placement_only returns just the instances and the tasks that didn't
+        fit, without counting the capacity left."""
+        rows = Counter(self.rows)
+        desired = {}
+        unplaced = 0
+        instances = len(self.instances)
+        # every drained instance leaves before any tasks move, so none of them takes another's tasks
+        for change in changes:
+            if "drain_instance" in change:
+                instance = self.instances[change["drain_instance"]]
+                row = tuple(instance["free"]) + tuple(instance["registered"])
+                if rows[row] > 0:
+                    rows[row] -= 1
+                    instances -= 1
+        for change in changes:
+            if "add_instances" in change:
+                added = change["add_instances"]
+                rows[(added["cpu"], added["memory"], added["cpu"], added["memory"])] += added["count"]
+                instances += added["count"]
+            elif "scale_service" in change:
+                name = change["scale_service"]["service"]
+                service = self.services[name]
+                current = desired.get(name, service["desired"])
+                target = change["scale_service"]["desired"]
+                if target > current:
+                    unplaced += place(rows, target - current, service["cpu"], service["memory"])
+                else:
+                    release(rows, current - target, service["cpu"], service["memory"])
+                desired[name] = target
+            elif "drain_instance" in change and "tasks" in change:
+                shapes = Counter(tuple(shape) for shape in change["tasks"])
+                # the largest on memory first, as binpack fills memory
+                by_size = sorted(shapes.items(), key=lambda item: (item[0][1], item[0][0]), reverse=True)
+                for (cpu, memory), count in by_size:
+                    unplaced += place(rows, count, cpu, memory)
+            elif "drain_instance" in change:
+                instance = self.instances[change["drain_instance"]]
+                free = tuple(instance["free"])
+                if instance["tasks"]:
+                    tasks = instance["tasks"]
+                    cpu = -(-(instance["registered"][0] - free[0]) // tasks)
+                    memory = -(-(instance["registered"][1] - free[1]) // tasks)
+                    unplaced += place(rows, tasks, cpu, memory)
+            else:
+                raise ValueError("Unknown change {}".format(change))
+        if placement_only:
+            return {"instances": instances, "unplaced_tasks": unplaced}
+
+        by_shape = dict(zip(self.shapes, CapacityEngine(counts=free_counts(rows)).schedulable(self.shapes)))
+        constrained = [shape for shape in self.shapes if by_shape[shape] != UNCONSTRAINED]
+        largest = min(constrained, key=by_shape.get) if constrained else None
+        result = {
+            "instances": instances,
+            "free_spaces": by_shape[largest] if largest else UNCONSTRAINED,
+            "largest_service": self.shape_names[largest] if largest else None,
+            "desired_tasks": self.desired_tasks + sum(
+                count - self.services[name]["desired"] for name, count in desired.items()),
+            "unplaced_tasks": unplaced,
+        }
+        if detail:
+            result["schedulable"] = {
+                name: by_shape[(svc["cpu"], svc["memory"])] for name, svc in self.services.items()
+            }
+        return result
+
+    def instances_needed(self, changes, cpu, memory, min_free=2, max_instances=1000):
+        """Returns the fewest instances of a shape to add so every task of changes is placed and
+        at least min_free more tasks fit, None if max_instances aren't enough"""
+
+        def enough(count):
+            # the instances come first so the changes can place tasks on them
+            changed = [{"add_instances": {"count": count, "cpu": cpu, "memory": memory}}] + list(changes)
+            if min_free <= 0:
+                # any capacity left is enough, so counting it can be skipped
+                return not self.evaluate(changed, placement_only=True)["unplaced_tasks"]
+            result = self.evaluate(changed)
+            return not result["unplaced_tasks"] and result["free_spaces"] >= min_free
+
+        if not enough(max_instances):
+            return None
+        low, high = 0, max_instances
+        while low < high:
+            middle = (low + high) // 2
+            if enough(middle):
+                high = middle
+            else:
+                low = middle + 1
+        return low
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command")
+    capture = commands.add_parser("capture", help="snapshot a live cluster")
+    capture.add_argument("cluster")
+    capture.add_argument("snapshot")
+    rerun = commands.add_parser("rerun", help="aggregate a snapshot as the metric lambda would")
+    rerun.add_argument("snapshot")
+    whatif = commands.add_parser("whatif", help="evaluate a file of scenarios")
+    whatif.add_argument("snapshot")
+    whatif.add_argument("scenarios")
+    whatif.add_argument("--detail", action="store_true", help="include the schedulable tasks of every service")
+    size = commands.add_parser("size", help="find the instances needed to run a service at a task count")
+    size.add_argument("snapshot")
+    size.add_argument("--service", required=True)
+    size.add_argument("--desired", type=int, required=True)
+    size.add_argument("--cpu", type=int, required=True, help="cpu units of the instance type")
+    size.add_argument("--memory", type=int, required=True, help="memory in MiB ECS registers for the instance type")
+    size.add_argument("--min-free", type=int, default=2, help="AdditionalTasks to leave, above the scale out threshold")
+    args = parser.parse_args()
+
+    if args.command == "capture":
+        snapshots.capture(args.cluster, args.snapshot)
+        return
+    if args.command is None:
+        parser.error("a command is required")
+    snapshot = snapshots.load(args.snapshot)
+    if args.command == "rerun":
+        print(snapshots.SnapshotAggregator(snapshot))
+    elif args.command == "whatif":
+        with open(args.scenarios) as f:
+            scenarios = json.load(f)
+        simulation = Simulation(snapshot)
+        start = time.time()
+        results = [dict(simulation.evaluate(scenario["changes"], args.detail), name=scenario.get("name")) for scenario in scenarios]
+        elapsed = time.time() - start
+        json.dump(results, sys.stdout, indent=4, sort_keys=True)
+        sys.stdout.write("\n")
+        sys.stderr.write("{} scenarios in {:.3f}s\n".format(len(scenarios), elapsed))
+    elif args.command == "size":
+        changes = [{"scale_service": {"service": args.service, "desired": args.desired}}]
+        needed = Simulation(snapshot).instances_needed(changes, args.cpu, args.memory, args.min_free)
+        print(json.dumps({"service": args.service, "desired": args.desired, "instances_to_add": needed}))
+
+
+if __name__ == "__main__":
+    main()
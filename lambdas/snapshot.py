@@ -0,0 +1,105 @@
+import logging
+import json
+import os
+import time
+
+from cluster_stats import ClusterStatAggregator
+
+logger = logging.getLogger()
+logging.basicConfig()
+logger.setLevel(logging.INFO)
+
+# bumped whenever the layout of a snapshot changes. Version 1 snapshots have no instance
+# attributes, so all of their instances aggregate into one group
+SNAPSHOT_VERSION = 2
+
+
+def snapshot_from(cluster, now=None):
+    """Returns the inputs an aggregated cluster was computed from as a snapshot dict.
+
+    Instances keep their free and registered (cpu, memory), task count and the attributes the
+    cluster was grouped by, services their counts and task definition, and task definitions the
+    (cpu, memory) one task needs.
+    """
+    return {
+        "version": SNAPSHOT_VERSION,
+        "cluster": cluster.cluster,
+        "captured_at": int(now or time.time()),
+        "instances": [
+            {"ec2InstanceId": instance_id, "free": list(free), "registered": list(registered), "tasks": tasks,
+             "attributes": [{"name": name, "value": value} for name, value in groups if value is not None]}
+            for instance_id, free, registered, tasks, groups
+            in zip(cluster.instance_ids, cluster.resource_pairs, cluster.registered_pairs, cluster.instance_tasks,
+                   cluster.instance_groups)
+        ],
+        "services": [
+            {"name": svc["name"], "desired": svc["desired"], "running": svc["running"],
+             "task_definition": svc["task_definition"]}
+            for svc in cluster.services
+        ],
+        "task_definitions": {
+            svc["task_definition"]: [svc["cpu_per_task"], svc["memory_per_task"]]
+            for svc in cluster.services
+        },
+    }
+
+
+def capture(cluster_name, path):
+    """Aggregates a live cluster and writes its inputs to a snapshot file"""
+    snapshot = snapshot_from(ClusterStatAggregator(cluster_name))
+    save(snapshot, path)
+    return snapshot
+
+
+def save(snapshot, path):
+    with open(path + ".tmp", "w") as f:
+        json.dump(snapshot, f)
+    os.rename(path + ".tmp", path)
+
+
+def load(path):
+    with open(path) as f:
+        snapshot = json.load(f)
+    if snapshot.get("version") not in range(1, SNAPSHOT_VERSION + 1):
+        raise ValueError("{} is a version {} snapshot, only versions up to {} are supported".format(
+            path, snapshot.get("version"), SNAPSHOT_VERSION))
+    return snapshot
+
+
+class SnapshotAggregator(ClusterStatAggregator):
+    """ClusterStatAggregator computed from a snapshot instead of the ECS API"""
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        super(SnapshotAggregator, self).__init__(snapshot["cluster"])
+        self.output["snapshot"] = {"version": snapshot["version"], "captured_at": snapshot["captured_at"]}
+
+    def _resolve_container_instances(self):
+        for instance in self.snapshot["instances"]:
+            yield {
+                "ec2InstanceId": instance["ec2InstanceId"],
+                "remainingResources": [
+                    {"name": "CPU", "integerValue": instance["free"][0]},
+                    {"name": "MEMORY", "integerValue": instance["free"][1]},
+                ],
+                "registeredResources": [
+                    {"name": "CPU", "integerValue": instance["registered"][0]},
+                    {"name": "MEMORY", "integerValue": instance["registered"][1]},
+                ],
+                "runningTasksCount": instance["tasks"],
+                "pendingTasksCount": 0,
+                "attributes": instance.get("attributes", []),
+            }
+
+    def _resolve_ecs_services(self):
+        for service in self.snapshot["services"]:
+            yield {
+                "serviceName": service["name"],
+                "desiredCount": service["desired"],
+                "runningCount": service["running"],
+                "pendingCount": 0,
+                "taskDefinition": service["task_definition"],
+            }
+
+    def _resolve_task_definitions(self, arns):
+        return {arn: tuple(self.snapshot["task_definitions"][arn]) for arn in set(arns)}
@@ -0,0 +1,80 @@
+import logging
+import json
+import os
+
+import clients
+from cluster_stats import resource_values
+
+logger = logging.getLogger()
+logging.basicConfig()
+logger.setLevel(logging.INFO)
+
+ECS_CLUSTER = os.environ.get("ECS_CLUSTER")
+# instances that haven't registered with ECS yet hold no tasks, they are cheaper than any empty instance
+UNREGISTERED_COST = -1
+# number of ec2 instance ids per cluster query filter
+CANDIDATE_BATCH_SIZE = 20
+
+
+def drain_cost(tasks, free, registered):
+    """Cost of draining an instance: one per task to stop and reschedule, plus the larger of its
+    cpu and memory utilization (below one) to break ties between instances with as many tasks"""
+    used = [1 - float(f) / r if r else 0 for f, r in zip(free, registered)]
+    return tasks + max(used)
+
+
+def instance_costs(cluster, ec2_instance_ids):
+    """Returns a dict of ec2 instance id to drain cost for the container instances of ec2_instance_ids.
+
+    Only the candidates are described, found through the cluster query language, so ranking
+    them costs two calls per CANDIDATE_BATCH_SIZE candidates whatever the size of the cluster.
+    """
+    ecs = clients.get('ecs')
+    costs = {}
+    for start in range(0, len(ec2_instance_ids), CANDIDATE_BATCH_SIZE):
+        batch = ec2_instance_ids[start:start + CANDIDATE_BATCH_SIZE]
+        arns = ecs.list_container_instances(
+            cluster=cluster,
+            filter="ec2InstanceId in [{}]".format(", ".join("'{}'".format(i) for i in batch))
+        )["containerInstanceArns"]
+        if not arns:
+            continue
+        for instance in ecs.describe_container_instances(cluster=cluster, containerInstances=arns)["containerInstances"]:
+            costs[instance["ec2InstanceId"]] = drain_cost(
+                instance.get("runningTasksCount", 0) + instance.get("pendingTasksCount", 0),
+                resource_values(instance["remainingResources"]),
+                resource_values(instance["registeredResources"])
+            )
+    return costs
+
+
+def select_instances(event, costs):
+    """Returns the instance ids to terminate for an autoscaling custom termination policy event.
+
+    For every availability zone in CapacityToTerminate, the candidates in that zone are taken
+    cheapest first.
+    """
+    selected = []
+    for capacity in event["CapacityToTerminate"]:
+        candidates = [
+            instance for instance in event["Instances"]
+            if instance["AvailabilityZone"] == capacity["AvailabilityZone"]
+            and instance["InstanceMarketOption"] == capacity.get("InstanceMarketOption", instance["InstanceMarketOption"])
+            and instance["InstanceId"] not in selected
+        ]
+        candidates.sort(key=lambda instance: (costs.get(instance["InstanceId"], UNREGISTERED_COST), instance["InstanceId"]))
+        selected.extend(instance["InstanceId"] for instance in candidates[:capacity["Capacity"]])
+    return selected
+
+
+def lambda_handler(event, context):
+    logger.info(json.dumps(event))
+    try:
+        costs = instance_costs(ECS_CLUSTER, sorted({instance["InstanceId"] for instance in event["Instances"]}))
+        selected = select_instances(event, costs)
+    except Exception as e:
+        # no instances hands the choice to the next termination policy of the group
+        logger.error("Unable to rank instances of {}: {}".format(ECS_CLUSTER, e))
+        return {"InstanceIDs": []}
+    logger.info("Terminating {} with drain costs {}".format(selected, [costs.get(i, UNREGISTERED_COST) for i in selected]))
+    return {"InstanceIDs": selected}
@@ -0,0 +1,52 @@
+"""CapacityEngine counts, with numpy and in plain python."""
+import random
+import unittest
+
+import capacity
+from capacity import UNCONSTRAINED, CapacityEngine
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class CapacityEngineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.numpy = capacity._numpy[:]
+
+    def tearDown(self):
+        capacity._numpy[:] = self.numpy
+
+    def without_numpy(self):
+        capacity._numpy[:] = [None]
+
+    def test_whole_tasks_per_instance(self):
+        self.without_numpy()
+        engine = CapacityEngine([(1024, 2048), (1024, 2048), (4096, 1024)])
+        # the last instance has cpu for 8 but memory for 1
+        self.assertEqual(engine.schedulable([(512, 1024)]), [2 + 2 + 1])
+        self.assertEqual(engine.schedulable([(0, 1024), (512, 0), (0, 0)]), [2 + 2 + 1, 2 + 2 + 8, UNCONSTRAINED])
+
+    def test_no_instances(self):
+        self.without_numpy()
+        self.assertEqual(CapacityEngine([]).schedulable([(256, 512), (0, 0)]), [0, UNCONSTRAINED])
+
+    def test_counts_of_identical_instances(self):
+        self.without_numpy()
+        engine = CapacityEngine(counts={(2048, 4096): 3, (512, 512): 0})
+        self.assertEqual(engine.free, [(2048, 4096)])
+        self.assertEqual(engine.schedulable([(1024, 1024)]), [6])
+
+    @unittest.skipIf(numpy is None, "numpy isn't installed")
+    def test_numpy_matches_plain_python(self):
+        rng = random.Random(0)
+        pairs = [(rng.randrange(0, 8193, 128), rng.randrange(0, 16385, 256)) for _ in range(2000)]
+        shapes = [(rng.choice([0, 128, 256, 1024, 4096]), rng.choice([0, 256, 512, 2048, 8192]))
+                  for _ in range(capacity.SHAPE_BLOCK_SIZE * 2 + 7)]
+        engine = CapacityEngine(pairs)
+        capacity._numpy[:] = [numpy]
+        with_numpy = engine.schedulable(shapes)
+        self.without_numpy()
+        self.assertEqual(with_numpy, engine.schedulable(shapes))
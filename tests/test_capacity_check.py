@@ -0,0 +1,63 @@
+"""capacity_check against the stub cluster."""
+import datetime
+import unittest
+
+import capacity_check
+from ratelimit import limiter
+from stub_aws import StubAWS, SyntheticCluster
+
+UNPLACEABLE = "(service {}) was unable to place a task because no container instance met all of its requirements."
+
+
+class DisplacedTasksTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cluster = SyntheticCluster(20, 5)
+        StubAWS(self.cluster).install()
+        limiter.enabled = False
+        busy = [i for i in self.cluster.instances.values() if self.cluster.tasks[i["containerInstanceArn"]]]
+        self.drained = {busy[0]["ec2InstanceId"]: busy[0]["containerInstanceArn"]}
+        self.tasks = len(self.cluster.tasks[busy[0]["containerInstanceArn"]])
+
+    def tearDown(self):
+        limiter.enabled = True
+
+    def test_tasks_fit_on_the_rest_of_the_cluster(self):
+        result = capacity_check.displaced_tasks(self.cluster.name, self.drained)
+        self.assertEqual(result["unplaced_tasks"], 0)
+        self.assertEqual(result["instances_needed"], 0)
+        self.assertTrue(result["services"])
+
+    def test_instances_draining_in_other_batches_take_no_tasks(self):
+        for arn, instance in self.cluster.instances.items():
+            if arn not in self.drained.values():
+                instance["status"] = "DRAINING"
+        result = capacity_check.displaced_tasks(self.cluster.name, self.drained)
+        self.assertEqual(result["unplaced_tasks"], self.tasks)
+        self.assertEqual(result["instances_needed"], 1)
+
+
+class UnplaceableServicesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cluster = SyntheticCluster(20, 5)
+        StubAWS(self.cluster).install()
+        limiter.enabled = False
+        self.service = next(iter(self.cluster.services.values()))
+        self.started = datetime.datetime.now(datetime.timezone.utc)
+
+    def tearDown(self):
+        limiter.enabled = True
+
+    def unplaceable(self, seconds):
+        self.service["events"] = [{
+            "message": UNPLACEABLE.format(self.service["serviceName"]),
+            "createdAt": self.started + datetime.timedelta(seconds=seconds),
+        }]
+        return capacity_check.unplaceable_services(self.cluster.name, [self.service["serviceName"]], self.started)
+
+    def test_event_after_the_drain_started(self):
+        self.assertEqual(self.unplaceable(5), [self.service["serviceName"]])
+
+    def test_event_before_the_drain_started(self):
+        self.assertEqual(self.unplaceable(-5), [])
@@ -0,0 +1,104 @@
+"""ClusterStateStore event application and the StateStoreAggregator runs between full scans."""
+import copy
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from cluster_state import ClusterStateStore, StateStoreAggregator
+from ratelimit import limiter
+from stub_aws import StubAWS, SyntheticCluster
+
+EVENT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bench", "events", "task-stopped.json")
+
+
+def ecs_time(seconds):
+    return time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(seconds))
+
+
+class ClusterStateStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        with open(EVENT_FILE) as f:
+            self.template = json.load(f)
+        self.cluster = SyntheticCluster(10, 3)
+        self.aws = StubAWS(self.cluster).install()
+        limiter.enabled = False
+        self.store = ClusterStateStore(self.cluster.name)
+        StateStoreAggregator(self.store, full_scan=True)
+        self.service = next(iter(self.cluster.services.values()))
+        self.aws.counter.reset()
+
+    def tearDown(self):
+        limiter.enabled = True
+
+    def task_event(self, task, status, created, version=1):
+        event = copy.deepcopy(self.template)
+        detail = event["detail"]
+        detail.update({
+            "clusterArn": self.cluster.arn,
+            "taskArn": task,
+            "group": "service:" + self.service["serviceName"],
+            "taskDefinitionArn": self.service["taskDefinition"],
+            "createdAt": ecs_time(created),
+            "desiredStatus": "STOPPED" if status == "STOPPED" else "RUNNING",
+            "lastStatus": status,
+            "version": version,
+        })
+        return event
+
+    def stored(self):
+        return self.store.services[self.service["serviceArn"]]
+
+    def test_task_events_adjust_the_running_count_once(self):
+        running = self.stored()["runningCount"]
+        started = self.task_event("task/new", "RUNNING", time.time() + 1, version=2)
+        self.assertTrue(self.store.apply_event(started))
+        self.assertFalse(self.store.apply_event(started))
+        self.assertEqual(self.stored()["runningCount"], running + 1)
+        # older versions of the same task change nothing
+        self.assertFalse(self.store.apply_event(self.task_event("task/new", "PENDING", time.time(), version=1)))
+        self.assertTrue(self.store.apply_event(self.task_event("task/new", "STOPPED", time.time() + 1, version=3)))
+        self.assertEqual(self.stored()["runningCount"], running)
+
+    def test_other_clusters_are_ignored(self):
+        event = self.task_event("task/new", "RUNNING", time.time() + 1)
+        event["detail"]["clusterArn"] = "arn:aws:ecs:us-east-1:123456789012:cluster/other"
+        self.assertFalse(self.store.apply_event(event))
+        self.assertEqual(self.store.touched, set())
+
+    def test_touched_services_are_described_before_the_next_aggregation(self):
+        revision = self.service["taskDefinition"].replace(":1", ":2")
+        self.cluster.task_definitions[revision] = dict(self.cluster.task_definitions[self.service["taskDefinition"]],
+                                                       taskDefinitionArn=revision)
+        self.service["taskDefinition"] = revision
+        self.service["desiredCount"] += 3
+        self.store.apply_event(self.task_event("task/new", "PENDING", time.time() + 1))
+        self.assertEqual(self.store.touched, {self.service["serviceName"]})
+
+        StateStoreAggregator(self.store)
+        self.assertEqual(self.stored()["desiredCount"], self.service["desiredCount"])
+        self.assertEqual(self.stored()["taskDefinition"], revision)
+        self.assertEqual(self.store.touched, set())
+        self.assertEqual(self.aws.counter.calls["ecs.DescribeServices"], 1)
+        self.assertEqual(self.aws.counter.calls["ecs.ListServices"], 0)
+
+    def test_task_stopped_during_the_scan_is_not_counted_twice(self):
+        # the scan counted the task as stopped already, its event arrives after the scan
+        self.service["runningCount"] -= 1
+        self.stored()["runningCount"] = self.service["runningCount"]
+        self.store.apply_event(self.task_event("task/old", "STOPPED", self.store.reconciled_at - 60))
+        self.assertEqual(self.stored()["runningCount"], self.service["runningCount"] - 1)
+
+        StateStoreAggregator(self.store)
+        self.assertEqual(self.stored()["runningCount"], self.service["runningCount"])
+
+    def test_touched_services_survive_a_save(self):
+        self.store.apply_event(self.task_event("task/new", "RUNNING", time.time() + 1))
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "state.json")
+        self.store.save(path)
+        self.assertEqual(ClusterStateStore.load(self.cluster.name, path).touched, {self.service["serviceName"]})
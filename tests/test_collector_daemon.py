@@ -0,0 +1,87 @@
+"""CollectorDaemon rounds against the stub cluster and queue."""
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import cluster_state
+from collector_daemon import SCALE_OUT_THRESHOLD, CollectorDaemon
+from ratelimit import limiter
+from stub_aws import StubAWS, SyntheticCluster
+
+EVENT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bench", "events", "task-stopped.json")
+LIST_CALLS = ["ecs.ListContainerInstances", "ecs.ListServices"]
+
+
+class CollectorDaemonTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cluster = SyntheticCluster(20, 5)
+        self.aws = StubAWS(self.cluster).install()
+        limiter.enabled = False
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.state_dir = cluster_state.STATE_DIR
+        cluster_state.STATE_DIR = directory
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+        cluster_state.STATE_DIR = self.state_dir
+        limiter.enabled = True
+
+    def collect(self, daemon):
+        self.aws.counter.reset()
+        return self.loop.run_until_complete(daemon.collect(self.loop))
+
+    def list_calls(self):
+        return sum(self.aws.counter.calls[name] for name in LIST_CALLS)
+
+    def queue_task_event(self, service):
+        with open(EVENT_FILE) as f:
+            event = json.load(f)
+        detail = event["detail"]
+        detail.update({"clusterArn": self.cluster.arn, "group": "service:" + service["serviceName"],
+                       "taskDefinitionArn": service["taskDefinition"], "lastStatus": "RUNNING",
+                       "desiredStatus": "RUNNING", "createdAt": "2100-01-01T00:00:00.000Z"})
+        self.aws.clients["sqs"].send(json.dumps(event))
+
+    def test_rounds_after_the_first_apply_events_instead_of_scanning(self):
+        daemon = CollectorDaemon([self.cluster.name], queue_url="queue")
+        self.assertGreater(self.collect(daemon), 0)
+        self.assertGreater(self.list_calls(), 0)
+
+        self.collect(daemon)
+        self.assertEqual(self.list_calls(), 0)
+        self.assertEqual(self.aws.counter.calls["ecs.DescribeServices"], 0)
+
+        service = next(iter(self.cluster.services.values()))
+        service["desiredCount"] += 2
+        self.queue_task_event(service)
+        self.collect(daemon)
+        self.assertEqual(self.list_calls(), 0)
+        self.assertEqual(self.aws.counter.calls["ecs.DescribeServices"], 1)
+        store = daemon.stores[self.cluster.name]
+        self.assertEqual(store.services[service["serviceArn"]]["desiredCount"], service["desiredCount"])
+        self.assertEqual(self.aws.clients["sqs"].in_flight, {})
+        # the saved store carries the refreshed service for the metric lambda
+        saved = cluster_state.ClusterStateStore.load(self.cluster.name)
+        self.assertEqual(saved.services[service["serviceArn"]]["desiredCount"], service["desiredCount"])
+
+    def test_without_a_queue_every_round_scans(self):
+        daemon = CollectorDaemon([self.cluster.name], queue_url=None)
+        self.collect(daemon)
+        self.collect(daemon)
+        self.assertGreater(self.list_calls(), 0)
+
+    def test_publishes_changes_crossings_and_heartbeats(self):
+        daemon = CollectorDaemon([self.cluster.name], threshold=3, heartbeat=50, queue_url=None)
+        high = SCALE_OUT_THRESHOLD + 10
+        self.assertTrue(daemon.should_publish("c", high, 0))
+        daemon.published["c"] = (high, 0)
+        self.assertFalse(daemon.should_publish("c", high + 2, 10))
+        self.assertTrue(daemon.should_publish("c", high + 3, 10))
+        self.assertTrue(daemon.should_publish("c", SCALE_OUT_THRESHOLD, 10))
+        self.assertTrue(daemon.should_publish("c", high, 50))
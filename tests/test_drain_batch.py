@@ -0,0 +1,130 @@
+"""DrainBatch state machine steps against the stub cluster."""
+import datetime
+import shutil
+import tempfile
+import unittest
+
+import drain_batch
+import drain_events
+from ratelimit import limiter
+from scale import retry_event
+from stub_aws import StubAWS, SyntheticCluster
+
+COMPLETE = "auto-scaling.CompleteLifecycleAction"
+HEARTBEAT = "auto-scaling.RecordLifecycleActionHeartbeat"
+UNPLACEABLE = "(service {}) was unable to place a task because no container instance met all of its requirements."
+
+
+class DrainBatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cluster = SyntheticCluster(20, 5)
+        self.aws = StubAWS(self.cluster).install()
+        limiter.enabled = False
+        self.registry = drain_batch.registry
+        drain_batch.registry = None
+        self.now = datetime.datetime.now()
+        busy = [i for i in self.cluster.instances.values() if self.cluster.tasks[i["containerInstanceArn"]]]
+        self.instances = busy[:2]
+
+    def tearDown(self):
+        drain_batch.registry = self.registry
+        limiter.enabled = True
+
+    def empty(self, instance):
+        instance["runningTasksCount"] = instance["pendingTasksCount"] = 0
+        self.cluster.tasks[instance["containerInstanceArn"]] = []
+
+    def step(self, event, seconds=0):
+        return drain_batch._handle(event, self.now + datetime.timedelta(seconds=seconds))
+
+    def test_unresolved_member_keeps_the_batch_running(self):
+        resolved, unresolved = self.instances
+        self.empty(resolved)
+        lost = retry_event(self.cluster, unresolved)
+        lost["containerInstanceArn"] = None
+        event = {"batch": [retry_event(self.cluster, resolved), lost], "state": "state_machine:retry"}
+
+        event = self.step(event)
+        self.assertEqual(event["state"], "state_machine:retry")
+        self.assertEqual([member["Records"][0]["EventSource"] for member in event["batch"]], ["state_machine:retry"])
+        self.assertIsNone(event["batch"][0]["containerInstanceArn"])
+        self.assertEqual(self.aws.counter.calls[COMPLETE], 1)
+        self.assertEqual(self.aws.counter.calls[HEARTBEAT], 1)
+
+        # completed once its endtime passes
+        event = self.step(event, seconds=600)
+        self.assertEqual(event["state"], "state_machine:end")
+        self.assertEqual(event["batch"], [])
+        self.assertEqual(self.aws.counter.calls[COMPLETE], 2)
+
+    def test_pause_leaves_instances_completed_by_events(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        registry = drain_batch.registry = drain_events.FileDrainRegistry(directory)
+        event = {"batch": [retry_event(self.cluster, i) for i in self.instances], "state": "state_machine:init"}
+        event = self.step(event)
+        self.assertFalse(event["capacity_paused"])
+        done, paused = [i["containerInstanceArn"] for i in self.instances]
+
+        # drain_events completed one member, and a service of the batch has nowhere to go
+        registry.mark_done(self.cluster.name, done)
+        name = event["capacity_check"]["services"][0]
+        service = next(s for s in self.cluster.services.values() if s["serviceName"] == name)
+        service["events"] = [{"message": UNPLACEABLE.format(name),
+                              "createdAt": datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=40)}]
+        event = self.step(event, seconds=40)
+
+        self.assertTrue(event["capacity_paused"])
+        self.assertEqual([member["containerInstanceArn"] for member in event["batch"]], [paused])
+        self.assertEqual(self.cluster.instances[done]["status"], "DRAINING")
+        self.assertEqual(self.cluster.instances[paused]["status"], "ACTIVE")
+        self.assertIsNone(registry.load(self.cluster.name, done))
+        self.assertIsNone(registry.load(self.cluster.name, paused))
+
+    def test_members_finish_once_empty(self):
+        event = self.step({"batch": [retry_event(self.cluster, i) for i in self.instances], "state": "state_machine:init"})
+        self.assertEqual(event["state"], "state_machine:retry")
+        self.assertFalse(event["capacity_paused"])
+        self.assertEqual([i["status"] for i in self.instances], ["DRAINING", "DRAINING"])
+
+        self.empty(self.instances[0])
+        event = self.step(event, seconds=10)
+        self.assertEqual(event["state"], "state_machine:retry")
+        self.assertEqual([m["containerInstanceArn"] for m in event["batch"]], [self.instances[1]["containerInstanceArn"]])
+        self.empty(self.instances[1])
+        event = self.step(event, seconds=20)
+        self.assertEqual(event["state"], "state_machine:end")
+        self.assertEqual(self.aws.counter.calls[COMPLETE], 2)
+
+    def test_no_room_pauses_until_there_is(self):
+        others = [i for i in self.cluster.instances.values() if i not in self.instances]
+        for instance in others:
+            instance["status"] = "DRAINING"
+        event = self.step({"batch": [retry_event(self.cluster, i) for i in self.instances], "state": "state_machine:init"})
+        self.assertTrue(event["capacity_paused"])
+        self.assertGreater(event["capacity_check"]["unplaced_tasks"], 0)
+        self.assertEqual([i["status"] for i in self.instances], ["ACTIVE", "ACTIVE"])
+        self.assertGreaterEqual(event["wait_seconds"], drain_batch.capacity_check.CAPACITY_CHECK_INTERVAL)
+
+        # still no room, the group is only asked for instances once
+        event = self.step(event, seconds=30)
+        self.assertTrue(event["capacity_paused"])
+        self.assertEqual(self.aws.counter.calls["auto-scaling.DescribeAutoScalingGroups"], 1)
+
+        for instance in others:
+            instance["status"] = "ACTIVE"
+        event = self.step(event, seconds=60)
+        self.assertFalse(event["capacity_paused"])
+        self.assertEqual(event["state"], "state_machine:retry")
+        self.assertEqual([i["status"] for i in self.instances], ["DRAINING", "DRAINING"])
+
+    def test_drain_goes_ahead_after_the_capacity_wait(self):
+        for instance in self.cluster.instances.values():
+            if instance not in self.instances:
+                instance["status"] = "DRAINING"
+        event = self.step({"batch": [retry_event(self.cluster, i) for i in self.instances], "state": "state_machine:init"})
+        self.assertTrue(event["capacity_paused"])
+        event = self.step(event, seconds=drain_batch.capacity_check.CAPACITY_WAIT + 1)
+        self.assertFalse(event["capacity_paused"])
+        self.assertEqual([i["status"] for i in self.instances], ["DRAINING", "DRAINING"])
@@ -0,0 +1,154 @@
+"""Replays the recorded task stopped event through drain_events against a FileDrainRegistry.
+
+    python -m pytest tests
+"""
+import copy
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import clients
+import drain_events
+from lifecycle_event import LifecycleEvent
+from ratelimit import limiter
+from stub_aws import CallCounter, StubAutoScaling, StubECS, SyntheticCluster
+
+EVENT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bench", "events", "task-stopped.json")
+COMPLETE = "auto-scaling.CompleteLifecycleAction"
+OTHER_TASK = "arn:aws:ecs:us-east-1:123456789012:task/0c9f4e3a-8f3b-4d36-9a55-1d2b7f1e6c20"
+
+
+def lifecycle_event(container_instance_arn):
+    """A draining lifecycle event as the state machine carries it"""
+    return {
+        "Records": [{"EventSource": "state_machine:retry", "Sns": {"Message": json.dumps({
+            "EC2InstanceId": "i-0123456789abcdef0",
+            "NotificationMetadata": json.dumps({"ecs_cluster": "default", "ecs_timeout": "5m"}),
+            "AutoScalingGroupName": "default-asg",
+            "LifecycleActionToken": "token",
+            "LifecycleHookName": "default-hook",
+        })}}],
+        "containerInstanceArn": container_instance_arn,
+        "state": "state_machine:retry",
+    }
+
+
+class PausingRegistry(drain_events.FileDrainRegistry):
+    """Removes every record right after it is first read, as a pause of the drain would"""
+
+    def __init__(self, directory):
+        super(PausingRegistry, self).__init__(directory)
+        self.paused = False
+
+    def load(self, cluster, arn):
+        record = super(PausingRegistry, self).load(cluster, arn)
+        if record is not None and not self.paused:
+            self.paused = True
+            self.remove(cluster, arn)
+        return record
+
+
+class ApplyTaskEventTest(unittest.TestCase):
+
+    def setUp(self):
+        with open(EVENT_FILE) as f:
+            self.event = json.load(f)
+        self.instance = self.event["detail"]["containerInstanceArn"]
+        self.task = self.event["detail"]["taskArn"]
+        self.directory = tempfile.mkdtemp()
+        self.registry = drain_events.FileDrainRegistry(self.directory)
+        self.counter = CallCounter()
+        limiter.enabled = False
+        clients.register("autoscaling", StubAutoScaling(self.counter))
+        cluster = SyntheticCluster(0, 0, name="default")
+        cluster.instances[self.instance] = {"containerInstanceArn": self.instance, "status": "DRAINING"}
+        clients.register("ecs", StubECS(self.counter, cluster))
+        self.ecs_instance = cluster.instances[self.instance]
+
+    def tearDown(self):
+        clients.reset()
+        limiter.enabled = True
+        shutil.rmtree(self.directory)
+
+    def register(self, tasks):
+        member = LifecycleEvent(lifecycle_event(self.instance))
+        drain_events.register(self.registry, member, tasks)
+
+    def stopped(self, task_arn):
+        event = copy.deepcopy(self.event)
+        event["detail"]["taskArn"] = task_arn
+        return event
+
+    def record(self):
+        return self.registry.load("default", self.instance)
+
+    def test_repeated_event_counts_once(self):
+        self.register([self.task, OTHER_TASK])
+        self.assertFalse(drain_events.apply_task_event(self.registry, self.event))
+        self.assertFalse(drain_events.apply_task_event(self.registry, self.event))
+        self.assertEqual(self.record()["tasks"], [OTHER_TASK])
+        self.assertFalse(self.record()["completed"])
+        self.assertEqual(self.counter.calls[COMPLETE], 0)
+
+    def test_last_task_completes_the_lifecycle_action(self):
+        self.register([self.task, OTHER_TASK])
+        self.assertFalse(drain_events.apply_task_event(self.registry, self.stopped(OTHER_TASK)))
+        self.assertTrue(drain_events.apply_task_event(self.registry, self.event))
+        self.assertTrue(self.record()["completed"])
+        self.assertEqual(self.registry.done("default"), {drain_events.instance_id(self.instance)})
+        self.assertEqual(self.counter.calls[COMPLETE], 1)
+        # a late repeat of the last event completes nothing more
+        self.assertFalse(drain_events.apply_task_event(self.registry, self.event))
+        self.assertEqual(self.counter.calls[COMPLETE], 1)
+
+    def test_task_not_registered_is_ignored(self):
+        self.register([OTHER_TASK])
+        self.assertFalse(drain_events.apply_task_event(self.registry, self.event))
+        self.assertEqual(self.record()["tasks"], [OTHER_TASK])
+        self.assertEqual(self.counter.calls[COMPLETE], 0)
+
+    def test_missing_record_is_ignored(self):
+        self.assertFalse(drain_events.apply_task_event(self.registry, self.event))
+        self.assertIsNone(self.record())
+        self.assertEqual(self.registry.done("default"), set())
+        self.assertEqual(self.counter.calls[COMPLETE], 0)
+
+    def test_running_task_event_is_ignored(self):
+        self.register([self.task])
+        event = copy.deepcopy(self.event)
+        event["detail"]["lastStatus"] = "RUNNING"
+        self.assertFalse(drain_events.apply_task_event(self.registry, event))
+        self.assertEqual(self.record()["tasks"], [self.task])
+
+    def test_event_file_replay(self):
+        self.register([self.task])
+        path = os.path.join(self.directory, "events.json")
+        with open(path, "w") as f:
+            json.dump([self.event, self.event], f)
+        self.assertEqual(drain_events.apply_event_file(self.registry, path), 1)
+        self.assertEqual(self.counter.calls[COMPLETE], 1)
+
+    def test_instance_active_again_is_not_completed(self):
+        self.register([self.task])
+        self.ecs_instance["status"] = "ACTIVE"
+        self.assertFalse(drain_events.apply_task_event(self.registry, self.event))
+        self.assertEqual(self.registry.done("default"), set())
+        self.assertEqual(self.counter.calls[COMPLETE], 0)
+
+    def test_record_removed_by_a_pause_stays_removed(self):
+        self.registry = PausingRegistry(self.directory)
+        self.register([self.task, OTHER_TASK])
+        self.assertFalse(drain_events.apply_task_event(self.registry, self.event))
+        self.assertIsNone(self.record())
+
+    def test_new_registration_is_not_overwritten(self):
+        self.register([self.task, OTHER_TASK])
+        stale = self.record()
+        self.register([self.task, OTHER_TASK])
+        latest = self.record()
+        self.assertNotEqual(stale["registration"], latest["registration"])
+        stale["tasks"].remove(self.task)
+        self.assertFalse(drain_events.current(self.registry, stale))
+        self.assertTrue(drain_events.current(self.registry, latest))
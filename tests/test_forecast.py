@@ -0,0 +1,69 @@
+"""History ring buffer and the ForecastAdditionalTasks projection."""
+import shutil
+import tempfile
+import unittest
+
+from capacity import UNCONSTRAINED
+from forecast import (MAX_SAMPLE_GAP, MIN_SAMPLES, FileHistoryBackend, History, forecast_additional_tasks, holt,
+                      record_and_forecast)
+
+
+def history(free, desired=None, interval=60):
+    samples = History("c", size=10)
+    for n, value in enumerate(free):
+        samples.append(1000 + n * interval, value, desired[n] if desired else 0)
+    return samples
+
+
+class AggregatedCluster(object):
+    def __init__(self, free_spaces, desired_tasks):
+        self.cluster = "c"
+        self.free_spaces = free_spaces
+        self.desired_tasks = desired_tasks
+
+
+class HistoryTest(unittest.TestCase):
+
+    def test_ring_buffer_keeps_the_newest_samples(self):
+        samples = history(range(15))
+        self.assertEqual(len(samples), 10)
+        self.assertEqual(samples.series("free"), list(range(5, 15)))
+        self.assertEqual(History.from_dict("c", samples.to_dict(), size=4).series("free"), [11, 12, 13, 14])
+
+    def test_gap_starts_over(self):
+        samples = history([1, 2, 3])
+        samples.append(samples.series("times")[-1] + MAX_SAMPLE_GAP + 1, 9, 0)
+        self.assertEqual(samples.series("free"), [9])
+
+
+class ForecastTest(unittest.TestCase):
+
+    def test_holt_follows_a_line(self):
+        self.assertAlmostEqual(holt([0, 2, 4, 6, 8, 10], 5), 20)
+
+    def test_few_samples_forecast_the_current_value(self):
+        self.assertIsNone(forecast_additional_tasks(History("c")))
+        self.assertEqual(forecast_additional_tasks(history([9, 7, 5][:MIN_SAMPLES - 1])), 5)
+        self.assertEqual(forecast_additional_tasks(history([5, 5, UNCONSTRAINED, 5, 5, 5])), 5)
+
+    def test_steady_cluster(self):
+        self.assertEqual(forecast_additional_tasks(history([20] * 8, [50] * 8)), 20)
+
+    def test_falling_free_slots(self):
+        forecast = forecast_additional_tasks(history([40, 38, 36, 34, 32, 30], [10] * 6), horizon=5)
+        self.assertLess(forecast, 30)
+        self.assertEqual(forecast_additional_tasks(history([40, 30, 20, 10, 5, 1], [10] * 6)), 0)
+
+    def test_rising_desired_tasks(self):
+        # the free slots haven't moved yet, the growth in desired tasks takes them
+        forecast = forecast_additional_tasks(history([30] * 6, [10, 12, 14, 16, 18, 20]), horizon=5)
+        self.assertLess(forecast, 30)
+
+    def test_record_and_forecast_keeps_the_history(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        backend = FileHistoryBackend(directory)
+        for n in range(MIN_SAMPLES):
+            value = record_and_forecast(AggregatedCluster(30, 10), backend=backend, now=1000 + n * 60)
+        self.assertEqual(value, 30)
+        self.assertEqual(len(backend.load("c")), MIN_SAMPLES)
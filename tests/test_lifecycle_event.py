@@ -0,0 +1,56 @@
+"""next_check_interval, the wait between drain checks."""
+import datetime
+import unittest
+
+from lifecycle_event import MAX_CHECK_INTERVAL, MIN_CHECK_INTERVAL, next_check_interval
+
+
+class NextCheckIntervalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = datetime.datetime(2020, 1, 1, 12, 0, 0)
+        self.endtime = self.now + datetime.timedelta(minutes=10)
+
+    def later(self, event, seconds, remaining, endtime=None):
+        return next_check_interval(event, remaining, endtime or self.endtime,
+                                   now=self.now + datetime.timedelta(seconds=seconds))
+
+    def test_first_check_waits_the_minimum(self):
+        event = {}
+        self.assertEqual(next_check_interval(event, 10, self.endtime, now=self.now), MIN_CHECK_INTERVAL)
+        self.assertEqual(event["last_check"]["remaining"], 10)
+
+    def test_wait_follows_the_stop_rate(self):
+        event = {}
+        next_check_interval(event, 12, self.endtime, now=self.now)
+        # 2 tasks stopped in 10 seconds, 10 left take 50 seconds, capped at the maximum
+        self.assertEqual(self.later(event, 10, 10), MAX_CHECK_INTERVAL)
+        # 5 stopped in 10 seconds, the 5 left take 10
+        self.assertEqual(self.later(event, 20, 5), 10)
+        # 4 stopped in 10 seconds, the 1 left takes 2.5, raised to the minimum
+        self.assertEqual(self.later(event, 30, 1), MIN_CHECK_INTERVAL)
+        # 2 stopped in 5 seconds, the 8 left take 20
+        event = {}
+        next_check_interval(event, 10, self.endtime, now=self.now)
+        self.assertEqual(self.later(event, 5, 8), 20)
+
+    def test_no_progress_doubles_the_wait(self):
+        event = {}
+        next_check_interval(event, 10, self.endtime, now=self.now)
+        self.assertEqual(self.later(event, 5, 10), MIN_CHECK_INTERVAL * 2)
+        self.assertEqual(self.later(event, 15, 10), MIN_CHECK_INTERVAL * 4)
+        self.assertEqual(self.later(event, 35, 10), MAX_CHECK_INTERVAL)
+
+    def test_never_overshoots_the_endtime(self):
+        event = {}
+        next_check_interval(event, 10, self.endtime, now=self.now)
+        self.assertEqual(self.later(event, 5, 10, endtime=self.now + datetime.timedelta(seconds=12)), 7)
+
+    def test_floor_raises_the_wait(self):
+        event = {}
+        self.assertEqual(next_check_interval(event, 10, self.endtime, now=self.now, floor=25), 25)
+
+    def test_unknown_remaining_waits_the_minimum(self):
+        event = {}
+        next_check_interval(event, 10, self.endtime, now=self.now)
+        self.assertEqual(self.later(event, 5, None), MIN_CHECK_INTERVAL)
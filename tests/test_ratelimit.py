@@ -0,0 +1,73 @@
+"""RateLimiter priority lanes and the botocore event names they are keyed by."""
+import threading
+import unittest
+
+import ratelimit
+from ratelimit import HIGH, LOW, RateLimiter
+from stub_aws import CallCounter, StubAutoScaling
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.limiter = RateLimiter(rates={"ecs.ListTasks": (1, 10), "ecs.DescribeServices": (1, 10)},
+                                   sleep=self.clock.sleep, clock=self.clock, rng=lambda: 0, share=1)
+
+    def test_lifecycle_calls_are_high_priority_by_their_event_names(self):
+        client = StubAutoScaling(CallCounter())
+        names = []
+        client.meta.events.register("before-call", lambda event_name, **kwargs: names.append(event_name))
+        client.record_lifecycle_action_heartbeat()
+        client.complete_lifecycle_action()
+        operations = [self.limiter._operation(name) for name in names]
+        self.assertEqual(operations, ["auto-scaling.RecordLifecycleActionHeartbeat",
+                                      "auto-scaling.CompleteLifecycleAction"])
+        for operation in operations:
+            self.assertIn(operation, ratelimit.PRIORITY_OPERATIONS)
+            self.assertIn(operation, ratelimit.RATES)
+            self.assertEqual(self.limiter.priority(operation), HIGH)
+
+    def test_low_lane_leaves_the_reserve(self):
+        for _ in range(5):
+            self.assertEqual(self.limiter.acquire("ecs.DescribeServices", LOW), 0)
+        # half of the burst of 10 is held back for high priority calls
+        self.assertGreater(self.limiter.acquire("ecs.DescribeServices", LOW), 0)
+
+    def test_high_lane_uses_the_whole_bucket(self):
+        for _ in range(5):
+            self.limiter.acquire("ecs.ListTasks", LOW)
+        for _ in range(5):
+            self.assertEqual(self.limiter.acquire("ecs.ListTasks", HIGH), 0)
+        self.assertGreater(self.limiter.acquire("ecs.ListTasks", HIGH), 0)
+
+    def test_lane_overrides_the_operation_priority(self):
+        self.assertEqual(self.limiter.priority("ecs.DescribeServices"), LOW)
+        with self.limiter.lane(HIGH):
+            self.assertEqual(self.limiter.priority("ecs.DescribeServices"), HIGH)
+        self.assertEqual(self.limiter.priority("ecs.DescribeServices"), LOW)
+
+    def test_bind_carries_the_lane_to_another_thread(self):
+        seen = []
+
+        def work():
+            seen.append(self.limiter.priority("ecs.DescribeServices"))
+
+        with self.limiter.lane(HIGH):
+            unbound = threading.Thread(target=work)
+            bound = threading.Thread(target=self.limiter.bind(work))
+        for thread in (unbound, bound):
+            thread.start()
+            thread.join()
+        self.assertEqual(seen, [LOW, HIGH])
@@ -0,0 +1,53 @@
+"""Snapshots of the stub cluster saved, loaded and aggregated again."""
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import snapshot
+from cluster_stats import ClusterStatAggregator
+from ratelimit import limiter
+from stub_aws import StubAWS, SyntheticCluster
+
+
+class SnapshotRoundTripTest(unittest.TestCase):
+
+    def setUp(self):
+        StubAWS(SyntheticCluster(30, 8)).install()
+        limiter.enabled = False
+        self.cluster = ClusterStatAggregator("bench")
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, "snapshot.json")
+
+    def tearDown(self):
+        limiter.enabled = True
+
+    def rerun(self, saved):
+        snapshot.save(saved, self.path)
+        return snapshot.SnapshotAggregator(snapshot.load(self.path))
+
+    def test_rerun_matches_the_live_aggregation(self):
+        rerun = self.rerun(snapshot.snapshot_from(self.cluster))
+        self.assertTrue(self.cluster.groups)
+        self.assertNotIn(None, [key[1] for key in self.cluster.group_counts])
+        self.assertEqual(json.dumps(rerun.groups, sort_keys=True), json.dumps(self.cluster.groups, sort_keys=True))
+        self.assertEqual(rerun.free_spaces, self.cluster.free_spaces)
+        self.assertEqual(rerun.desired_tasks, self.cluster.desired_tasks)
+
+    def test_version_1_snapshot_groups_under_none(self):
+        saved = snapshot.snapshot_from(self.cluster)
+        saved["version"] = 1
+        for instance in saved["instances"]:
+            del instance["attributes"]
+        rerun = self.rerun(saved)
+        self.assertEqual({key[1] for key in rerun.group_counts}, {None})
+        self.assertEqual(rerun.free_spaces, self.cluster.free_spaces)
+
+    def test_unknown_version_is_refused(self):
+        saved = snapshot.snapshot_from(self.cluster)
+        saved["version"] = snapshot.SNAPSHOT_VERSION + 1
+        snapshot.save(saved, self.path)
+        with self.assertRaises(ValueError):
+            snapshot.load(self.path)